@@ -2,8 +2,21 @@ __author__ = """Lucas Lima Rodrigues"""
 __email__ = "lucaslrodri@gmail.com"
 __version__ = "0.1.0"
 
-from .jupyter_tikz import _ARGS, TexDocument, TexFragment, TikZMagics
+from .jupyter_tikz import _ARGS, TexDocument, TexFragment
+
+
+def __getattr__(name: str):
+    # The magic imports IPython, so it is only loaded when it is used
+    if name == "TikZMagics":
+        from .magics import TikZMagics
+
+        return TikZMagics
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def load_ipython_extension(ipython):  # pragma: no cover
+    from .magics import TikZMagics
+    from .warmup import _warmup_on_load
+
     ipython.register_magics(TikZMagics)
+    _warmup_on_load()
@@ -0,0 +1,265 @@
+"""Command-line batch renderer for TeX/TikZ files, e.g., `python -m jupyter_tikz -j 4 -r figures/*.tikz`."""
+
+import argparse
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from pathlib import Path
+from threading import Lock
+
+from .converters import _converter_name
+from .jupyter_tikz import (
+    _ARGS,
+    TexDocument,
+    TexFragment,
+    _export_targets,
+    _get_arg_params,
+    _get_input_type,
+)
+
+# Magic options that make no sense when rendering several files
+_EXCLUDED_ARGS = [
+    "print-jinja",
+    "print-tex",
+    "no-compile",
+    "split-pictures",
+    "animate",
+    "fps",
+    "animation-format",
+    "cache",
+    "draft",
+    "refine",
+    "reuse-saved",
+    "save-tikz",
+    "save-tex",
+    "save-pdf",
+    "save-image",
+    "save-var",
+]
+# Options that do not change the output image
+_RUN_ONLY_ARGS = [
+    "sources",
+    "jobs",
+    "force",
+    "journal",
+    "no_cache",
+    "full_err",
+    "keep_temp",
+]
+_DEFAULT_JOURNAL = ".jupyter-tikz-journal.jsonl"
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m jupyter_tikz",
+        description="Render TeX/TikZ files to images. `.tex` files are rendered as full documents and `.tikz` files as standalone documents, unless an input type is given.",
+    )
+    parser.add_argument(
+        "sources",
+        nargs="+",
+        help="TeX/TikZ files or glob patterns, e.g., `figs/**/*.tikz`.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default=None,
+        help="Directory for the output images. Defaults to the directory of each source.",
+    )
+    parser.add_argument(
+        "--journal",
+        default=_DEFAULT_JOURNAL,
+        help=f"Journal file used to resume interrupted runs. Defaults to `{_DEFAULT_JOURNAL}`.",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Render all sources, even if up to date."
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Do not use the render cache."
+    )
+    for arg in _ARGS:
+        if arg in _EXCLUDED_ARGS:
+            continue
+        args, kwargs = _get_arg_params(arg)
+        if arg == "input-type":
+            # Without an explicit input type, it is given by the file extension
+            kwargs["default"] = None
+            kwargs["help"] = (
+                f"{_ARGS[arg]['desc']}. Defaults to `full-document` for `.tex` files "
+                "and `standalone-document` otherwise."
+            )
+        parser.add_argument(*args, **kwargs)
+    return parser
+
+
+def _expand_sources(patterns: list[str]) -> tuple[list[Path], list[str]]:
+    sources: dict[Path, None] = {}
+    unmatched = []
+    for pattern in patterns:
+        matches = [Path(match) for match in sorted(glob.glob(pattern, recursive=True))]
+        matches = [match.resolve() for match in matches if match.is_file()]
+        if not matches:
+            unmatched.append(pattern)
+        sources.update(dict.fromkeys(matches))
+    return list(sources), unmatched
+
+
+def _input_type(source: Path, args: argparse.Namespace) -> str | None:
+    if args.implicit_pic:
+        return "tikzpicture"
+    if args.full_document:
+        return "full-document"
+    if args.input_type:
+        return _get_input_type(args.input_type)
+    return "full-document" if source.suffix == ".tex" else "standalone-document"
+
+
+def _output_path(source: Path, args: argparse.Namespace) -> Path:
+    output_dir = Path(args.output_dir).resolve() if args.output_dir else source.parent
+    return output_dir / f"{source.stem}.{'png' if args.rasterize else 'svg'}"
+
+
+def _build_document(source: Path, args: argparse.Namespace) -> TexDocument:
+    code = source.read_text(encoding="utf-8")
+    input_type = _input_type(source, args)
+    if input_type is None:
+        raise ValueError(f"`{args.input_type}` is not a valid input type.")
+    if input_type == "full-document":
+        return TexDocument(code, no_jinja=args.no_jinja)
+    return TexFragment(
+        code,
+        implicit_tikzpicture=input_type == "tikzpicture",
+        preamble=args.latex_preamble,
+        tex_packages=args.tex_packages,
+        no_tikz=args.no_tikz,
+        tikz_libraries=args.tikz_libraries,
+        pgfplots_libraries=args.pgfplots_libraries,
+        scale=args.scale,
+        no_jinja=args.no_jinja,
+    )
+
+
+def _journal_key(source: Path, args: argparse.Namespace) -> str:
+    options = {
+        key: value
+        for key, value in sorted(vars(args).items())
+        if key not in _RUN_ONLY_ARGS
+    }
+    key = source.read_bytes() + json.dumps(options, default=str).encode()
+    return md5(key).hexdigest()
+
+
+def _read_journal(journal_path: Path) -> dict[str, dict]:
+    entries = {}
+    if journal_path.exists():
+        for line in journal_path.read_text(encoding="utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:  # Interrupted while writing
+                continue
+            entries[entry["output"]] = entry
+    return entries
+
+
+def _is_up_to_date(source: Path, output: Path, key: str, journal: dict) -> bool:
+    if not output.exists() or output.stat().st_mtime < source.stat().st_mtime:
+        return False
+    entry = journal.get(str(output))
+    return entry is None or (entry["key"] == key and entry["status"] == "done")
+
+
+def _render(source: Path, output: Path, args: argparse.Namespace) -> bool:
+    try:
+        tex_document = _build_document(source, args)
+        image = tex_document.run_latex(
+            tex_program=args.tex_program,
+            tex_args=args.tex_args,
+            rasterize=args.rasterize,
+            full_err=args.full_err,
+            keep_temp=args.keep_temp,
+            save_image=str(output),
+            dpi=args.dpi,
+            grayscale=args.gray,
+            cache=not args.no_cache,
+            max_passes=args.max_passes,
+            converter=args.converter,
+            export_formats=args.export_formats,
+        )
+    except Exception as e:  # e.g., a Jinja syntax error: the other files are rendered
+        print(f"{source}: {e}", file=sys.stderr)
+        return False
+    return image is not None
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Renders the TeX/TikZ files given in the command line.
+
+    Returns:
+        int: The exit code, `1` if any file failed to render.
+    """
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+    args.jobs = args.jobs or os.cpu_count()
+    try:
+        _converter_name(args.converter, "png" if args.rasterize else "svg")
+        _export_targets(args.export_formats, "output", args.dpi)
+    except ValueError as e:
+        parser.error(str(e))
+
+    sources, unmatched = _expand_sources(args.sources)
+    for pattern in unmatched:
+        print(f"No files match `{pattern}`.", file=sys.stderr)
+
+    journal_path = Path(args.journal).resolve()
+    journal = {} if args.force else _read_journal(journal_path)
+    journal_lock = Lock()
+
+    pending, skipped = [], []
+    for source in sources:
+        output = _output_path(source, args)
+        key = _journal_key(source, args)
+        if not args.force and _is_up_to_date(source, output, key, journal):
+            skipped.append(source)
+        else:
+            pending.append((source, output, key))
+
+    def render(job: tuple[Path, Path, str]) -> tuple[Path, bool]:
+        source, output, key = job
+        ok = _render(source, output, args)
+        entry = {
+            "source": str(source),
+            "output": str(output),
+            "key": key,
+            "status": "done" if ok else "failed",
+        }
+        with journal_lock:
+            journal[entry["output"]] = entry
+            with journal_path.open("a", encoding="utf-8") as journal_file:
+                journal_file.write(json.dumps(entry) + "\n")
+        return source, ok
+
+    journal_path.parent.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(render, pending))
+
+    # Keep only the latest entry for each output
+    journal_path.write_text(
+        "".join(json.dumps(entry) + "\n" for entry in journal.values()),
+        encoding="utf-8",
+    )
+
+    rendered = [str(source) for source, ok in results if ok]
+    failed = [str(source) for source, ok in results if not ok] + unmatched
+    print(
+        f"{len(rendered)} rendered, {len(skipped)} up to date, {len(failed)} failed.",
+        file=sys.stderr,
+    )
+    for source in failed:
+        print(f"Failed: {source}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
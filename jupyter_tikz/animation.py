@@ -0,0 +1,376 @@
+"""Animations rendered from a sequence of documents, e.g., a Jinja template over a range of parameter values."""
+
+from __future__ import annotations
+
+import io
+import re
+import struct
+import sys
+import zlib
+from fractions import Fraction
+from hashlib import md5
+from pathlib import Path
+from typing import TYPE_CHECKING, Literal, Sequence
+
+from .jupyter_tikz import (
+    _DEFAULT_MAX_PASSES,
+    TexDocument,
+    _dest_path,
+    _evict_cache,
+    _image_cache_key,
+    _indexed_dest,
+    _make_temp_dir,
+    _pdftocairo_path,
+    _restore_cached,
+    _save_bytes,
+    _store_cached,
+)
+
+if TYPE_CHECKING:
+    from IPython.display import Image
+
+_ANIMATION_FORMATS = ["apng", "gif", "frames"]
+# Wraps each frame of `standalone` documents, so each one is cropped to its own page
+_FRAME_ENV = "jupytertikzframe"
+_STANDALONE_CLASS_PATTERN = re.compile(
+    r"\\documentclass(?:\[(?P<options>[^\]]*)\])?\{standalone\}"
+)
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def render_animation(
+    frames: Sequence[TexDocument],
+    fps: float = 10,
+    animation_format: Literal["apng", "gif", "frames"] = "apng",
+    tex_program: str = "pdflatex",
+    tex_args: str | None = None,
+    full_err: bool = False,
+    keep_temp: bool = False,
+    save_image: str | None = None,
+    dpi: int = 96,
+    grayscale: bool = False,
+    cache: bool = False,
+    max_passes: int = _DEFAULT_MAX_PASSES,
+) -> Image | list[Image] | None:
+    """Renders the documents as the frames of an animation.
+
+    Frames sharing the same preamble are compiled as the pages of a single document, and all pages are rasterized with a single `pdftocairo` call. Otherwise, each frame is rendered with `run_latex`. With `cache`, only the frames that are not in the render cache are compiled.
+
+    Example:
+        `render_animation([TexFragment(code, ns={"t": t}) for t in range(10)])`
+
+    Args:
+        frames: One document per frame.
+        fps: Frames per second.
+        animation_format: `apng` (animated PNG), `gif` (requires Pillow) or `frames` (a list with one image per frame).
+        tex_program: The LaTeX program to use for compilation.
+        tex_args: Arguments to pass to the TeX program.
+        full_err: Print the full error message when an error occurs.
+        keep_temp: Keep the temporary LaTeX files, moved to the working directory at the end.
+        save_image: Save the animation to file. With `frames`, each frame is saved with its number as suffix (e.g., `frame-1.png`).
+        dpi: DPI to use when rasterizing the frames.
+        grayscale: Set grayscale to the frames.
+        cache: Reuse the frames from the render cache.
+        max_passes: Maximum number of TeX passes.
+
+    Returns:
+        Image | list[Image] | None: The animation, or a list of frames. None if an error occurs.
+    """
+    if animation_format not in _ANIMATION_FORMATS:
+        raise ValueError(
+            f"`{animation_format}` is not a valid animation format. "
+            f"Valid formats are: {', '.join(_ANIMATION_FORMATS)}."
+        )
+    if not frames:
+        raise ValueError("No frames to render.")
+
+    keys = [
+        _image_cache_key(frame._cache_key(tex_program, tex_args), "png", dpi, grayscale)
+        for frame in frames
+    ]
+    pngs: dict[str, bytes] = {}
+    if cache:
+        for key in set(keys):
+            cached = _read_cached(key)
+            if cached is not None:
+                pngs[key] = cached
+
+    # Identical frames are rendered once
+    pending = {key: frame for key, frame in zip(keys, frames) if key not in pngs}
+    if pending:
+        options = dict(
+            tex_program=tex_program,
+            tex_args=tex_args,
+            full_err=full_err,
+            keep_temp=keep_temp,
+            dpi=dpi,
+            grayscale=grayscale,
+            cache=cache,
+            max_passes=max_passes,
+        )
+        rendered = _render_frames(list(pending.values()), list(pending), **options)
+        if rendered is None:
+            return None
+        pngs.update(zip(pending, rendered))
+
+    images = [pngs[key] for key in keys]
+    source_hash = md5("".join(frame._hex_hash for frame in frames).encode()).hexdigest()
+
+    from IPython import display
+
+    if animation_format == "frames":
+        if save_image:
+            for index, data in enumerate(images, start=1):
+                dest_path = _dest_path(_indexed_dest(save_image, index), "png")
+                _save_bytes(dest_path, data, source_hash)
+        return [display.Image(data=data, format="png") for data in images]
+
+    if animation_format == "gif":
+        animation = _gif(images, fps)
+    else:
+        animation = _apng(images, fps)
+        if animation is None:
+            print(
+                "The frames have different sizes. Use a fixed bounding box "
+                "(e.g., `\\useasboundingbox (-2,-2) rectangle (2,2);`) to animate them.",
+                file=sys.stderr,
+            )
+            return None
+    image_format = "gif" if animation_format == "gif" else "png"
+    if save_image:
+        _save_bytes(_dest_path(save_image, image_format), animation, source_hash)
+    return display.Image(data=animation, format=image_format)
+
+
+def _read_cached(key: str) -> bytes | None:
+    path = Path(key)
+    if not _restore_cached(key, path):
+        return None
+    try:
+        return path.read_bytes()
+    finally:
+        path.unlink()
+
+
+def _split_document(latex: str) -> tuple[str, str] | None:
+    begin = re.search(r"\\begin\{document\}[^\n]*\n?", latex)
+    end = latex.rfind("\\end{document}")
+    if not begin or end < begin.end():
+        return None
+    return latex[: begin.start()], latex[begin.end() : end].strip("\n")
+
+
+def _frames_latex(frames: Sequence[TexDocument]) -> str | None:
+    """Joins the frames into a multi-page document, if they share the same preamble."""
+    parts = [_split_document(frame.full_latex) for frame in frames]
+    if any(part is None for part in parts) or len({part[0] for part in parts}) > 1:
+        return None
+    preamble = parts[0][0]
+    bodies = [body for _, body in parts]
+
+    match = _STANDALONE_CLASS_PATTERN.search(preamble)
+    if match is None:  # Other classes have page breaks
+        body = "\n\\clearpage\n".join(bodies)
+    else:
+        options = [
+            option.strip()
+            for option in (match.group("options") or "").split(",")
+            if option.strip()
+        ]
+        if any(option == "tikz" or option.startswith("multi") for option in options):
+            body = "\n".join(bodies)  # Each picture is already a page
+        else:
+            options.append(f"multi={_FRAME_ENV}")
+            preamble = (
+                preamble[: match.start()]
+                + f"\\documentclass[{','.join(options)}]{{standalone}}"
+                + preamble[match.end() :]
+                + f"\\newenvironment{{{_FRAME_ENV}}}{{}}{{}}\n"
+            )
+            body = "\n".join(
+                f"\\begin{{{_FRAME_ENV}}}\n{frame_body}\n\\end{{{_FRAME_ENV}}}"
+                for frame_body in bodies
+            )
+    return f"{preamble}\\begin{{document}}\n{body}\n\\end{{document}}"
+
+
+def _render_frames(
+    frames: list[TexDocument],
+    keys: list[str],
+    tex_program: str,
+    tex_args: str | None,
+    full_err: bool,
+    keep_temp: bool,
+    dpi: int,
+    grayscale: bool,
+    cache: bool,
+    max_passes: int,
+) -> list[bytes] | None:
+    latex = _frames_latex(frames) if len(frames) > 1 else None
+    if latex is not None:
+        pages = _render_pages(
+            TexDocument(latex, no_jinja=True),
+            tex_program,
+            tex_args,
+            full_err,
+            keep_temp,
+            dpi,
+            grayscale,
+            max_passes,
+        )
+        if pages is None:
+            return None
+        if len(pages) == len(frames):
+            if cache:
+                stored = [_store_bytes(data, key) for data, key in zip(pages, keys)]
+                if any(stored):
+                    _evict_cache()
+            return pages
+        # e.g., a frame with several pictures: pages and frames do not match
+
+    images = []
+    for frame in frames:
+        image = frame.run_latex(
+            tex_program=tex_program,
+            tex_args=tex_args,
+            rasterize=True,
+            full_err=full_err,
+            keep_temp=keep_temp,
+            dpi=dpi,
+            grayscale=grayscale,
+            cache=cache,
+            max_passes=max_passes,
+        )
+        if image is None:
+            return None
+        images.append(image.data)
+    return images
+
+
+def _render_pages(
+    document: TexDocument,
+    tex_program: str,
+    tex_args: str | None,
+    full_err: bool,
+    keep_temp: bool,
+    dpi: int,
+    grayscale: bool,
+    max_passes: int,
+) -> list[bytes] | None:
+    temp_dir = _make_temp_dir()
+    tex_path = temp_dir / f"{document._hex_hash}.tex"
+    try:
+        tex_path.write_text(document.full_latex, encoding="utf-8")
+        res = document._compile(tex_path, tex_program, tex_args, full_err, max_passes)
+        if res != 0:
+            return None
+
+        # pdftocairo writes `<prefix>-<page>.png`, with zero padded page numbers
+        prefix = tex_path.with_suffix(".frame")
+        pdftocairo_command = (
+            f"{_pdftocairo_path()} -png -{'gray' if grayscale else 'transp'} -r {dpi}"
+            f" {tex_path.with_suffix('.pdf')} {prefix}"
+        )
+        if document._run_command(pdftocairo_command, full_err=full_err) != 0:
+            return None
+        pages = sorted(
+            tex_path.parent.glob(f"{prefix.name}-*.png"),
+            key=lambda page: int(page.stem.rsplit("-", 1)[1]),
+        )
+        return [page.read_bytes() for page in pages]
+    finally:
+        document._clearup_latex_garbage(keep_temp, temp_dir)
+
+
+def _store_bytes(data: bytes, key: str) -> bool:
+    path = Path(f"{key}.part")
+    path.write_bytes(data)
+    try:
+        return _store_cached(path, key)
+    finally:
+        path.unlink()
+
+
+def _png_chunks(data: bytes) -> list[tuple[bytes, bytes]]:
+    chunks = []
+    offset = len(_PNG_SIGNATURE)
+    while offset < len(data):
+        (length,) = struct.unpack("!I", data[offset : offset + 4])
+        chunk_type = data[offset + 4 : offset + 8]
+        chunks.append((chunk_type, data[offset + 8 : offset + 8 + length]))
+        offset += length + 12
+    return chunks
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(chunk_type + data)
+    return struct.pack("!I", len(data)) + chunk_type + data + struct.pack("!I", crc)
+
+
+def _apng(images: list[bytes], fps: float) -> bytes | None:
+    """Assembles PNG frames into an animated PNG, without re-encoding them.
+
+    Returns:
+        bytes | None: The animated PNG. None if the frames have different sizes or pixel formats.
+    """
+    frames = [_png_chunks(data) for data in images]
+    headers = [dict(chunks)[b"IHDR"] for chunks in frames]
+    if len(set(headers)) > 1:
+        return None
+    width, height = struct.unpack("!II", headers[0][:8])
+    delay = Fraction(1 / fps).limit_denominator(1000)
+
+    apng = _PNG_SIGNATURE + _png_chunk(b"IHDR", headers[0])
+    # Ancillary chunks of the first frame, e.g., the resolution (pHYs)
+    for chunk_type, data in frames[0]:
+        if chunk_type not in (b"IHDR", b"IDAT", b"IEND"):
+            apng += _png_chunk(chunk_type, data)
+    apng += _png_chunk(b"acTL", struct.pack("!II", len(frames), 0))  # Loop forever
+
+    sequence = 0
+    for index, chunks in enumerate(frames):
+        # Each frame clears the canvas, so transparent frames do not accumulate
+        frame_control = struct.pack(
+            "!IIIIIHHBB",
+            sequence,
+            width,
+            height,
+            0,
+            0,
+            delay.numerator,
+            delay.denominator,
+            1,
+            0,
+        )
+        apng += _png_chunk(b"fcTL", frame_control)
+        sequence += 1
+        for chunk_type, data in chunks:
+            if chunk_type != b"IDAT":
+                continue
+            if index == 0:  # The first frame is also the still image
+                apng += _png_chunk(b"IDAT", data)
+            else:
+                apng += _png_chunk(b"fdAT", struct.pack("!I", sequence) + data)
+                sequence += 1
+    return apng + _png_chunk(b"IEND", b"")
+
+
+def _gif(images: list[bytes], fps: float) -> bytes:
+    try:
+        from PIL import Image as PILImage
+    except ImportError as e:  # pragma: no cover
+        raise ImportError(
+            "Pillow is required to render GIF animations. Use `apng` instead, or install Pillow."
+        ) from e
+    frames = [PILImage.open(io.BytesIO(data)) for data in images]
+    gif = io.BytesIO()
+    frames[0].save(
+        gif,
+        format="GIF",
+        save_all=True,
+        append_images=frames[1:],
+        duration=round(1000 / fps),
+        loop=0,
+        disposal=2,
+    )
+    return gif.getvalue()
@@ -0,0 +1,146 @@
+"""Backends converting the compiled PDF to the output image.
+
+The backend is chosen with `run_latex(converter=...)`, the `JUPYTER_TIKZ_CONVERTER` environment variable, or defaults to `pdftocairo`. `pymupdf` converts in-process, without spawning a program per figure.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+from pathlib import Path
+from typing import Callable
+
+_DEFAULT_CONVERTER = "pdftocairo"
+
+
+def _pdftocairo_path() -> str:
+    return os.environ.get("JUPYTER_TIKZ_PDFTOCAIROPATH") or "pdftocairo"
+
+
+def _convert_pdftocairo(
+    pdf_path: Path,
+    image_path: Path,
+    dpi: int,
+    grayscale: bool,
+    run_command: Callable[[str], int],
+) -> int:
+    rasterize = image_path.suffix == ".png"
+    command = f"{_pdftocairo_path()} -{image_path.suffix[1:]}"
+    if rasterize:
+        command += f" -singlefile -{'gray' if grayscale else 'transp'} -r {dpi}"
+    command += f" {pdf_path}"
+    # With `-singlefile`, pdftocairo adds the extension
+    command += (
+        f" {image_path.parent / image_path.stem}" if rasterize else f" {image_path}"
+    )
+    return run_command(command)
+
+
+def _convert_pdftoppm(
+    pdf_path: Path,
+    image_path: Path,
+    dpi: int,
+    grayscale: bool,
+    run_command: Callable[[str], int],
+) -> int:
+    # No transparency: the background is white
+    command = f"pdftoppm -png -singlefile -r {dpi}{' -gray' if grayscale else ''}"
+    return run_command(f"{command} {pdf_path} {image_path.parent / image_path.stem}")
+
+
+def _convert_dvisvgm(
+    pdf_path: Path,
+    image_path: Path,
+    dpi: int,
+    grayscale: bool,
+    run_command: Callable[[str], int],
+) -> int:
+    _ = dpi, grayscale
+    # Glyphs are drawn as paths, as with pdftocairo, so the SVG needs no fonts
+    return run_command(
+        f"dvisvgm --pdf --page=1 --no-fonts --output={image_path} {pdf_path}"
+    )
+
+
+def _import_pymupdf():
+    try:
+        import pymupdf
+    except ImportError:
+        try:
+            import fitz as pymupdf  # PyMuPDF < 1.24
+        except ImportError as e:  # pragma: no cover
+            raise ImportError(
+                "PyMuPDF is required to use the `pymupdf` converter. Install it, or use `pdftocairo`."
+            ) from e
+    return pymupdf
+
+
+def _convert_pymupdf(
+    pdf_path: Path,
+    image_path: Path,
+    dpi: int,
+    grayscale: bool,
+    run_command: Callable[[str], int],
+) -> int:
+    _ = run_command
+    pymupdf = _import_pymupdf()
+    try:
+        with pymupdf.open(pdf_path) as document:
+            page = document[0]
+            if image_path.suffix == ".svg":
+                image_path.write_text(
+                    page.get_svg_image(text_as_path=True), encoding="utf-8"
+                )
+            else:
+                if grayscale:
+                    pixmap = page.get_pixmap(
+                        dpi=dpi, colorspace=pymupdf.csGRAY, alpha=False
+                    )
+                else:
+                    pixmap = page.get_pixmap(dpi=dpi, alpha=True)
+                pixmap.save(str(image_path))
+    except Exception as e:  # e.g., a corrupted PDF
+        print(f"PyMuPDF: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+_CONVERTERS = {
+    "pdftocairo": {"formats": ["svg", "png"], "convert": _convert_pdftocairo},
+    "pdftoppm": {"formats": ["png"], "convert": _convert_pdftoppm},
+    "dvisvgm": {"formats": ["svg"], "convert": _convert_dvisvgm},
+    "pymupdf": {"formats": ["svg", "png"], "convert": _convert_pymupdf},
+}
+
+
+def _converter_name(converter: str | None, image_format: str) -> str:
+    """Returns the converter to use, raising `ValueError` if it cannot output `image_format`."""
+    converter = (
+        converter or os.environ.get("JUPYTER_TIKZ_CONVERTER") or _DEFAULT_CONVERTER
+    )
+    if converter not in _CONVERTERS:
+        raise ValueError(
+            f"`{converter}` is not a valid converter. "
+            f"Valid converters are: {', '.join(_CONVERTERS)}."
+        )
+    if image_format not in _CONVERTERS[converter]["formats"]:
+        raise ValueError(f"`{converter}` cannot output {image_format.upper()} images.")
+    return converter
+
+
+def convert(
+    converter: str,
+    pdf_path: Path,
+    image_path: Path,
+    dpi: int,
+    grayscale: bool,
+    run_command: Callable[[str], int],
+) -> int:
+    """Converts the first page of `pdf_path` to `image_path`, in the format given by its extension.
+
+    Returns:
+        int: The exit code, `0` on success.
+    """
+    return _CONVERTERS[converter]["convert"](
+        pdf_path, image_path, dpi, grayscale, run_command
+    )
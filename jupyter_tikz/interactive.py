@@ -0,0 +1,261 @@
+"""Interactive figures driven by ipywidgets, e.g., `interact_tikz(code, r=(1, 5))`.
+
+Widget changes are debounced, obsolete renders are dropped, rendered values are served from memory, and the neighbouring slider positions are rendered in the background while the user is idle.
+"""
+
+from __future__ import annotations
+
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from contextlib import redirect_stderr
+from typing import Any, Callable
+
+from .jupyter_tikz import TexDocument, TexFragment, _CancelScope
+
+_DEFAULT_DEBOUNCE = 0.2  # s
+_DEFAULT_CACHE_SIZE = 128  # renders
+
+
+def _params_key(params: dict[str, Any]) -> str:
+    return repr(sorted(params.items()))
+
+
+class _RenderScheduler:
+    """Renders the latest requested parameters in the background.
+
+    Requests are debounced, and renders of previous requests are cancelled: queued ones are dropped, and the TeX and converter processes of the running one are terminated. Rendered parameters are kept in a LRU cache, and shown at once.
+    """
+
+    def __init__(
+        self,
+        render: Callable[[dict[str, Any]], Any],
+        on_result: Callable[[Any], None],
+        debounce: float = _DEFAULT_DEBOUNCE,
+        cache_size: int = _DEFAULT_CACHE_SIZE,
+    ):
+        self._render = render
+        self._on_result = on_result
+        self.debounce = debounce
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, Any] = OrderedDict()
+        self._running: dict[str, Future] = {}
+        self._scopes: dict[str, _CancelScope] = {}
+        self._generation = 0
+        self._timer: threading.Timer | None = None
+        # Reentrant, since callbacks of finished futures run when they are added
+        self._lock = threading.RLock()
+        # A single worker, so a prefetch never delays a render by more than one compile
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def request(
+        self, params: dict[str, Any], neighbours: list[dict[str, Any]] | None = None
+    ) -> None:
+        """Shows the render of `params`, then prefetches `neighbours`."""
+        neighbours = neighbours or []
+        key = _params_key(params)
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            if self._timer is not None:
+                self._timer.cancel()
+            for running_key, future in list(self._running.items()):
+                if running_key != key and not future.cancel():
+                    # Already running, e.g., a prefetch: stop its processes. The scope
+                    # is missing while the render starts or finishes
+                    scope = self._scopes.get(running_key)
+                    if scope is not None:
+                        scope.cancel()
+            cached = key in self._cache
+            if cached:
+                self._cache.move_to_end(key)
+                result = self._cache[key]
+            else:
+                self._timer = threading.Timer(
+                    self.debounce, self._start, (key, params, generation, neighbours)
+                )
+                self._timer.daemon = True
+                self._timer.start()
+        if cached:
+            self._on_result(result)
+            self.prefetch(neighbours, generation)
+
+    def prefetch(self, params_list: list[dict[str, Any]], generation: int) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return  # The user moved on
+            for params in params_list:
+                key = _params_key(params)
+                if key not in self._cache:
+                    self._submit(key, params)
+
+    def close(self) -> None:
+        with self._lock:
+            self._generation += 1
+            if self._timer is not None:
+                self._timer.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _start(self, key: str, params: dict[str, Any], generation: int, neighbours):
+        with self._lock:
+            if generation != self._generation:
+                return  # Superseded while debouncing
+            future = self._submit(key, params)
+        future.add_done_callback(
+            lambda future: self._finish(future, generation, neighbours)
+        )
+
+    def _submit(self, key: str, params: dict[str, Any]) -> Future:
+        with self._lock:
+            future = self._running.get(key)
+            if future is None:
+                future = self._executor.submit(self._render_cached, key, params)
+                self._running[key] = future
+                future.add_done_callback(lambda future: self._forget(key, future))
+            return future
+
+    def _forget(self, key: str, future: Future) -> None:
+        with self._lock:
+            if self._running.get(key) is future:
+                del self._running[key]
+
+    def _render_cached(self, key: str, params: dict[str, Any]) -> Any:
+        scope = _CancelScope()
+        with self._lock:
+            self._scopes[key] = scope
+        try:
+            with scope:
+                result = self._render(params)
+        finally:
+            with self._lock:
+                del self._scopes[key]
+        if scope.terminated:  # The render failed because it was cancelled
+            raise CancelledError()
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def _finish(self, future: Future, generation: int, neighbours) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return  # Obsolete
+        self._on_result(future.result())
+        self.prefetch(neighbours, generation)
+
+
+def _neighbour_values(widget) -> list:
+    """Returns the values next to the current value of a slider or selection widget."""
+    options = getattr(widget, "_options_values", None)
+    if options is not None:  # e.g., `Dropdown` or `SelectionSlider`
+        index = widget.index
+        if index is None:
+            return []
+        return [options[i] for i in (index - 1, index + 1) if 0 <= i < len(options)]
+    if isinstance(widget.value, bool):
+        return [not widget.value]
+    step = getattr(widget, "step", None)
+    if isinstance(widget.value, (int, float)) and step:
+        # Rounded, so float sliders match the values they report
+        values = [round(widget.value + delta, 10) for delta in (-step, step)]
+        return [value for value in values if widget.min <= value <= widget.max]
+    return []
+
+
+def _neighbours(widgets: dict[str, Any], values: dict[str, Any]) -> list[dict]:
+    return [
+        {**values, name: value}
+        for name, widget in widgets.items()
+        for value in _neighbour_values(widget)
+    ]
+
+
+def interact_tikz(
+    code: str,
+    full_document: bool = False,
+    fragment_options: dict[str, Any] | None = None,
+    run_options: dict[str, Any] | None = None,
+    ns: dict[str, Any] | None = None,
+    debounce: float = _DEFAULT_DEBOUNCE,
+    cache_size: int = _DEFAULT_CACHE_SIZE,
+    prefetch: bool = True,
+    **widgets,
+):
+    """Renders a Jinja template with the values of ipywidgets controls.
+
+    Example:
+        `interact_tikz(r"\\draw (0,0) circle ((* r *));", fragment_options={"implicit_tikzpicture": True}, r=(0.5, 2, 0.25))`
+
+    Args:
+        code: Jinja template of the LaTeX code.
+        full_document: Whether `code` is a full document. Otherwise, it is rendered with `TexFragment`.
+        fragment_options: Options passed to `TexFragment`, e.g., `{"implicit_tikzpicture": True, "tikz_libraries": "calc"}`.
+        run_options: Options passed to `run_latex`, e.g., `{"rasterize": True}`.
+        ns: Variables of the template, besides the widgets.
+        debounce: Time (s) without changes before rendering.
+        cache_size: Number of renders kept in memory.
+        prefetch: Render the neighbouring positions of each widget while the user is idle.
+        **widgets: One widget per template variable, or an abbreviation as in `ipywidgets.interact` (e.g., `(0, 10)` for a slider).
+
+    Returns:
+        ipywidgets.VBox: The widgets and the output.
+    """
+    try:
+        import ipywidgets
+    except ImportError as e:  # pragma: no cover
+        raise ImportError(
+            "ipywidgets is required to use `interact_tikz`. "
+            "Install it with `pip install jupyter-tikz[widgets]`."
+        ) from e
+
+    controls = {}
+    for name, abbrev in widgets.items():
+        if isinstance(abbrev, ipywidgets.Widget):
+            control = abbrev
+        else:
+            control = ipywidgets.interactive.widget_from_abbrev(abbrev)
+            if control is None:
+                raise ValueError(f"{abbrev!r} cannot be transformed to a widget.")
+        if not control.description:
+            control.description = name
+        controls[name] = control
+    output = ipywidgets.Output()
+
+    def render(params: dict[str, Any]) -> tuple[Any, str]:
+        stderr = io.StringIO()
+        try:
+            with redirect_stderr(stderr):
+                variables = {**(ns or {}), **params}
+                if full_document:
+                    tex = TexDocument(code, ns=variables)
+                else:
+                    tex = TexFragment(code, ns=variables, **(fragment_options or {}))
+                image = tex.run_latex(**(run_options or {}))
+        except Exception as e:  # e.g., undefined Jinja variables
+            return None, f"{type(e).__name__}: {e}"
+        return image, stderr.getvalue()
+
+    def show(result: tuple[Any, str]) -> None:
+        image, error = result
+        # Called from worker threads, where `with output` is not reliable
+        output.outputs = ()
+        if image is not None:
+            output.append_display_data(image)
+        if error:
+            output.append_stderr(error)
+
+    scheduler = _RenderScheduler(render, show, debounce, cache_size)
+
+    def on_change(_=None) -> None:
+        values = {name: control.value for name, control in controls.items()}
+        neighbours = _neighbours(controls, values) if prefetch else []
+        scheduler.request(values, neighbours)
+
+    for control in controls.values():
+        control.observe(on_change, names="value")
+    on_change()
+    return ipywidgets.VBox([*controls.values(), output])
@@ -1,20 +1,48 @@
 """Jupyter TikZ is an IPython Cell and Line Magic for rendering TeX/TikZ outputs in Jupyter Notebooks."""
 
+from __future__ import annotations
+
+import ast
+import base64
+import json
 import os
 import re
+import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from hashlib import md5
 from pathlib import Path
 from string import Template
 from textwrap import dedent, indent
-from typing import Any, Literal
-
-import jinja2
-from IPython import display
-from IPython.core.magic import Magics, line_cell_magic, magics_class, needs_local_scope
-from IPython.core.magic_arguments import argument, magic_arguments, parse_argstring
-from IPython.display import SVG, Image
+from typing import TYPE_CHECKING, Any, Literal
+
+if TYPE_CHECKING:
+    from IPython.display import SVG, Image
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # Windows: renders of the same key are not serialized
+
+from . import metrics as _metrics
+from . import progress as _progress
+from . import tracing as _tracing
+from .converters import (
+    _CONVERTERS,
+    _DEFAULT_CONVERTER,
+    _converter_name,
+    _pdftocairo_path,
+    convert,
+)
 
 _EXTRAS_CONFLITS_ERR = "You cannot provide `preamble` and (`tex_packages`, `tikz_libraries`, and/or `pgfplots_libraries`) at the same time."
 _PRINT_CONFLICT_ERR = (
@@ -22,6 +50,88 @@ _PRINT_CONFLICT_ERR = (
 )
 _INPUT_TYPE_CONFLIT_ERR = "You cannot use `--implicit-pic`, `--full-document` or/and `-as=<input_type>` at the same time."
 
+# Jinja2 delimiters, `(**` starts with `(*`
+_JINJA_DELIMITERS = ["(*", "(~"]
+
+# Stop at the first error instead of prompting or going through cascades of errors
+_DEFAULT_TEX_ARGS = "-interaction=batchmode -halt-on-error -file-line-error"
+# Errors look like `./file.tex:12: Undefined control sequence.` or `! Emergency stop.`
+_TEX_ERROR_PATTERN = re.compile(r"^(?:\S*:\d+: |! )", re.MULTILINE)
+_LOG_TAIL_SIZE = 16 * 1024  # bytes
+# Output of the TeX and converter processes kept for error messages
+_OUTPUT_TAIL_SIZE = 64 * 1024  # bytes
+_OUTPUT_CHUNK_SIZE = 8 * 1024  # bytes
+
+# e.g., `Label(s) may have changed. Rerun to get cross-references right.`
+_RERUN_PATTERN = re.compile(r"Rerun to get|Please rerun|Rerun LaTeX", re.IGNORECASE)
+# Lines written to every `.aux` file, which do not need another pass
+_TRIVIAL_AUX_PATTERN = re.compile(r"^\\relax$|^\\gdef ?\\@abspage@last\{\d+\}$")
+_DEFAULT_MAX_PASSES = 3
+
+# Contexts where comments and whitespace are kept when computing cache keys, including
+# data where line breaks separate rows (pgfplots inline tables, `filecontents`)
+_VERBATIM_PATTERN = re.compile(
+    r"(?s:\\begin\{(?P<env>verbatim\*?|Verbatim\*?|lstlisting|minted|alltt|filecontents\*?)\}"
+    r".*?\\end\{(?P=env)\})"
+    r"|\\verb\*?(?P<delim>[^\sa-zA-Z*])[^\n]*?(?P=delim)"
+    r"|\\(?:url|href)\{[^}]*\}"
+    r"|(?:(?<![\\a-zA-Z])table|\\pgfplotstableread)\s*(?:\[[^\]]*\])?\s*\{[^{}]*\}"
+)
+# An unescaped `%` up to the end of the line, which also skips the indentation of the next
+# line, unless it is blank (a paragraph break)
+_TEX_COMMENT_PATTERN = re.compile(r"(?<!\\)((?:\\\\)*)%[^\n]*(?:\n(?![ \t]*\n)[ \t]*)?")
+_PARAGRAPH_BREAK_PATTERN = re.compile(r"[ \t]*\n[ \t]*\n\s*")
+_CONTROL_WORD_PATTERN = re.compile(r"(?<!\\)((?:\\\\)*\\[a-zA-Z]+) ?")
+
+# Fast settings of draft previews, applied after the options of each plot
+_DRAFT_SAMPLES = 25
+_DRAFT_DPI = 48
+_DRAFT_SETTINGS = Template(
+    r"""\makeatletter
+\AtBeginDocument{%
+  \@ifpackageloaded{pgfplots}{\pgfplotsset{every axis plot post/.append style={samples=$samples, samples y=$samples_y, shader=flat}}}{}%
+  \@ifpackageloaded{tikz}{\tikzset{every plot/.append style={samples=$samples}}}{}%
+}
+\makeatother
+"""
+)
+
+_CAPACITY_EXCEEDED_MSG = "TeX capacity exceeded"
+# Enlarged texmf.cnf memory settings, e.g., for large pgfplots figures
+_ENLARGED_TEX_MEMORY = {
+    "extra_mem_top": "10000000",
+    "extra_mem_bot": "10000000",
+    "pool_size": "6000000",
+    "save_size": "100000",
+    "stack_size": "20000",
+    "buf_size": "1000000",
+    "max_strings": "500000",
+}
+_DYNAMIC_MEMORY_TEX_PROGRAM = "lualatex"
+# Documents that only compile with a fallback: {<cache key>: (program, env)}, also
+# stored in the `fallbacks` folder of the cache directory for the next processes
+_TEX_FALLBACKS: dict[str, tuple[str, dict[str, str]]] = {}
+
+# Cache size limit in MB, overridden by `JUPYTER_TIKZ_CACHESIZE`
+_DEFAULT_CACHE_SIZE = 1024
+# Shared caches (`JUPYTER_TIKZ_CACHEDIR`) are group accessible, private caches are not
+_SHARED_CACHE_MODES = (0o2770, 0o640)  # (directories, files)
+_PRIVATE_CACHE_MODES = (0o700, 0o600)
+# Temporary files of interrupted writers are removed after this time (s)
+_STALE_TEMP_AGE = 3600
+
+# The render daemon runs TeX as its owner for every client: only these engines and options
+# are sent to it, so a client cannot run shell commands (`-shell-escape`) or write elsewhere
+_DAEMON_TEX_PROGRAMS = ["pdflatex", "lualatex", "xelatex"]
+_DAEMON_TEX_ARG_PATTERN = re.compile(
+    r"--?(?:8bit|draftmode|file-line-error|no-file-line-error|halt-on-error"
+    r"|no-shell-escape|recorder|synctex=-?\d+"
+    r"|interaction=(?:batchmode|nonstopmode|scrollmode|errorstopmode))"
+)
+_DAEMON_CONNECT_TIMEOUT = 5  # s
+# Renders taking longer are run in-process, overridden by `JUPYTER_TIKZ_DAEMON_TIMEOUT`
+_DEFAULT_DAEMON_TIMEOUT = 600  # s
+
 
 class TexDocument:
     """This class provides functionality to create and render a LaTeX document given the full LaTeX code. It can also constructs LaTeX code using Jinja2 templates."""
@@ -41,11 +151,14 @@ class TexDocument:
         """
         self._code: str = code.strip()
         self._no_jinja: bool = no_jinja
+        # Set by `run_latex`: usage of the processes per stage (e.g., `tex`, `convert`)
+        self.resource_usage: dict[str, dict[str, float]] = {}
         if not ns:
             ns = {}
 
         if not self._no_jinja:
-            self._render_jinja(ns)
+            with _tracing.span("jinja"):
+                self._render_jinja(ns)
 
     @property
     def full_latex(self) -> str:
@@ -61,6 +174,50 @@ class TexDocument:
             return dedent(match.group(0))
         return None
 
+    def split_tikzpictures(self) -> list["TexDocument"]:
+        r"""Splits the document into one document per `tikzpicture`.
+
+        Each resulting document shares the original preamble (everything up to `\begin{document}`) and contains a single TikZ Picture.
+
+        Returns:
+            list[TexDocument]: One document per `tikzpicture`. Empty if the document has no `\begin{document}` or no TikZ Pictures.
+        """
+        latex = self.full_latex
+        begin = re.search(r"\\begin\{document\}[^\n]*\n?", latex)
+        if not begin:
+            return []
+
+        preamble = latex[: begin.end()]
+        pattern = r"^\s*\\begin\{tikzpicture\}.*?\\end\{tikzpicture\}"
+        pictures = re.finditer(pattern, latex[begin.end() :], re.DOTALL | re.MULTILINE)
+
+        return [
+            TexDocument(
+                preamble + match.group(0).strip("\n") + "\n\\end{document}",
+                no_jinja=True,
+            )
+            for match in pictures
+        ]
+
+    def draft(self) -> "TexDocument":
+        r"""Returns a draft of the document, which is faster to compile.
+
+        Plots use fewer samples and pgfplots surfaces are shaded flat, overriding the options of pgfplots plots. Render it with a low `dpi` (e.g., `dpi=48`) for a quick preview.
+
+        Returns:
+            TexDocument: The draft. The document itself if it has no `\begin{document}`.
+        """
+        latex = self.full_latex
+        begin = re.search(r"\\begin\{document\}", latex)
+        if not begin:
+            return self
+        settings = _DRAFT_SETTINGS.substitute(
+            samples=_DRAFT_SAMPLES, samples_y=max(_DRAFT_SAMPLES // 2, 2)
+        )
+        return TexDocument(
+            latex[: begin.start()] + settings + latex[begin.start() :], no_jinja=True
+        )
+
     @staticmethod
     def _arg_head(arg, limit=60) -> str:
         if type(arg) == str:
@@ -88,7 +245,8 @@ class TexDocument:
             [
                 f'{k if k != "_no_jinja" else "no_jinja"}={self._arg_head(v)}'
                 for k, v in params_dict.items()
-                if k not in ["_code", "full_latex", "tikz_code", "ns"] and v
+                if k not in ["_code", "full_latex", "tikz_code", "ns", "resource_usage"]
+                and v
             ]
         )
         if params:
@@ -99,55 +257,48 @@ class TexDocument:
         """Returns the LaTeX code string to render."""
         return self._code
 
-    def _clearup_latex_garbage(self, keep_temp) -> None:
-        if not (keep_temp):  # F
-            files = Path().glob(f"{self._hex_hash}.*")
-            for file in files:
-                if file.exists():
-                    file.unlink()
-
-    def _run_command(self, command: str, full_err: bool = False, **kwargs) -> int:
-
-        result = subprocess.run(
-            command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            check=False,
-            **kwargs,
-        )
+    def _clearup_latex_garbage(self, keep_temp: bool, temp_dir: Path) -> None:
+        if keep_temp:  # Moved to the working directory
+            for file in temp_dir.iterdir():
+                shutil.move(file, file.name)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _run_command(
+        self,
+        command: str,
+        full_err: bool = False,
+        log_path: Path | None = None,
+        **kwargs,
+    ) -> int:
+
+        result = _run_process(command, **kwargs)
+        _record_usage(getattr(result, "resource_usage", None))
         if result.returncode != 0:
-            err_msg = result.stderr if result.stderr else result.stdout
-            if not full_err:  # tail -n 20
-                err_msg = "\n".join(err_msg.splitlines()[-20:])
+            # In batch mode, TeX only reports errors in its log
+            err_msg = _tex_error(log_path, full_err) if log_path else None
+            if not err_msg:
+                err_msg = result.stderr if result.stderr else result.stdout
+                if not full_err:  # tail -n 20
+                    err_msg = "\n".join(err_msg.splitlines()[-20:])
             print(err_msg, file=sys.stderr)
         return result.returncode
 
     def _save(
-        self, dest: str, ext: Literal["tikz", "tex", "png", "svg", "pdf"]
+        self,
+        dest: str,
+        ext: Literal["tikz", "tex", "png", "svg", "pdf"],
+        temp_dir: Path | None = None,
+        record: bool = False,
     ) -> None:
-        dest_path = Path(dest)
-
-        if os.environ.get("JUPYTER_TIKZ_SAVEDIR"):
-            dest_path = str(os.environ.get("JUPYTER_TIKZ_SAVEDIR")) / dest_path
-        else:
-            dest_path = dest_path
-
-        dest_path = dest_path.resolve()
-
-        if dest_path.suffix != f".{ext}":
-            dest_path = dest_path.with_suffix(dest_path.suffix + f".{ext}")
-
-        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        dest_path = _dest_path(dest, ext)
 
         if ext == "tikz":
             if not self.tikz_code:
                 raise ValueError("No TikZ code to save.")
-            dest_path.with_suffix(".tikz").write_text(self.tikz_code, encoding="utf-8")
+            data = self.tikz_code.encode("utf-8")
         else:
-            Path(self._hex_hash).with_suffix(f".{ext}").replace(
-                dest_path.with_suffix(f".{ext}")
-            )
+            data = (temp_dir or Path()).joinpath(f"{self._hex_hash}.{ext}").read_bytes()
+        _save_bytes(dest_path, data, self._hex_hash, record)
 
     def run_latex(
         self,
@@ -162,89 +313,518 @@ class TexDocument:
         save_tex: str | None = None,
         save_tikz: str | None = None,
         save_pdf: str | None = None,
-    ) -> Image | SVG | None:
+        split_pictures: bool = False,
+        jobs: int | None = None,
+        cache: bool = False,
+        max_passes: int = _DEFAULT_MAX_PASSES,
+        aux_key: str | None = None,
+        converter: str | None = None,
+        reuse_saved: bool = False,
+        export_formats: str | list[str] | None = None,
+        progress: bool = False,
+    ) -> Image | SVG | list[Image | SVG | None] | None:
         """Run the LaTeX program to render the LaTeX code.
 
+        TeX is run again only when the log asks for it (e.g., `Rerun to get cross-references right`) or the `.aux` file changed, up to `max_passes` times.
+
+        If the compilation fails with `TeX capacity exceeded`, it is retried with enlarged memory settings and then with `lualatex` (dynamic memory allocation). The working fallback is reused in subsequent runs of the same document.
+
         Args:
             tex_program: The LaTeX program to use for compilation.
-            tex_args: Arguments to pass to the TeX program.
+            tex_args: Arguments to pass to the TeX program. They are passed after `-interaction=batchmode -halt-on-error -file-line-error`, so they can override them.
             rasterize: Output a rasterized image (PNG) instead of SVG.
             full_err: Print the full error message when an error occurs. If False, it prints only the last 20 lines.
-            keep_temp: Keep temporary LaTeX files.
+            keep_temp: Keep the temporary LaTeX files, moved to the working directory at the end.
             save_image: Save the output image to file.
             dpi: DPI to use when rasterizing the image.
             grayscale: Set grayscale to a rasterized image.
             save_tex: Save the full LaTeX code to file.
             save_tikz: Save the TikZ code to file.
             save_pdf: Save the output PDF to file.
+            split_pictures: Render each `tikzpicture` as a separate document, sharing the original preamble. Saved files are suffixed with the picture number (e.g., `image-1.svg`).
+            jobs: Maximum number of pictures compiled concurrently when `split_pictures` is set. Defaults to the number of CPUs.
+            cache: Reuse the PDF and image from the render cache if the same LaTeX code was already rendered with the same options. Files included by the code (e.g., with `\\input`) are not tracked.
+            max_passes: Maximum number of TeX passes, for references, `remember picture` nodes, etc.
+            aux_key: Stable identity of the document (e.g., the notebook cell id). Its `.aux` file is kept between runs, so after a small edit the references are right in a single pass.
+            converter: Backend converting the PDF to the image: `pdftocairo`, `pdftoppm` (PNG only), `dvisvgm` (SVG only) or `pymupdf` (in-process, requires PyMuPDF). Defaults to `JUPYTER_TIKZ_CONVERTER` or `pdftocairo`.
+            reuse_saved: Skip the compilation if the `save_tex` file holds the same LaTeX code and the `save_image` (or `save_pdf`) file was saved from it, unmodified since. The saved image is displayed as is, so changing only `dpi`, `grayscale` or `converter` does not render it again.
+            export_formats: Also save the figure in these formats, converted concurrently from the same PDF: `pdf`, `svg`, `png` or `png@<dpi>` (e.g., `["pdf", "png@300"]`, or `"pdf,png@300"`). Files are named after `save_image`, with the DPI for PNG images (e.g., `fig-300dpi.png`).
+            progress: In a Jupyter kernel, show the stage, TeX pass, pages and elapsed time of compilations taking more than 2 s. Not shown with `split_pictures`.
 
         Returns:
-            Image | SVG | None: The rendered image. None if an error occurs.
+            Image | SVG | list[Image | SVG | None] | None: The rendered image. None if an error occurs. A list with one image per picture if `split_pictures` is set.
         """
-        try:
-
-            tex_path = Path().resolve() / f"{self._hex_hash}.tex"
-            tex_path.write_text(self.full_latex, encoding="utf-8")
-
-            tex_command = tex_program
-            if tex_args:
-                tex_command += f" {tex_args}"
-            tex_command += f" {tex_path}"
+        if split_pictures:
+            with _tracing.span("split_pictures", hash=self._hex_hash):
+                return self._run_latex_split(
+                    jobs,
+                    tex_program=tex_program,
+                    tex_args=tex_args,
+                    rasterize=rasterize,
+                    full_err=full_err,
+                    keep_temp=keep_temp,
+                    save_image=save_image,
+                    dpi=dpi,
+                    grayscale=grayscale,
+                    save_tex=save_tex,
+                    save_tikz=save_tikz,
+                    save_pdf=save_pdf,
+                    cache=cache,
+                    max_passes=max_passes,
+                    aux_key=aux_key,
+                    converter=converter,
+                    reuse_saved=reuse_saved,
+                    export_formats=export_formats,
+                )
 
-            res = self._run_command(tex_command, full_err=full_err)
-            if res != 0:
-                self._clearup_latex_garbage(keep_temp)
-                return None
+        image_format = "svg" if not rasterize else "png"
+        converter = _converter_name(converter, image_format)
+        exports = _export_targets(export_formats, save_image, dpi)
+        with _tracing.span(
+            "run_latex",
+            hash=self._hex_hash,
+            engine=tex_program,
+            format=image_format,
+            cache=cache,
+        ), _progress.show(progress):
+            _metrics.start_render(self._hex_hash, tex_program, image_format)
+            # Peak memory, CPU time and I/O of the TeX and converter processes
+            _render_usage.render = self.resource_usage = usage = {}
+            # Each render has its own directory, so concurrent renders of the same
+            # document (e.g., with other options) do not remove each other's files
+            temp_dir = _make_temp_dir()
+            try:
+                tex_path = temp_dir / f"{self._hex_hash}.tex"
+                tex_path.write_text(self.full_latex, encoding="utf-8")
+
+                image_path = tex_path.with_suffix(f".{image_format}")
+
+                render_options = dict(
+                    tex_program=tex_program,
+                    tex_args=tex_args,
+                    rasterize=rasterize,
+                    full_err=full_err,
+                    dpi=dpi,
+                    grayscale=grayscale,
+                    cache=cache,
+                    max_passes=max_passes,
+                    aux_key=aux_key,
+                    converter=converter,
+                )
+                rendered = None
+                # Exports are converted from the PDF, so it must be saved too
+                if reuse_saved and save_tex and (save_pdf or not exports):
+                    rendered = self._reuse_saved(
+                        tex_path,
+                        image_path,
+                        save_tex,
+                        save_image,
+                        save_pdf,
+                        **render_options,
+                    )
+                if rendered is None:
+                    rendered = self._render_remote(
+                        tex_path, image_path, **render_options
+                    )
+                if rendered is None:  # The render daemon is not running
+                    rendered = self._render_local(
+                        tex_path, image_path, **render_options
+                    )
+                if usage:
+                    _metrics.update(resource_usage=usage)
+                _check_budgets(usage)
+                if not rendered:
+                    return None
+
+                from IPython import display
+
+                image = (
+                    display.Image(tex_path.with_suffix(".png"))
+                    if rasterize
+                    else display.SVG(tex_path.with_suffix(".svg"))
+                )
 
-            image_format = "svg" if not rasterize else "png"
+                _metrics.record_output(image_path)
+
+                with _stage("save"):
+                    if save_tex:
+                        self._save(save_tex, "tex", temp_dir)
+                    if save_image:
+                        self._save(save_image, image_format, temp_dir, reuse_saved)
+                    if save_pdf:
+                        self._save(save_pdf, "pdf", temp_dir, reuse_saved)
+                    if save_tikz and self.tikz_code:
+                        self._save(save_tikz, "tikz")
+
+                if exports:
+                    with _stage("export"):
+                        exported = self._export(
+                            tex_path, exports, grayscale, full_err, converter
+                        )
+                    if not exported:
+                        _metrics.fail("export")
+                        return None
+
+                return image
+            except Exception as e:
+                _metrics.fail("exception")
+                raise e
+            finally:
+                with _tracing.span("cleanup"):
+                    self._clearup_latex_garbage(keep_temp, temp_dir)
+                _metrics.finish_render()
+                _render_usage.render = None
+
+    def _render_local(
+        self,
+        tex_path: Path,
+        image_path: Path,
+        tex_program: str,
+        tex_args: str | None,
+        rasterize: bool,
+        full_err: bool,
+        dpi: int,
+        grayscale: bool,
+        cache: bool,
+        max_passes: int,
+        aux_key: str | None,
+        converter: str,
+    ) -> bool:
+        pdf_path = tex_path.with_suffix(".pdf")
+
+        cache_key = image_key = None
+        if cache:
+            cache_key = self._cache_key(tex_program, tex_args)
+            image_key = _image_cache_key(
+                cache_key, image_path.suffix[1:], dpi, grayscale, converter
+            )
+            _metrics.update(pdf_cache="hit", image_cache="hit")  # Until compiled
+
+        stored = False
+        if not (cache_key and _restore_cached(f"{cache_key}.pdf", pdf_path)):
+            with _cache_lock(cache_key):
+                # Another process may have rendered it while waiting for the lock
+                if not (cache_key and _restore_cached(f"{cache_key}.pdf", pdf_path)):
+                    if cache_key:
+                        _metrics.update(pdf_cache="miss")
+                    with _stage("tex"):
+                        res = self._compile(
+                            tex_path,
+                            tex_program,
+                            tex_args,
+                            full_err,
+                            max_passes,
+                            aux_key,
+                        )
+                    if res != 0:
+                        _metrics.fail("tex")
+                        return False
+                    if cache_key:
+                        stored = _store_cached(pdf_path, f"{cache_key}.pdf")
+
+        if not (image_key and _restore_cached(image_key, image_path)):
+            with _cache_lock(image_key):
+                if not (image_key and _restore_cached(image_key, image_path)):
+                    if image_key:
+                        _metrics.update(image_cache="miss")
+                    with _stage("convert"):
+                        res = self._convert(
+                            tex_path, rasterize, dpi, grayscale, full_err, converter
+                        )
+                    if res != 0:
+                        _metrics.fail("convert")
+                        return False
+                    if image_key:
+                        stored = _store_cached(image_path, image_key) or stored
+
+        if stored:
+            _evict_cache()
+        return True
+
+    def _reuse_saved(
+        self,
+        tex_path: Path,
+        image_path: Path,
+        save_tex: str,
+        save_image: str | None,
+        save_pdf: str | None,
+        rasterize: bool,
+        full_err: bool,
+        dpi: int,
+        grayscale: bool,
+        converter: str,
+        **render_options,
+    ) -> bool | None:
+        """Restores the saved outputs to the temporary files. None if they are missing or stale."""
+        _ = render_options
+        wait_for_saves()
+        saved_image = (
+            _dest_path(save_image, image_path.suffix[1:]) if save_image else None
+        )
+        saved_pdf = _dest_path(save_pdf, "pdf") if save_pdf else None
+        saved = [path for path in [saved_image, saved_pdf] if path]
+        if not saved or not _is_saved(
+            _dest_path(save_tex, "tex"), tex_path.read_bytes(), saved, self._hex_hash
+        ):
+            return None
+
+        _metrics.update(renderer="saved")
+        if saved_pdf:
+            shutil.copyfile(saved_pdf, tex_path.with_suffix(".pdf"))
+        if saved_image:
+            shutil.copyfile(saved_image, image_path)
+            return True
+        with _stage("convert"):
+            res = self._convert(
+                tex_path, rasterize, dpi, grayscale, full_err, converter
+            )
+        if res != 0:
+            _metrics.fail("convert")
+        return res == 0
 
-            if os.environ.get("JUPYTER_TIKZ_PDFTOCAIROPATH"):
-                pdftocairo_path = os.environ.get("JUPYTER_TIKZ_PDFTOCAIROPATH")
+    def _export(
+        self,
+        tex_path: Path,
+        exports: list[tuple[str, int, Path]],
+        grayscale: bool,
+        full_err: bool,
+        converter: str,
+    ) -> bool:
+        """Converts the compiled PDF to the `exports` concurrently and saves them."""
+        pdf_path = tex_path.with_suffix(".pdf")
+        usage = getattr(_render_usage, "render", None)
+
+        def export(index: int) -> tuple[int, dict[str, dict[str, float]]]:
+            image_format, dpi, dest_path = exports[index]
+            if image_format == "pdf":
+                _save_bytes(dest_path, pdf_path.read_bytes(), self._hex_hash)
+                return 0, {}
+            # Converters that cannot output the format fall back to the default one
+            if image_format not in _CONVERTERS[converter]["formats"]:
+                export_converter = _DEFAULT_CONVERTER
             else:
-                pdftocairo_path = "pdftocairo"
-
-            pdftocairo_command = f"{pdftocairo_path} -{image_format}"
-            if rasterize:
-                pdftocairo_command += (
-                    f" -singlefile -{'gray' if grayscale else 'transp'} -r {dpi}"
-                )
-
-            pdftocairo_command += f" {tex_path.with_suffix('.pdf')}"
-            pdftocairo_command += (
-                f" {tex_path.with_suffix('.svg')}"
-                if not rasterize
-                else f" {tex_path.parent / tex_path.stem}"
+                export_converter = converter
+            image_path = tex_path.with_name(
+                f"{tex_path.stem}.export-{index}.{image_format}"
             )
-            res = self._run_command(pdftocairo_command, full_err=full_err)
+            # The usage of this thread is merged into the render by the caller
+            _render_usage.render, _render_usage.stage = {}, "export"
+            try:
+                with _tracing.span(
+                    "export file",
+                    format=image_format,
+                    dpi=dpi,
+                    converter=export_converter,
+                ):
+                    res = convert(
+                        export_converter,
+                        pdf_path,
+                        image_path,
+                        dpi,
+                        grayscale,
+                        lambda command: self._run_command(command, full_err=full_err),
+                    )
+                if res == 0:
+                    _save_bytes(dest_path, image_path.read_bytes(), self._hex_hash)
+                return res, _render_usage.render
+            finally:
+                _render_usage.render = _render_usage.stage = None
+
+        # PyMuPDF documents cannot be used from several threads
+        workers = 1 if converter == "pymupdf" else len(exports)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(export, range(len(exports))))
+        for _, export_usage in results:
+            for stage, stage_usage in export_usage.items():
+                if usage is not None:
+                    usage[stage] = _merge_usage(usage.get(stage, {}), stage_usage)
+        return all(res == 0 for res, _ in results)
+
+    def _render_remote(
+        self, tex_path: Path, image_path: Path, **render_options
+    ) -> bool | None:
+        """Renders with the render daemon, if it is running.
 
+        Returns:
+            bool | None: Whether the render succeeded. None if the daemon is not available.
+        """
+        socket_path = _daemon_socket_path()
+        if os.environ.get("JUPYTER_TIKZ_NO_DAEMON") or not socket_path.exists():
+            return None
+        if not _daemon_accepts(
+            render_options["tex_program"], render_options["tex_args"]
+        ):
+            return None
+        request = {
+            "client": os.getpid(),
+            "cwd": os.getcwd(),
+            "latex": self.full_latex,
+            **render_options,
+        }
+        try:
+            with _stage("remote"), socket.socket(
+                socket.AF_UNIX, socket.SOCK_STREAM
+            ) as client:
+                client.settimeout(_DAEMON_CONNECT_TIMEOUT)
+                client.connect(str(socket_path))
+                client.settimeout(_daemon_timeout())
+                _send_message(client, request)
+                response = _recv_message(client)
+        except (OSError, ValueError):  # Stale socket, daemon stopped or hung
+            return None
+        # e.g., a worker process of the daemon was killed
+        if response is None or response.get("retry_locally"):
+            return None
+        _metrics.update(renderer="daemon")
+        render_usage = getattr(_render_usage, "render", None)
+        if render_usage is not None:  # Processes of the daemon worker
+            render_usage.update(response.get("resource_usage") or {})
+        if not response["ok"]:
+            _metrics.fail("remote")
+            print(response["error"], file=sys.stderr)
+            return False
+        tex_path.with_suffix(".pdf").write_bytes(base64.b64decode(response["pdf"]))
+        image_path.write_bytes(base64.b64decode(response["image"]))
+        return True
+
+    def _compile(
+        self,
+        tex_path: Path,
+        tex_program: str,
+        tex_args: str | None,
+        full_err: bool,
+        max_passes: int = 1,
+        aux_key: str | None = None,
+    ) -> int:
+        aux_path = tex_path.with_suffix(".aux")
+        stable_aux_path = _stable_aux_path(aux_key) if aux_key else None
+        if stable_aux_path:
+            _copy_aux(stable_aux_path, aux_path)
+
+        for passes in range(1, max(max_passes, 1) + 1):
+            previous_aux = _read_aux(aux_path)
+            _progress.update(tex_pass=passes, log_path=tex_path.with_suffix(".log"))
+            res = self._compile_pass(tex_path, tex_program, tex_args, full_err)
+            _metrics.update(tex_passes=passes)
             if res != 0:
-                self._clearup_latex_garbage(keep_temp)
-                return None
+                return res
+            if not _needs_rerun(tex_path.with_suffix(".log"), previous_aux, aux_path):
+                break
+
+        if stable_aux_path:
+            stable_aux_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            stored = stable_aux_path.exists()
+            _copy_aux(aux_path, stable_aux_path)
+            if not stored and stable_aux_path.exists():
+                _evict_cache()
+        return res
+
+    def _compile_pass(
+        self,
+        tex_path: Path,
+        tex_program: str,
+        tex_args: str | None,
+        full_err: bool,
+    ) -> int:
+        fallback_key = self._cache_key(tex_program, tex_args)
+        program, env = _load_fallback(fallback_key, tex_program) or (tex_program, {})
+
+        _metrics.update(engine=program)
+        _progress.update(engine=program)
+        res = self._run_tex(tex_path, program, tex_args, full_err, env)
+        if res == 0 or not _capacity_exceeded(tex_path.with_suffix(".log")):
+            return res
+
+        for program, env in _capacity_fallbacks(tex_program):
+            print(
+                f"TeX capacity exceeded. Retrying with {_describe_fallback(program, env)}.",
+                file=sys.stderr,
+            )
+            _metrics.update(engine=program)
+            _progress.update(engine=program)
+            res = self._run_tex(tex_path, program, tex_args, full_err, env)
+            if res == 0:
+                # Remember the choice, so the failing attempt is not repeated
+                _store_fallback(fallback_key, (program, env))
+                return res
+            if not _capacity_exceeded(tex_path.with_suffix(".log")):
+                return res
+        return res
+
+    def _convert(
+        self,
+        tex_path: Path,
+        rasterize: bool,
+        dpi: int,
+        grayscale: bool,
+        full_err: bool,
+        converter: str = _DEFAULT_CONVERTER,
+    ) -> int:
+        image_format = "svg" if not rasterize else "png"
+        return convert(
+            converter,
+            tex_path.with_suffix(".pdf"),
+            tex_path.with_suffix(f".{image_format}"),
+            dpi,
+            grayscale,
+            lambda command: self._run_command(command, full_err=full_err),
+        )
 
-            image = (
-                display.Image(tex_path.with_suffix(".png"))
-                if rasterize
-                else display.SVG(tex_path.with_suffix(".svg"))
+    def _cache_key(self, tex_program: str, tex_args: str | None) -> str:
+        # Cosmetic edits (comments, indentation) keep the key
+        key = "\0".join(
+            [_canonical_latex(self.full_latex), tex_program, tex_args or ""]
+        )
+        return md5(key.encode()).hexdigest()
+
+    def _run_tex(
+        self,
+        tex_path: Path,
+        tex_program: str,
+        tex_args: str | None,
+        full_err: bool,
+        env: dict[str, str] | None = None,
+    ) -> int:
+        # User arguments come last, so they override the defaults
+        tex_command = f"{tex_program} {_DEFAULT_TEX_ARGS}"
+        if tex_args:
+            tex_command += f" {tex_args}"
+        # TeX runs in the working directory, so included files are found as usual
+        tex_command += f" -output-directory={tex_path.parent} {tex_path}"
+
+        # Environment variables override texmf.cnf settings for this run only
+        kwargs = {"env": {**os.environ, **env}} if env else {}
+        with _tracing.span("tex pass", engine=tex_program, env=env or None):
+            return self._run_command(
+                tex_command,
+                full_err=full_err,
+                log_path=tex_path.with_suffix(".log"),
+                **kwargs,
             )
 
-            if save_image:
-                self._save(save_image, image_format)
-            if save_tex:
-                self._save(save_tex, "tex")
-            if save_pdf:
-                self._save(save_pdf, "pdf")
-            if save_tikz and self.tikz_code:
-                self._save(save_tikz, "tikz")
+    def _run_latex_split(
+        self, jobs: int | None = None, **kwargs
+    ) -> list[Image | SVG | None]:
+        pictures = self.split_tikzpictures() or [self]
 
-            self._clearup_latex_garbage(keep_temp)
+        def run(index: int) -> Image | SVG | None:
+            picture_kwargs = {
+                key: _indexed_dest(value, index) if key.startswith("save_") else value
+                for key, value in kwargs.items()
+            }
+            if kwargs.get("aux_key"):
+                picture_kwargs["aux_key"] = f"{kwargs['aux_key']}-{index}"
+            return pictures[index - 1].run_latex(**picture_kwargs)
 
-            return image
-        except Exception as e:
-            raise e
-        finally:
-            self._clearup_latex_garbage(keep_temp)
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            return list(executor.map(run, range(1, len(pictures) + 1)))
 
     def _render_jinja(self, ns) -> None:
+        if not any(delimiter in self._code for delimiter in _JINJA_DELIMITERS):
+            return  # Not a template, so Jinja is not even imported
+
+        import jinja2
+
         fs_loader = jinja2.FileSystemLoader(os.getcwd())
 
         tmpl_env = jinja2.Environment(
@@ -256,6 +836,8 @@ class TexDocument:
             comment_start_string="(~",  # Normal is '{#'.
             comment_end_string="~)",  # Normal is '#}'.
         )
+        tmpl_env.filters.update(_JINJA_FILTERS)
+        tmpl_env.globals.update(_JINJA_GLOBALS)
 
         tmpl = tmpl_env.from_string(self._code)
 
@@ -325,6 +907,38 @@ class TexFragment(TexDocument):
 
         super().__init__(code, **kwargs)
 
+    @staticmethod
+    def plot_expression(
+        expression: str,
+        domain: str | tuple[float, float] = "-5:5",
+        samples: int = 25,
+        variable: str = "x",
+        precision: int = 4,
+        file: str | None = None,
+    ) -> str:
+        r"""Evaluates a pgfplots expression with NumPy, so TeX only draws the points.
+
+        pgfmath evaluates `\addplot {x^2 - sin(deg(x))};` in TeX, which is slow for many samples. Instead, insert the result in the code: `\addplot <result>;`. As in pgfmath, trigonometric functions use degrees.
+
+        Args:
+            expression: The pgfmath expression of `variable`, e.g., `x^2 - sin(deg(x))`.
+            domain: The domain, as `"<min>:<max>"` or a tuple.
+            samples: The number of points.
+            variable: The name of the variable.
+            precision: Number of decimal places.
+            file: Write the points to this file and return `table {<file>}`.
+
+        Returns:
+            str: The pgfplots `coordinates {...}`, or `table {<file>}` with `file`.
+
+        Raises:
+            ValueError: If the expression uses syntax or functions that are not supported.
+        """
+        points = _evaluate_expression(expression, domain, samples, variable)
+        if file:
+            return _table_filter(points, precision=precision, file=file)
+        return _coordinates_filter(points, precision=precision)
+
     def _build_standalone_preamble(
         self,
         tex_packages: str | None = None,
@@ -385,6 +999,764 @@ class TexFragment(TexDocument):
         )
 
 
+def _cache_dir() -> Path:
+    if os.environ.get("JUPYTER_TIKZ_CACHEDIR"):
+        return Path(os.environ["JUPYTER_TIKZ_CACHEDIR"])
+    return _user_cache_dir()
+
+
+def _user_cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "jupyter-tikz"
+
+
+def _cache_modes() -> tuple[int, int]:
+    if os.environ.get("JUPYTER_TIKZ_CACHEDIR"):
+        return _SHARED_CACHE_MODES
+    return _PRIVATE_CACHE_MODES
+
+
+def _make_cache_dir(path: Path) -> None:
+    if path.is_dir():
+        return  # Permissions of existing directories are left to their owner
+    path.mkdir(parents=True, exist_ok=True)
+    try:
+        os.chmod(path, _cache_modes()[0])
+    except OSError:  # pragma: no cover
+        pass
+
+
+# Resource usage of the processes of the current render, per stage
+_render_usage = threading.local()
+
+
+@contextmanager
+def _stage(name: str):
+    # Render stages are both measured and traced
+    previous = getattr(_render_usage, "stage", None)
+    _render_usage.stage = name
+    _progress.update(stage=name)
+    try:
+        with _metrics.stage(name), _tracing.span(name):
+            yield
+    finally:
+        _render_usage.stage = previous
+
+
+# Scope whose processes can be cancelled, for the render of the current thread
+_cancel_scope = threading.local()
+
+
+class _CancelScope:
+    """Terminates the processes run in its block when `cancel` is called from another thread.
+
+    Used to stop renders that became obsolete, e.g., by `interact_tikz`. Processes started after `cancel` are terminated at once, so the render fails quickly.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        # Whether a process was terminated, so the result of the render is not valid
+        self.terminated = False
+        self._processes: set[subprocess.Popen] = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> _CancelScope:
+        self._previous = getattr(_cancel_scope, "scope", None)
+        _cancel_scope.scope = self
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        _cancel_scope.scope = self._previous
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            for process in self._processes:
+                self._terminate(process)
+
+    def _register(self, process: subprocess.Popen) -> None:
+        with self._lock:
+            if self.cancelled:
+                self._terminate(process)
+            else:
+                self._processes.add(process)
+
+    def _unregister(self, process: subprocess.Popen) -> None:
+        with self._lock:
+            self._processes.discard(process)
+
+    def _terminate(self, process: subprocess.Popen) -> None:
+        self.terminated = True
+        try:
+            if os.name == "posix":
+                # The shell and TeX, which runs in its own process group
+                os.killpg(process.pid, signal.SIGTERM)
+            else:  # pragma: no cover
+                process.terminate()
+        except OSError:  # Already exited
+            pass
+
+
+class _OutputTail:
+    """Keeps the last `size` bytes of a stream, which is read in chunks as it is written."""
+
+    def __init__(self, size: int = _OUTPUT_TAIL_SIZE):
+        self.size = size
+        self._chunks: deque[bytes] = deque()
+        self._length = 0
+
+    def read_from(self, stream) -> None:
+        for chunk in iter(lambda: stream.read1(_OUTPUT_CHUNK_SIZE), b""):
+            self._chunks.append(chunk)
+            self._length += len(chunk)
+            while self._length - len(self._chunks[0]) >= self.size:
+                self._length -= len(self._chunks.popleft())
+
+    def text(self) -> str:
+        # Only the tail is decoded, and a character cut at its start is replaced
+        return b"".join(self._chunks)[-self.size :].decode("utf-8", errors="replace")
+
+
+def _run_process(command: str, **kwargs) -> subprocess.CompletedProcess:
+    """Runs a shell command as `subprocess.run`, with the resource usage of the process in `resource_usage`.
+
+    Only the last `_OUTPUT_TAIL_SIZE` bytes of `stdout` and `stderr` are kept, e.g., for error messages.
+    """
+    stdout, stderr = _OutputTail(), _OutputTail()
+    scope: _CancelScope | None = getattr(_cancel_scope, "scope", None)
+    if scope is not None and os.name == "posix":
+        kwargs["start_new_session"] = True  # So the whole group can be terminated
+    with subprocess.Popen(
+        command,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **kwargs,
+    ) as process:
+        if scope is not None:
+            scope._register(process)
+        # Both pipes are drained, so a process filling one of them does not block
+        reader = threading.Thread(target=stderr.read_from, args=(process.stderr,))
+        reader.start()
+        stdout.read_from(process.stdout)
+        reader.join()
+        if scope is not None:
+            # Before reaping, so a reused pid is never signaled
+            scope._unregister(process)
+        usage = None
+        if hasattr(os, "wait4"):
+            # Reaps the process, with the usage of its descendants (e.g., `sh -c`)
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            usage = _usage_dict(rusage)
+        else:  # pragma: no cover
+            process.wait()
+    result = subprocess.CompletedProcess(
+        command, process.returncode, stdout.text(), stderr.text()
+    )
+    result.resource_usage = usage
+    return result
+
+
+def _usage_dict(rusage) -> dict[str, float]:
+    # `ru_maxrss` is in KB, except on macOS
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    return {
+        "processes": 1,
+        "user_time": rusage.ru_utime,
+        "system_time": rusage.ru_stime,
+        "max_rss": rusage.ru_maxrss * rss_unit,
+        "read_blocks": rusage.ru_inblock,
+        "write_blocks": rusage.ru_oublock,
+    }
+
+
+def _merge_usage(total: dict[str, float], usage: dict[str, float]) -> dict[str, float]:
+    return {
+        key: (max if key == "max_rss" else sum)((total.get(key, 0), value))
+        for key, value in usage.items()
+    }
+
+
+def _record_usage(usage: dict[str, float] | None) -> None:
+    render = getattr(_render_usage, "render", None)
+    if usage is None or render is None:
+        return
+    stage = getattr(_render_usage, "stage", None) or "other"
+    render[stage] = _merge_usage(render.get(stage, {}), usage)
+
+
+def _check_budgets(usage: dict[str, dict[str, float]]) -> None:
+    """Warns when a render exceeds `JUPYTER_TIKZ_MEMORY_BUDGET` (MB) or `JUPYTER_TIKZ_CPU_BUDGET` (s)."""
+    if not usage:
+        return
+    memory_budget = os.environ.get("JUPYTER_TIKZ_MEMORY_BUDGET")
+    max_rss = max(stage["max_rss"] for stage in usage.values())
+    if memory_budget and max_rss > float(memory_budget) * 1024**2:
+        print(
+            f"The render used {max_rss / 1024**2:.0f} MB of memory, "
+            f"over the budget of {memory_budget} MB (`JUPYTER_TIKZ_MEMORY_BUDGET`).",
+            file=sys.stderr,
+        )
+    cpu_budget = os.environ.get("JUPYTER_TIKZ_CPU_BUDGET")
+    cpu_time = sum(
+        stage["user_time"] + stage["system_time"] for stage in usage.values()
+    )
+    if cpu_budget and cpu_time > float(cpu_budget):
+        print(
+            f"The render used {cpu_time:.1f} s of CPU time, "
+            f"over the budget of {cpu_budget} s (`JUPYTER_TIKZ_CPU_BUDGET`).",
+            file=sys.stderr,
+        )
+
+
+@contextmanager
+def _cache_lock(cache_key: str | None):
+    """Serializes the renders of the same cache entry across processes sharing the cache."""
+    if cache_key is None or fcntl is None:
+        yield
+        return
+    lock_dir = _cache_dir() / "locks"
+    try:
+        _make_cache_dir(lock_dir)
+        # A fixed set of lock files, never removed, so eviction cannot race with locking
+        lock_fd = os.open(
+            lock_dir / f"{cache_key[:2]}.lock",
+            os.O_RDONLY | os.O_CREAT,
+            _cache_modes()[1],
+        )
+    except OSError:  # e.g., a lock file created by another user with a strict umask
+        lock_fd = None
+    if lock_fd is None:
+        yield  # Renders are still correct, only not serialized
+        return
+    try:
+        # The mode given to `os.open` is masked by the umask
+        os.fchmod(lock_fd, _cache_modes()[1])
+    except OSError:  # Created by another user
+        pass
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(lock_fd)  # Releases the lock
+
+
+def _daemon_socket_path() -> Path:
+    if os.environ.get("JUPYTER_TIKZ_DAEMON_SOCKET"):
+        return Path(os.environ["JUPYTER_TIKZ_DAEMON_SOCKET"])
+    return _cache_dir() / "daemon.sock"
+
+
+def _daemon_timeout() -> float:
+    return float(
+        os.environ.get("JUPYTER_TIKZ_DAEMON_TIMEOUT") or _DEFAULT_DAEMON_TIMEOUT
+    )
+
+
+def _daemon_accepts(tex_program: str, tex_args: str | None) -> bool:
+    """Whether the render daemon runs this TeX program with these arguments."""
+    if tex_program not in _DAEMON_TEX_PROGRAMS:
+        return False
+    return all(
+        _DAEMON_TEX_ARG_PATTERN.fullmatch(arg) for arg in (tex_args or "").split()
+    )
+
+
+def _send_message(sock: socket.socket, message: dict) -> None:
+    data = json.dumps(message).encode()
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+
+def _recv_message(sock: socket.socket) -> dict | None:
+    def recv_exactly(size: int) -> bytes | None:
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:  # Connection closed
+                return None
+            data += chunk
+        return data
+
+    header = recv_exactly(4)
+    if header is None:
+        return None
+    data = recv_exactly(struct.unpack("!I", header)[0])
+    return None if data is None else json.loads(data)
+
+
+def _canonical_latex(latex: str) -> str:
+    """Returns the LaTeX code without comments and with collapsed whitespace, outside verbatim contexts.
+
+    Used for cache keys only, so re-indenting the code or editing comments hits the cache.
+    """
+    chunks, end = [], 0
+    for match in _VERBATIM_PATTERN.finditer(latex):
+        chunks += [_collapse_whitespace(latex[end : match.start()]), match.group(0)]
+        end = match.end()
+    chunks.append(_collapse_whitespace(latex[end:]))
+    return "".join(chunks).strip()
+
+
+def _collapse_whitespace(latex: str) -> str:
+    latex = _TEX_COMMENT_PATTERN.sub(r"\1", latex)
+    # As in TeX, a line break is a space and blank lines are a single paragraph break
+    paragraphs = [
+        re.sub(r"\s+", " ", paragraph)
+        for paragraph in _PARAGRAPH_BREAK_PATTERN.split(latex)
+    ]
+    # Spaces after control words are skipped, so `\draw[...]` is `\draw [...]`
+    return "\n\n".join(
+        _CONTROL_WORD_PATTERN.sub(r"\1 ", paragraph) for paragraph in paragraphs
+    )
+
+
+def _image_cache_key(
+    cache_key: str,
+    image_format: str,
+    dpi: int,
+    grayscale: bool,
+    converter: str = _DEFAULT_CONVERTER,
+) -> str:
+    # Images of other converters differ, keys of the default one are unchanged
+    if converter != _DEFAULT_CONVERTER:
+        cache_key = f"{cache_key}.{converter}"
+    if image_format == "svg":
+        return f"{cache_key}.svg"
+    return f"{cache_key}.{dpi}dpi-{'gray' if grayscale else 'transp'}.{image_format}"
+
+
+def _restore_cached(name: str, dest: Path) -> bool:
+    cached_path = _cache_dir() / name
+    try:
+        shutil.copyfile(cached_path, dest)
+    except OSError:  # Not cached, evicted meanwhile or not readable
+        return False
+    try:
+        os.utime(cached_path)  # Most recently used
+    except OSError:  # pragma: no cover
+        pass  # Shared entry owned by another user, or evicted meanwhile
+    return True
+
+
+def _store_cached(src: Path, name: str) -> bool:
+    """Publishes a cache entry atomically, so readers never see a partial file."""
+    cache_dir = _cache_dir()
+    try:
+        _make_cache_dir(cache_dir)
+        fd, temp_path = tempfile.mkstemp(
+            dir=cache_dir, prefix=f".{name}.", suffix=".tmp"
+        )
+    except OSError as e:
+        print(f"Could not write to the render cache: {e}", file=sys.stderr)
+        return False
+    try:
+        with os.fdopen(fd, "wb") as temp_file, open(src, "rb") as src_file:
+            shutil.copyfileobj(src_file, temp_file)
+        os.chmod(temp_path, _cache_modes()[1])
+        os.replace(temp_path, cache_dir / name)
+    except OSError as e:
+        Path(temp_path).unlink(missing_ok=True)
+        print(f"Could not write to the render cache: {e}", file=sys.stderr)
+        return False
+    return True
+
+
+def _evict_cache(max_size: int | None = None) -> None:
+    """Removes the least recently used entries until the cache fits in `max_size` MB.
+
+    The records of saved files, the fallbacks and the `.aux` files are entries too.
+    """
+    if max_size is None:
+        max_size = int(os.environ.get("JUPYTER_TIKZ_CACHESIZE", _DEFAULT_CACHE_SIZE))
+    entries = []
+    now = time.time()
+    cache_dirs = [
+        _cache_dir(),
+        _cache_dir() / "saved",
+        _cache_dir() / "fallbacks",
+        _user_cache_dir() / "aux",
+    ]
+    for cache_dir in cache_dirs:
+        try:
+            it = os.scandir(cache_dir)
+        except OSError:  # Nothing stored yet
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if not entry.is_file():
+                        continue  # e.g., the locks directory
+                    stat = entry.stat()
+                except FileNotFoundError:  # Removed by another process
+                    continue
+                if entry.name.startswith("."):  # Written by another process
+                    if now - stat.st_mtime > _STALE_TEMP_AGE:
+                        Path(entry.path).unlink(missing_ok=True)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    size = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, path in sorted(entries):
+        if size <= max_size * 1024 * 1024:
+            break
+        try:
+            Path(path).unlink(missing_ok=True)
+        except PermissionError:  # pragma: no cover
+            continue
+        size -= entry_size
+
+
+def _read_log(log_path: Path, full: bool = False) -> str:
+    """Reads the TeX log, or only its tail, where TeX stops at the first error."""
+    try:
+        with open(log_path, "rb") as log_file:
+            if not full:
+                log_file.seek(max(log_path.stat().st_size - _LOG_TAIL_SIZE, 0))
+            log = log_file.read()
+    except OSError:
+        return ""
+    return log.decode("utf-8", errors="replace")
+
+
+def _tex_error(log_path: Path, full_err: bool = False) -> str:
+    log = _read_log(log_path, full_err)
+    if full_err:
+        return log
+    lines = log.splitlines()
+    match = _TEX_ERROR_PATTERN.search(log)
+    error_line = log.count("\n", 0, match.start()) if match else len(lines)
+    # 20 lines from the first error, or the last 20 lines if it is close to the end
+    start = min(error_line, max(len(lines) - 20, 0))
+    return "\n".join(lines[start : start + 20])
+
+
+def _make_temp_dir() -> Path:
+    """Returns a new private directory for the temporary files of a render."""
+    return Path(tempfile.mkdtemp(prefix="jupyter-tikz-"))
+
+
+def _stable_aux_path(aux_key: str) -> Path:
+    # Private, even with a shared cache: users of the same notebook have the same cell ids
+    return _user_cache_dir() / "aux" / f"{md5(aux_key.encode()).hexdigest()}.aux"
+
+
+def _copy_aux(src: Path, dest: Path) -> None:
+    temp_path = dest.with_name(
+        f".{dest.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    try:
+        shutil.copyfile(src, temp_path)
+        os.replace(temp_path, dest)  # Concurrent renders never read a partial file
+    except OSError:  # Not written yet, or not writable
+        pass
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def _read_aux(aux_path: Path) -> list[str]:
+    try:
+        lines = aux_path.read_text(encoding="utf-8", errors="replace").splitlines()
+    except OSError:
+        return []
+    return [line for line in lines if not _TRIVIAL_AUX_PATTERN.match(line.strip())]
+
+
+def _needs_rerun(log_path: Path, previous_aux: list[str], aux_path: Path) -> bool:
+    """Whether another TeX pass is needed, as in `latexmk`: the log asks for it or the `.aux` file changed."""
+    if _RERUN_PATTERN.search(_read_log(log_path)):
+        return True
+    return _read_aux(aux_path) != previous_aux
+
+
+def _capacity_exceeded(log_path: Path) -> bool:
+    return _CAPACITY_EXCEEDED_MSG in _read_log(log_path)
+
+
+def _capacity_fallbacks(tex_program: str) -> list[tuple[str, dict[str, str]]]:
+    if Path(tex_program).stem == _DYNAMIC_MEMORY_TEX_PROGRAM:
+        return []
+    return [(tex_program, _ENLARGED_TEX_MEMORY), (_DYNAMIC_MEMORY_TEX_PROGRAM, {})]
+
+
+def _fallback_path(fallback_key: str) -> Path:
+    return _cache_dir() / "fallbacks" / f"{fallback_key}.json"
+
+
+def _load_fallback(
+    fallback_key: str, tex_program: str
+) -> tuple[str, dict[str, str]] | None:
+    """Returns the fallback that compiled the document, in this process or a previous one."""
+    if fallback_key in _TEX_FALLBACKS:
+        return _TEX_FALLBACKS[fallback_key]
+    try:
+        stored = json.loads(_fallback_path(fallback_key).read_text(encoding="utf-8"))
+        fallback = (stored["program"], stored["env"])
+    except (OSError, ValueError, KeyError, TypeError):  # Not stored
+        return None
+    # Only the fallbacks of this program: a shared cache is writable by other users
+    if fallback not in _capacity_fallbacks(tex_program):
+        return None
+    _TEX_FALLBACKS[fallback_key] = fallback
+    return fallback
+
+
+def _store_fallback(fallback_key: str, fallback: tuple[str, dict[str, str]]) -> None:
+    _TEX_FALLBACKS[fallback_key] = fallback
+    fallback_path = _fallback_path(fallback_key)
+    temp_path = fallback_path.with_name(
+        f".{fallback_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    try:
+        _make_cache_dir(fallback_path.parent)
+        program, env = fallback
+        temp_path.write_text(
+            json.dumps({"program": program, "env": env}), encoding="utf-8"
+        )
+        os.chmod(temp_path, _cache_modes()[1])
+        os.replace(temp_path, fallback_path)
+    except OSError:  # Remembered by this process only
+        pass
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def _describe_fallback(tex_program: str, env: dict[str, str]) -> str:
+    if env:
+        settings = ", ".join(f"{key}={value}" for key, value in env.items())
+        return f"`{tex_program}` and enlarged memory ({settings})"
+    return f"`{tex_program}` (dynamic memory allocation)"
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError as e:  # pragma: no cover
+        raise ImportError(
+            "NumPy is required to use the `coordinates`, `table` and `evaluate` filters. "
+            "Install it with `pip install jupyter-tikz[numpy]`."
+        ) from e
+    return numpy
+
+
+def _as_columns(data, y=None):
+    """Returns `data` (and `y`) as a 2D float array with one row per point."""
+    np = _import_numpy()
+
+    if y is not None:
+        x = np.asarray(data, dtype=float).ravel()
+        return np.column_stack([x, np.asarray(y, dtype=float).ravel()])
+
+    values = np.asarray(data, dtype=float)
+    if values.ndim == 1:
+        # pandas Series are plotted against their index
+        index = getattr(data, "index", None)
+        x = np.arange(len(values)) if index is None else np.asarray(index, float)
+        return np.column_stack([x, values])
+    return values
+
+
+def _decimate_indices(x, y, max_points: int, method: str = "lttb"):
+    """Returns the indices of at most `max_points` points that preserve the visual shape of `(x, y)`."""
+    np = _import_numpy()
+    n_points = len(x)
+    if max_points >= n_points:
+        return np.arange(n_points)
+    if max_points < 3:
+        raise ValueError("`max_points` must be at least 3.")
+
+    if method == "minmax":
+        # First and last points plus the minimum and maximum of each bucket
+        buckets = np.array_split(np.arange(1, n_points - 1), (max_points - 2) // 2)
+        indices = [0]
+        for bucket in buckets:
+            if len(bucket):
+                extremes = (bucket[np.argmin(y[bucket])], bucket[np.argmax(y[bucket])])
+                indices.extend(sorted(set(extremes)))
+        indices.append(n_points - 1)
+        return np.asarray(indices)
+
+    if method == "lttb":
+        # Largest-Triangle-Three-Buckets, Steinarsson (2013)
+        edges = np.linspace(1, n_points - 1, max_points - 1).astype(int)
+        indices = np.zeros(max_points, dtype=int)
+        for i in range(max_points - 2):
+            start, end = edges[i], edges[i + 1]
+            next_end = edges[i + 2] if i + 2 < len(edges) else n_points
+            avg_x = x[end:next_end].mean()
+            avg_y = y[end:next_end].mean()
+            a = indices[i]
+            areas = np.abs(
+                (x[a] - avg_x) * (y[start:end] - y[a])
+                - (x[a] - x[start:end]) * (avg_y - y[a])
+            )
+            indices[i + 1] = start + np.argmax(areas)
+        indices[-1] = n_points - 1
+        return indices
+
+    raise ValueError(
+        f"`{method}` is not a valid decimation method. Valid methods are `lttb` or `minmax`."
+    )
+
+
+def _plot_values(data, y=None, max_points: int | None = None, method: str = "lttb"):
+    values = _as_columns(data, y)
+    if max_points:
+        x, y = values[:, 0], values[:, 1]
+        values = values[_decimate_indices(x, y, max_points, method)]
+    return values
+
+
+def _coordinates_filter(
+    data,
+    y=None,
+    precision: int = 4,
+    max_points: int | None = None,
+    method: str = "lttb",
+) -> str:
+    r"""Jinja filter that formats NumPy arrays or pandas columns as pgfplots `coordinates {...}`.
+
+    Example:
+        `\addplot (* data | coordinates(max_points=500) *);` or `\addplot (* x | coordinates(y) *);`
+    """
+    values = _plot_values(data, y, max_points, method)[:, :2]
+    point = f"(%.{precision}f,%.{precision}f)"
+    return (
+        "coordinates {" + " ".join([point % (a, b) for a, b in values.tolist()]) + "}"
+    )
+
+
+def _table_filter(
+    data,
+    y=None,
+    precision: int = 4,
+    max_points: int | None = None,
+    method: str = "lttb",
+    file: str | None = None,
+) -> str:
+    r"""Jinja filter that formats NumPy arrays or pandas columns as a pgfplots inline `table {...}`.
+
+    With `file`, the rows are written to that file instead, relative to the working directory, and `table {<file>}` is returned.
+
+    Example:
+        `\addplot (* df[["t", "x"]] | table(precision=2) *);`
+    """
+    values = _plot_values(data, y, max_points, method)
+    row = " ".join([f"%.{precision}f"] * values.shape[1])
+    rows = "".join([row % tuple(r) + "\n" for r in values.tolist()])
+    if file:
+        file_path = Path(file)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_text(rows, encoding="utf-8")
+        return f"table {{{file_path.as_posix()}}}"
+    return "table {\n" + rows + "}"
+
+
+def _pgfmath_functions() -> dict[str, Any]:
+    """NumPy versions of the pgfmath functions. As in pgfmath, angles are in degrees."""
+    np = _import_numpy()
+    return {
+        "sin": lambda a: np.sin(np.radians(a)),
+        "cos": lambda a: np.cos(np.radians(a)),
+        "tan": lambda a: np.tan(np.radians(a)),
+        "sec": lambda a: 1 / np.cos(np.radians(a)),
+        "cosec": lambda a: 1 / np.sin(np.radians(a)),
+        "cot": lambda a: 1 / np.tan(np.radians(a)),
+        "asin": lambda x: np.degrees(np.arcsin(x)),
+        "acos": lambda x: np.degrees(np.arccos(x)),
+        "atan": lambda x: np.degrees(np.arctan(x)),
+        "atan2": lambda y, x: np.degrees(np.arctan2(y, x)),
+        "sinh": np.sinh,
+        "cosh": np.cosh,
+        "tanh": np.tanh,
+        "deg": np.degrees,
+        "rad": np.radians,
+        "exp": np.exp,
+        "ln": np.log,
+        "log10": np.log10,
+        "log2": np.log2,
+        "sqrt": np.sqrt,
+        "abs": np.abs,
+        "sign": np.sign,
+        "pow": np.power,
+        "mod": np.fmod,  # Truncated, as in pgfmath
+        "min": np.minimum,
+        "max": np.maximum,
+        "floor": np.floor,
+        "ceil": np.ceil,
+        "round": np.round,
+        "int": np.trunc,
+        "frac": lambda x: x - np.trunc(x),
+        "veclen": np.hypot,
+        "pi": np.pi,
+        "e": np.e,
+    }
+
+
+_PGFMATH_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Compare,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.operator,
+    ast.unaryop,
+    ast.cmpop,
+)
+
+
+def _evaluate_expression(
+    expression: str,
+    domain: str | tuple[float, float] = "-5:5",
+    samples: int = 25,
+    variable: str = "x",
+):
+    r"""Evaluates a pgfmath expression (e.g., `x^2 - sin(deg(x))`) with NumPy over `samples` points of `domain`.
+
+    Returns:
+        numpy.ndarray: The points, one `(x, y)` row per sample.
+
+    Raises:
+        ValueError: If the expression uses syntax or functions that are not supported.
+    """
+    np = _import_numpy()
+    if isinstance(domain, str):
+        domain = tuple(float(bound) for bound in domain.split(":"))
+    # pgfplots expressions may use `\x`, and `^` is the power operator
+    code = expression.replace(f"\\{variable}", variable).replace("^", "**")
+    try:
+        tree = ast.parse(code.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"`{expression}` is not a valid expression.") from e
+
+    names = {**_pgfmath_functions(), variable: np.linspace(*domain, samples)}
+    for node in ast.walk(tree):
+        if not isinstance(node, _PGFMATH_NODES) or (
+            isinstance(node, ast.Constant) and not isinstance(node.value, (int, float))
+        ):
+            raise ValueError(f"`{expression}` is not a valid expression.")
+        if isinstance(node, ast.Name) and node.id not in names:
+            raise ValueError(f"`{node.id}` is not supported in `{expression}`.")
+
+    with np.errstate(all="ignore"):  # Poles give `inf` or `nan`, as gaps in the plot
+        y = eval(compile(tree, "<expression>", "eval"), {"__builtins__": {}}, names)
+    x = names[variable]
+    return np.column_stack([x, np.broadcast_to(np.asarray(y, dtype=float), x.shape)])
+
+
+_JINJA_FILTERS = {
+    "coordinates": _coordinates_filter,
+    "table": _table_filter,
+    "evaluate": _evaluate_expression,
+}
+_JINJA_GLOBALS = {
+    "evaluate": _evaluate_expression,
+}
+
+
 _ARGS = {
     "input-type": {
         "short-arg": "as",
@@ -490,6 +1862,29 @@ _ARGS = {
         "type": bool,
         "desc": "Set grayscale to the rasterized image",
     },
+    "animate": {
+        "short-arg": "an",
+        "dest": "animate",
+        "type": str,
+        "default": None,
+        "desc": "Render the Jinja template once per value of this IPython variable, as the frames of an animation",
+        "example": "`-an=t`",
+    },
+    "fps": {
+        "short-arg": "fps",
+        "dest": "fps",
+        "type": float,
+        "default": 10,
+        "desc": "Frames per second of the animation",
+    },
+    "animation-format": {
+        "short-arg": "af",
+        "dest": "animation_format",
+        "type": str,
+        "default": "apng",
+        "desc": "Format of the animation. Possible values are: `apng`, `gif` (requires Pillow) and `frames` (one image per frame)",
+        "example": "`-af=gif`",
+    },
     "full-err": {
         "short-arg": "e",
         "dest": "full_err",
@@ -515,15 +1910,77 @@ _ARGS = {
         "dest": "tex_args",
         "type": str,
         "default": None,
-        "desc": "Arguments to pass to the TeX program",
+        "desc": "Arguments to pass to the TeX program, after the defaults `-interaction=batchmode -halt-on-error -file-line-error`",
         "example": '`-ta "$tex_args_ipython_variable"`',
     },
+    "max-passes": {
+        "short-arg": "mp",
+        "dest": "max_passes",
+        "type": int,
+        "default": _DEFAULT_MAX_PASSES,
+        "desc": "Maximum number of TeX passes. TeX is run again only when references or the `.aux` file changed",
+        "example": "`-mp=1`",
+    },
+    "converter": {
+        "short-arg": "cv",
+        "dest": "converter",
+        "type": str,
+        "default": None,
+        "desc": "Backend converting the PDF to the image: `pdftocairo`, `pdftoppm` (PNG only), `dvisvgm` (SVG only) or `pymupdf` (in-process). Defaults to `JUPYTER_TIKZ_CONVERTER` or `pdftocairo`",
+        "example": "`-cv=pymupdf`",
+    },
+    "split-pictures": {
+        "short-arg": "spl",
+        "dest": "split_pictures",
+        "type": bool,
+        "desc": "Render each `tikzpicture` of the document as a separate image, compiling them concurrently",
+    },
+    "jobs": {
+        "short-arg": "j",
+        "dest": "jobs",
+        "type": int,
+        "default": None,
+        "desc": "Maximum number of concurrent compilations. Defaults to the number of CPUs",
+        "example": "`-j=4`",
+    },
+    "cache": {
+        "short-arg": "c",
+        "dest": "cache",
+        "type": bool,
+        "desc": "Reuse the output from the render cache if the same LaTeX code was already rendered with the same options",
+    },
     "no-compile": {
         "short-arg": "nc",
         "dest": "no_compile",
         "type": bool,
         "desc": "Do not compile the TeX code",
     },
+    "export-formats": {
+        "short-arg": "ex",
+        "dest": "export_formats",
+        "type": str,
+        "default": None,
+        "desc": "Also save the figure in these formats, converted concurrently from the same PDF. Files are named after `-S`",
+        "example": "`-S=fig -ex=pdf,svg,png@300` saves `fig.pdf`, `fig.svg` and `fig-300dpi.png`",
+    },
+    "draft": {
+        "short-arg": "dr",
+        "dest": "draft",
+        "type": bool,
+        "desc": "Render a quick preview, with fewer plot samples, flat shading and a low DPI. Files are not saved",
+    },
+    "refine": {
+        "short-arg": "rf",
+        "dest": "refine",
+        "type": bool,
+        "desc": "Render a draft preview, then replace it with the full-quality figure rendered in the background",
+    },
+    "reuse-saved": {
+        "short-arg": "rs",
+        "dest": "reuse_saved",
+        "type": bool,
+        "desc": "Display the saved image without compiling if the `-st` file holds the same LaTeX code and the `-S` (or `-sp`) file was saved from it",
+    },
     "save-tikz": {  # New
         "short-arg": "s",
         "dest": "save_tikz",
@@ -593,173 +2050,236 @@ def _get_arg_params(arg: str) -> tuple[tuple[str, str], dict[str, Any]]:
     return args, kwargs
 
 
-def _apply_args():
-    def decorator(magic_command):
-        for arg in reversed(_ARGS.keys()):
-            args, kwargs = _get_arg_params(arg)
-            magic_command = argument(*args, **kwargs)(magic_command)
-        return magic_command
+def _get_input_type(input_type: str) -> str | None:
+    VALID_INPUT_TYPES = ["full-document", "standalone-document", "tikzpicture"]
+    input_type = input_type.lower()
+    input_type_len = len(input_type)
 
-    return decorator
+    for index, valid_input_type in enumerate(VALID_INPUT_TYPES):
+        if input_type == valid_input_type[:input_type_len]:
+            return VALID_INPUT_TYPES[index]
 
+    return None
 
-def _remove_wrapping_quotes(text):
-    # Define the regex pattern to match a string wrapped with quotation marks
-    pattern = re.compile(r'^"(.*)"$', re.DOTALL)
 
-    # Use re.sub to replace the matched pattern with the content inside the quotation marks
-    return pattern.sub(r"\1", text)
+def _dest_path(dest: str, ext: str) -> Path:
+    dest_path = Path(dest)
 
+    if os.environ.get("JUPYTER_TIKZ_SAVEDIR"):
+        dest_path = str(os.environ.get("JUPYTER_TIKZ_SAVEDIR")) / dest_path
 
-@magics_class
-class TikZMagics(Magics):
-    def _get_input_type(self, input_type: str) -> str | None:
-        VALID_INPUT_TYPES = ["full-document", "standalone-document", "tikzpicture"]
-        input_type = input_type.lower()
-        input_type_len = len(input_type)
+    dest_path = dest_path.resolve()
 
-        for index, valid_input_type in enumerate(VALID_INPUT_TYPES):
-            if input_type == valid_input_type[:input_type_len]:
-                return VALID_INPUT_TYPES[index]
+    if dest_path.suffix != f".{ext}":
+        dest_path = dest_path.with_suffix(dest_path.suffix + f".{ext}")
 
-        return None
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    return dest_path
 
-    # Path to the pdftocairo executable
-    @line_cell_magic
-    @magic_arguments()
-    @_apply_args()
-    @argument("code", nargs="?", help="the variable in IPython with the Tex/TikZ code")
-    @needs_local_scope
-    def tikz(self, line, cell: str | None = None, local_ns=None) -> Image | SVG | None:
-        r"""
-        Renders a TikZ diagram in a Jupyter notebook cell. This function can be used as both a line magic (%tikz) and a cell magic (%%tikz).
-
-        When used as cell magic, it executes the TeX/TikZ code within the cell:
-            Example:
-                In [3]: %%tikz
-                   ...:  \begin{tikzpicture}
-                   ...:     \draw (0,0) rectangle (1,1);
-                   ...: \end{tikzpicture}
-
-        When used as line magic, the TeX/TikZ code is passed as an IPython string variable:
-            Example:
-                In [4]: %tikz "$ipython_string_variable_with_code"
-
-        Additional options can be passed to the magic command to customize LaTeX code and rendering output:
-            Example:
-                In [5]: %%tikz -l=arrows,matrix
-                   ...: \matrix (m) [matrix of math nodes, row sep=3em, column sep=4em] {
-                   ...:     A & B \\
-                   ...:     C & D \\
-                   ...: };
-                   ...: \path[-stealth, line width=.4mm]
-                   ...:     (m-1-1) edge node [left ] {$ac$} (m-2-1)
-                   ...:     (m-1-1) edge node [above] {$ab$} (m-1-2)
-                   ...:     (m-1-2) edge node [right] {$bd$} (m-2-2)
-                   ...:     (m-2-1) edge node [below] {$cd$} (m-2-2);
-        """
 
-        self.args: dict = vars(parse_argstring(self.tikz, line))
+# Writes of saved files, when they are made in the background
+_save_executor: ThreadPoolExecutor | None = None
+_save_executor_lock = threading.Lock()
+_manifest_lock = threading.Lock()
 
-        for key, value in self.args.items():
-            if not (isinstance(value, str)):
-                continue
-            self.args[key] = _remove_wrapping_quotes(value)
 
-        if self.args["latex_preamble"] and (
-            self.args["tex_packages"]
-            or self.args["tikz_libraries"]
-            or self.args["pgfplots_libraries"]
-        ):
-            print(_EXTRAS_CONFLITS_ERR, file=sys.stderr)
-            return
+def _save_bytes(
+    dest_path: Path, data: bytes, source_hash: str, record: bool = False
+) -> None:
+    """Saves `data` to `dest_path`, in a background thread if `JUPYTER_TIKZ_ASYNC_SAVE` is set.
 
-        if (self.args["implicit_pic"] and self.args["full_document"]) or (
-            (self.args["implicit_pic"] or self.args["full_document"])
-            and self.args["input_type"] != "standalone-document"
-        ):
-            print(
-                _INPUT_TYPE_CONFLIT_ERR,
-                file=sys.stderr,
-            )
-            return
-        if self.args["print_jinja"] and self.args["print_tex"]:
-            print(
-                _PRINT_CONFLICT_ERR,
-                file=sys.stderr,
-            )
-            return
+    With `record`, its source is recorded for `reuse_saved`.
+    """
+    if not os.environ.get("JUPYTER_TIKZ_ASYNC_SAVE"):
+        _write_saved(dest_path, data, source_hash, record)
+        return
+    global _save_executor
+    with _save_executor_lock:
+        if _save_executor is None:
+            # A single thread, so saves to the same file are written in order
+            _save_executor = ThreadPoolExecutor(max_workers=1)
+        future = _save_executor.submit(
+            _write_saved, dest_path, data, source_hash, record
+        )
+    future.add_done_callback(_report_save_error)
 
-        if self.args["implicit_pic"]:
-            self.input_type = "tikzpicture"
-        elif self.args["full_document"]:
-            self.input_type = "full-document"
-        else:
-            self.input_type = self._get_input_type(self.args["input_type"])
-        if self.input_type is None:
-            print(
-                f'`{self.args["input_type"]}` is not a valid input type.',
-                "Valid input types are `full-document`, `standalone-document`, or `tikzpicture`.",
-                file=sys.stderr,
-            )
-            return
 
-        self.src = cell or ""
-        local_ns = local_ns or {}
+def _report_save_error(future) -> None:
+    if future.exception() is not None:
+        print(f"Saving failed: {future.exception()}", file=sys.stderr)
 
-        if cell is None:
-            if self.args["code"] is None:
-                print('Use "%tikz?" for help', file=sys.stderr)
-                return
 
-            if self.args["code"] not in local_ns:
-                self.src: str = self.args["code"]
-            else:
-                self.src: str = local_ns[self.args["code"]]
+def wait_for_saves() -> None:
+    """Waits until the files saved in the background (`JUPYTER_TIKZ_ASYNC_SAVE`) are written."""
+    with _save_executor_lock:
+        executor = _save_executor
+    if executor is not None:
+        executor.submit(lambda: None).result()
+
 
-        if self.input_type == "full-document":
-            self.tex_obj = TexDocument(
-                self.src, no_jinja=self.args["no_jinja"], ns=local_ns
+def _write_saved(
+    dest_path: Path, data: bytes, source_hash: str, record: bool = False
+) -> None:
+    # Unchanged files are not rewritten, so their mtime does not trigger rebuilds
+    if not (
+        dest_path.is_file()
+        and dest_path.stat().st_size == len(data)
+        and dest_path.read_bytes() == data
+    ):
+        temp_path = dest_path.with_name(
+            f".{dest_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        try:
+            temp_path.write_bytes(data)
+            os.replace(temp_path, dest_path)  # Readers never see a partial file
+        finally:
+            temp_path.unlink(missing_ok=True)
+    content_hash = md5(data).hexdigest()
+    if record:
+        _record_saved(dest_path, source_hash, content_hash)
+    _update_manifest(dest_path, source_hash, content_hash)
+
+
+def _saved_record_path(dest_path: Path) -> Path:
+    return _cache_dir() / "saved" / f"{md5(str(dest_path).encode()).hexdigest()}.json"
+
+
+def _record_saved(dest_path: Path, source_hash: str, content_hash: str) -> None:
+    """Records the source of a saved file in the cache directory, for `reuse_saved`."""
+    record_path = _saved_record_path(dest_path)
+    record = {"path": str(dest_path), "source": source_hash, "md5": content_hash}
+    try:
+        if json.loads(record_path.read_text(encoding="utf-8")) == record:
+            return
+        recorded = True
+    except (OSError, ValueError):  # Not recorded yet
+        recorded = record_path.exists()
+    temp_path = record_path.with_name(
+        f".{record_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    try:
+        _make_cache_dir(record_path.parent)
+        temp_path.write_text(json.dumps(record), encoding="utf-8")
+        os.chmod(temp_path, _cache_modes()[1])
+        os.replace(temp_path, record_path)
+    except OSError:  # The file is then compiled again by `reuse_saved`
+        return
+    finally:
+        temp_path.unlink(missing_ok=True)
+    if not recorded:
+        _evict_cache()
+
+
+def _update_manifest(dest_path: Path, source_hash: str, content_hash: str) -> None:
+    """Records the source of each saved file in `JUPYTER_TIKZ_MANIFEST`, if it is set."""
+    if not os.environ.get("JUPYTER_TIKZ_MANIFEST"):
+        return
+    manifest_path = Path(os.environ["JUPYTER_TIKZ_MANIFEST"]).resolve()
+    try:
+        key = os.path.relpath(dest_path, manifest_path.parent)
+    except ValueError:  # Windows: another drive
+        key = str(dest_path)
+    entry = {"source": source_hash, "md5": content_hash}
+
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    lock_path = manifest_path.with_name(f".{manifest_path.name}.lock")
+    with _manifest_lock, open(lock_path, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+        if manifest.get(key) == entry:
+            return
+        manifest[key] = entry
+        temp_path = manifest_path.with_name(f".{manifest_path.name}.{os.getpid()}.tmp")
+        temp_path.write_text(
+            json.dumps(manifest, indent=2, sort_keys=True) + "\n", encoding="utf-8"
+        )
+        os.replace(temp_path, manifest_path)
+
+
+def _is_saved(
+    saved_tex: Path, latex: bytes, outputs: list[Path], source_hash: str
+) -> bool:
+    """Whether `saved_tex` holds `latex` and all `outputs` were saved from `source_hash`, unmodified since.
+
+    The contents are compared, not the mtimes: unchanged files are not rewritten.
+    """
+    try:
+        if saved_tex.stat().st_size != len(latex) or saved_tex.read_bytes() != latex:
+            return False
+        for output in outputs:
+            record = json.loads(_saved_record_path(output).read_text(encoding="utf-8"))
+            if (
+                record.get("source") != source_hash
+                or record.get("md5") != md5(output.read_bytes()).hexdigest()
+            ):
+                return False
+        return True
+    except (OSError, ValueError):  # Not saved or not recorded yet
+        return False
+
+
+def _export_targets(
+    export_formats: str | list[str] | None, save_image: str | None, dpi: int
+) -> list[tuple[str, int, Path]]:
+    """Parses the export formats, returning their format, DPI and destination.
+
+    Raises:
+        ValueError: If a format is not valid or `save_image` is not given.
+    """
+    if isinstance(export_formats, str):
+        export_formats = export_formats.split(",")
+    export_formats = [spec.strip() for spec in export_formats or [] if spec.strip()]
+    if not export_formats:
+        return []
+    if not save_image:
+        raise ValueError("Exporting needs `save_image` (`-S`) to name the files.")
+
+    base = Path(save_image)
+    if base.suffix in [".pdf", ".svg", ".png"]:
+        base = base.with_suffix("")
+    targets = []
+    for spec in export_formats:
+        image_format, _, export_dpi = spec.lower().partition("@")
+        if image_format not in ["pdf", "svg", "png"] or (
+            export_dpi and (image_format != "png" or not export_dpi.isdigit())
+        ):
+            raise ValueError(
+                f"`{spec}` is not a valid export format. "
+                "Valid formats are: pdf, svg, png and png@<dpi>."
             )
+        if export_dpi:
+            dest = base.with_name(f"{base.name}-{int(export_dpi)}dpi")
         else:
-            implicit_tikzpicture = self.input_type == "tikzpicture"
-            self.tex_obj = TexFragment(
-                self.src,
-                implicit_tikzpicture=implicit_tikzpicture,
-                preamble=self.args["latex_preamble"],
-                tex_packages=self.args["tex_packages"],
-                no_tikz=self.args["no_tikz"],
-                tikz_libraries=self.args["tikz_libraries"],
-                pgfplots_libraries=self.args["pgfplots_libraries"],
-                scale=self.args["scale"],
-                no_jinja=self.args["no_jinja"],
-                ns=local_ns,
-            )
+            dest = base
+        targets.append(
+            (image_format, int(export_dpi or dpi), _dest_path(str(dest), image_format))
+        )
+    return targets
+
+
+def _indexed_dest(dest: str | None, index: int) -> str | None:
+    if not dest:
+        return dest
+    dest_path = Path(dest)
+    return str(dest_path.with_name(f"{dest_path.stem}-{index}{dest_path.suffix}"))
+
+
+def _remove_wrapping_quotes(text):
+    # Define the regex pattern to match a string wrapped with quotation marks
+    pattern = re.compile(r'^"(.*)"$', re.DOTALL)
+
+    # Use re.sub to replace the matched pattern with the content inside the quotation marks
+    return pattern.sub(r"\1", text)
 
-        if self.args["print_jinja"]:
-            print(self.tex_obj)
-        if self.args["print_tex"]:
-            print(self.tex_obj.full_latex)
-
-        image = None
-        if not self.args["no_compile"]:
-            image = self.tex_obj.run_latex(
-                tex_program=self.args["tex_program"],
-                tex_args=self.args["tex_args"],
-                rasterize=self.args["rasterize"],
-                full_err=self.args["full_err"],
-                keep_temp=self.args["keep_temp"],
-                save_tikz=self.args["save_tikz"],
-                save_tex=self.args["save_tex"],
-                save_pdf=self.args["save_pdf"],
-                save_image=self.args["save_image"],
-                dpi=self.args["dpi"],
-                grayscale=self.args["gray"],
-            )
-            if image is None:
-                return None
 
-        if self.args["save_var"]:
-            local_ns[self.args["save_var"]] = str(self.tex_obj)
+def __getattr__(name: str) -> Any:
+    # The magic lives in `magics.py`, so IPython is only imported when it is used
+    if name == "TikZMagics":
+        from .magics import TikZMagics
 
-        return image
+        return TikZMagics
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,394 @@
+"""IPython magic for rendering TeX/TikZ outputs, loaded with `%load_ext jupyter_tikz`."""
+
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from IPython import display
+from IPython.core.magic import (
+    Magics,
+    line_cell_magic,
+    line_magic,
+    magics_class,
+    needs_local_scope,
+)
+from IPython.core.magic_arguments import argument, magic_arguments, parse_argstring
+from IPython.display import SVG, Image
+
+from . import tracing as _tracing
+from .animation import _ANIMATION_FORMATS, render_animation
+from .converters import _converter_name
+from .jupyter_tikz import (
+    _ARGS,
+    _DRAFT_DPI,
+    _EXTRAS_CONFLITS_ERR,
+    _INPUT_TYPE_CONFLIT_ERR,
+    _PRINT_CONFLICT_ERR,
+    TexDocument,
+    TexFragment,
+    _export_targets,
+    _get_arg_params,
+    _get_input_type,
+    _remove_wrapping_quotes,
+)
+from .warmup import _format_report, start_warmup, warmup
+
+# Full-quality renders of drafts (`--refine`), one at a time
+_refine_executor: ThreadPoolExecutor | None = None
+_refine_lock = threading.Lock()
+# The latest refine of each cell, so the refines of previous runs are skipped
+_latest_refines: dict[str, object] = {}
+
+
+def _submit_refine(key: str, tex_obj: TexDocument, run_kwargs: dict, handles) -> None:
+    global _refine_executor
+    token = object()
+    with _refine_lock:
+        _latest_refines[key] = token
+        if _refine_executor is None:
+            _refine_executor = ThreadPoolExecutor(max_workers=1)
+        _refine_executor.submit(_refine, key, token, tex_obj, run_kwargs, handles)
+
+
+def _refine(key: str, token: object, tex_obj: TexDocument, run_kwargs, handles) -> None:
+    if _latest_refines.get(key) is not token:
+        return  # The cell was run again
+    images = tex_obj.run_latex(**run_kwargs)
+    if images is None:
+        return  # The error is printed, the draft is kept
+    if not isinstance(images, list):
+        images = [images]
+    for handle, image in zip(handles, images):
+        if handle is not None and image is not None:
+            handle.update(image)
+
+
+def _wait_for_refines() -> None:
+    with _refine_lock:
+        executor = _refine_executor
+    if executor is not None:
+        executor.submit(lambda: None).result()
+
+
+def _apply_args(arg_names: list[str] | None = None):
+    def decorator(magic_command):
+        for arg in reversed(arg_names or list(_ARGS.keys())):
+            args, kwargs = _get_arg_params(arg)
+            magic_command = argument(*args, **kwargs)(magic_command)
+        return magic_command
+
+    return decorator
+
+
+@magics_class
+class TikZMagics(Magics):
+    def _get_input_type(self, input_type: str) -> str | None:
+        return _get_input_type(input_type)
+
+    def _build_tex(self, ns: dict) -> TexDocument:
+        if self.input_type == "full-document":
+            return TexDocument(self.src, no_jinja=self.args["no_jinja"], ns=ns)
+        return TexFragment(
+            self.src,
+            implicit_tikzpicture=self.input_type == "tikzpicture",
+            preamble=self.args["latex_preamble"],
+            tex_packages=self.args["tex_packages"],
+            no_tikz=self.args["no_tikz"],
+            tikz_libraries=self.args["tikz_libraries"],
+            pgfplots_libraries=self.args["pgfplots_libraries"],
+            scale=self.args["scale"],
+            no_jinja=self.args["no_jinja"],
+            ns=ns,
+        )
+
+    def _cell_id(self) -> str | None:
+        """Returns the id of the running notebook cell, if the frontend sends it."""
+        kernel = getattr(self.shell, "kernel", None)
+        if kernel is None:
+            return None
+        try:
+            parent = kernel.get_parent()
+        except AttributeError:  # ipykernel < 6
+            parent = getattr(kernel, "_parent_header", {})
+        return (parent or {}).get("metadata", {}).get("cellId")
+
+    def _render_draft(self, run_kwargs: dict) -> Image | SVG | list | None:
+        """Renders a draft of the figure, refined in the background with `--refine`."""
+        draft_kwargs = {
+            **run_kwargs,
+            "dpi": min(run_kwargs["dpi"], _DRAFT_DPI),
+            "aux_key": None,  # Keeps the `.aux` file of the final figure
+            "reuse_saved": False,
+            "export_formats": None,
+        }
+        for key in ["save_tikz", "save_tex", "save_pdf", "save_image"]:
+            draft_kwargs[key] = None
+        images = self.tex_obj.draft().run_latex(**draft_kwargs)
+        if images is None or not self.args["refine"]:
+            return images
+
+        if not isinstance(images, list):
+            images = [images]
+        handles = [
+            display.display(image, display_id=True) if image is not None else None
+            for image in images
+        ]
+        _submit_refine(
+            self._cell_id() or self.tex_obj._hex_hash,
+            self.tex_obj,
+            {**run_kwargs, "progress": False},  # The cell has finished
+            handles,
+        )
+        return []  # Already displayed
+
+    # Path to the pdftocairo executable
+    @line_cell_magic
+    @magic_arguments()
+    @_apply_args()
+    @argument("code", nargs="?", help="the variable in IPython with the Tex/TikZ code")
+    @needs_local_scope
+    def tikz(self, line, cell: str | None = None, local_ns=None) -> Image | SVG | None:
+        r"""
+        Renders a TikZ diagram in a Jupyter notebook cell. This function can be used as both a line magic (%tikz) and a cell magic (%%tikz).
+
+        When used as cell magic, it executes the TeX/TikZ code within the cell:
+            Example:
+                In [3]: %%tikz
+                   ...:  \begin{tikzpicture}
+                   ...:     \draw (0,0) rectangle (1,1);
+                   ...: \end{tikzpicture}
+
+        When used as line magic, the TeX/TikZ code is passed as an IPython string variable:
+            Example:
+                In [4]: %tikz "$ipython_string_variable_with_code"
+
+        Additional options can be passed to the magic command to customize LaTeX code and rendering output:
+            Example:
+                In [5]: %%tikz -l=arrows,matrix
+                   ...: \matrix (m) [matrix of math nodes, row sep=3em, column sep=4em] {
+                   ...:     A & B \\
+                   ...:     C & D \\
+                   ...: };
+                   ...: \path[-stealth, line width=.4mm]
+                   ...:     (m-1-1) edge node [left ] {$ac$} (m-2-1)
+                   ...:     (m-1-1) edge node [above] {$ab$} (m-1-2)
+                   ...:     (m-1-2) edge node [right] {$bd$} (m-2-2)
+                   ...:     (m-2-1) edge node [below] {$cd$} (m-2-2);
+        """
+        name = "%tikz" if cell is None else "%%tikz"
+        with _tracing.span(name, cell_id=self._cell_id()):
+            return self._tikz(line, cell, local_ns)
+
+    def _tikz(self, line, cell: str | None, local_ns) -> Image | SVG | None:
+        with _tracing.span("parse"):
+            self.args: dict = vars(parse_argstring(self.tikz, line))
+
+            for key, value in self.args.items():
+                if not (isinstance(value, str)):
+                    continue
+                self.args[key] = _remove_wrapping_quotes(value)
+
+        if self.args["latex_preamble"] and (
+            self.args["tex_packages"]
+            or self.args["tikz_libraries"]
+            or self.args["pgfplots_libraries"]
+        ):
+            print(_EXTRAS_CONFLITS_ERR, file=sys.stderr)
+            return
+
+        if (self.args["implicit_pic"] and self.args["full_document"]) or (
+            (self.args["implicit_pic"] or self.args["full_document"])
+            and self.args["input_type"] != "standalone-document"
+        ):
+            print(
+                _INPUT_TYPE_CONFLIT_ERR,
+                file=sys.stderr,
+            )
+            return
+        if self.args["print_jinja"] and self.args["print_tex"]:
+            print(
+                _PRINT_CONFLICT_ERR,
+                file=sys.stderr,
+            )
+            return
+
+        if self.args["implicit_pic"]:
+            self.input_type = "tikzpicture"
+        elif self.args["full_document"]:
+            self.input_type = "full-document"
+        else:
+            self.input_type = self._get_input_type(self.args["input_type"])
+        if self.input_type is None:
+            print(
+                f'`{self.args["input_type"]}` is not a valid input type.',
+                "Valid input types are `full-document`, `standalone-document`, or `tikzpicture`.",
+                file=sys.stderr,
+            )
+            return
+
+        self.src = cell or ""
+        local_ns = local_ns or {}
+
+        if cell is None:
+            if self.args["code"] is None:
+                print('Use "%tikz?" for help', file=sys.stderr)
+                return
+
+            if self.args["code"] not in local_ns:
+                self.src: str = self.args["code"]
+            else:
+                self.src: str = local_ns[self.args["code"]]
+
+        frames = None
+        if self.args["animate"]:
+            if self.args["animation_format"] not in _ANIMATION_FORMATS:
+                print(
+                    f'`{self.args["animation_format"]}` is not a valid animation format.',
+                    f"Valid formats are: {', '.join(_ANIMATION_FORMATS)}.",
+                    file=sys.stderr,
+                )
+                return None
+            if self.args["animate"] not in local_ns:
+                print(f'`{self.args["animate"]}` is not defined.', file=sys.stderr)
+                return None
+            # The variable holds the values, each frame sees one of them
+            frames = [
+                self._build_tex({**local_ns, self.args["animate"]: value})
+                for value in local_ns[self.args["animate"]]
+            ]
+            if not frames:
+                print(f'`{self.args["animate"]}` is empty.', file=sys.stderr)
+                return None
+            self.tex_obj = frames[0]
+        else:
+            self.tex_obj = self._build_tex(local_ns)
+
+        if self.args["print_jinja"]:
+            print(self.tex_obj)
+        if self.args["print_tex"]:
+            print(self.tex_obj.full_latex)
+
+        image = None
+        if not self.args["no_compile"] and frames is not None:
+            image = render_animation(
+                frames,
+                fps=self.args["fps"],
+                animation_format=self.args["animation_format"],
+                tex_program=self.args["tex_program"],
+                tex_args=self.args["tex_args"],
+                full_err=self.args["full_err"],
+                keep_temp=self.args["keep_temp"],
+                save_image=self.args["save_image"],
+                dpi=self.args["dpi"],
+                grayscale=self.args["gray"],
+                cache=self.args["cache"],
+                max_passes=self.args["max_passes"],
+            )
+            if image is None:
+                return None
+            if isinstance(image, list):
+                display.display(*image)
+                image = None
+        elif not self.args["no_compile"]:
+            try:
+                image_format = "png" if self.args["rasterize"] else "svg"
+                _converter_name(self.args["converter"], image_format)
+                _export_targets(
+                    self.args["export_formats"],
+                    self.args["save_image"],
+                    self.args["dpi"],
+                )
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                return None
+            run_kwargs = dict(
+                tex_program=self.args["tex_program"],
+                tex_args=self.args["tex_args"],
+                rasterize=self.args["rasterize"],
+                full_err=self.args["full_err"],
+                keep_temp=self.args["keep_temp"],
+                save_tikz=self.args["save_tikz"],
+                save_tex=self.args["save_tex"],
+                save_pdf=self.args["save_pdf"],
+                save_image=self.args["save_image"],
+                dpi=self.args["dpi"],
+                grayscale=self.args["gray"],
+                split_pictures=self.args["split_pictures"],
+                jobs=self.args["jobs"],
+                cache=self.args["cache"],
+                max_passes=self.args["max_passes"],
+                aux_key=self._cell_id(),
+                converter=self.args["converter"],
+                reuse_saved=self.args["reuse_saved"],
+                export_formats=self.args["export_formats"],
+                progress=True,
+            )
+            if self.args["draft"] or self.args["refine"]:
+                image = self._render_draft(run_kwargs)
+            else:
+                image = self.tex_obj.run_latex(**run_kwargs)
+            if image is None:
+                return None
+            if isinstance(image, list):
+                images = [img for img in image if img is not None]
+                if images:
+                    display.display(*images)
+                image = None
+
+        if self.args["save_var"]:
+            local_ns[self.args["save_var"]] = str(self.tex_obj)
+
+        return image
+
+    @line_magic
+    @magic_arguments()
+    @_apply_args(
+        [
+            "latex-preamble",
+            "tex-packages",
+            "tikz-libraries",
+            "pgfplots-libraries",
+            "rasterize",
+            "tex-program",
+            "converter",
+        ]
+    )
+    @argument(
+        "-b",
+        "--background",
+        action="store_true",
+        help="Warm up in a background thread, without reporting the timings.",
+    )
+    def tikz_warmup(self, line) -> None:
+        r"""
+        Primes the caches of the TeX toolchain, so the first figure does not pay for them. It renders a small figure with each TeX program (comma-separated in `-tp`) and the given preamble, and reports the time of each step.
+            Example:
+                In [1]: %tikz_warmup -tp=pdflatex,lualatex -t=pgfplots
+        """
+        args = vars(parse_argstring(self.tikz_warmup, line))
+        for key, value in args.items():
+            if isinstance(value, str):
+                args[key] = _remove_wrapping_quotes(value)
+        if args["latex_preamble"] and (
+            args["tex_packages"] or args["tikz_libraries"] or args["pgfplots_libraries"]
+        ):
+            print(_EXTRAS_CONFLITS_ERR, file=sys.stderr)
+            return
+        kwargs = dict(
+            tex_programs=args["tex_program"],
+            preamble=args["latex_preamble"],
+            tex_packages=args["tex_packages"],
+            tikz_libraries=args["tikz_libraries"],
+            pgfplots_libraries=args["pgfplots_libraries"],
+            rasterize=args["rasterize"],
+            converter=args["converter"],
+        )
+        try:
+            _converter_name(args["converter"], "png" if args["rasterize"] else "svg")
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return
+        if args["background"]:
+            start_warmup(**kwargs)
+            return
+        print(_format_report(warmup(**kwargs)))
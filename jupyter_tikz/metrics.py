@@ -0,0 +1,247 @@
+"""Render metrics, enabled by setting `JUPYTER_TIKZ_METRICS` to a file path.
+
+Paths ending with `.prom` are written in the Prometheus text format, e.g., for the textfile collector of the node exporter. The file holds counters and histograms of all the processes writing to it. Other paths get one JSON line per render.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+_DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # s
+_SIZE_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000)  # bytes
+_MEMORY_BUCKETS = tuple(2**power * 1024**2 for power in range(4, 13))  # 16 MB to 4 GB
+_FAMILIES = {
+    "jupyter_tikz_renders_total": ("counter", "Renders by engine, format and status."),
+    "jupyter_tikz_render_failures_total": ("counter", "Failed renders by stage."),
+    "jupyter_tikz_cache_total": (
+        "counter",
+        "Render cache lookups by entry and result.",
+    ),
+    "jupyter_tikz_render_duration_seconds": ("histogram", "Duration of renders."),
+    "jupyter_tikz_stage_duration_seconds": ("histogram", "Duration of render stages."),
+    "jupyter_tikz_output_bytes": ("histogram", "Size of the rendered images."),
+    "jupyter_tikz_process_cpu_seconds_total": (
+        "counter",
+        "CPU time of the TeX and converter processes by stage.",
+    ),
+    "jupyter_tikz_process_max_rss_bytes": (
+        "histogram",
+        "Peak memory of the TeX and converter processes of each render by stage.",
+    ),
+}
+
+# The render of the current thread, None if metrics are disabled
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def _metrics_path() -> str | None:
+    return os.environ.get("JUPYTER_TIKZ_METRICS")
+
+
+def _record() -> dict[str, Any] | None:
+    return getattr(_local, "record", None)
+
+
+def start_render(document_hash: str, engine: str, image_format: str) -> None:
+    if not _metrics_path():
+        return
+    _local.record = {
+        "time": time.time(),
+        "pid": os.getpid(),
+        "hash": document_hash,
+        "engine": engine,
+        "format": image_format,
+        "renderer": "local",
+        "stages": {},
+        "_start": time.perf_counter(),
+    }
+
+
+def update(**fields) -> None:
+    record = _record()
+    if record is not None:
+        record.update(fields)
+
+
+def record_output(path: Path) -> None:
+    record = _record()
+    if record is not None and path.exists():
+        record["output_bytes"] = path.stat().st_size
+
+
+def fail(stage: str) -> None:
+    """Records the stage where the render failed, unless it was already recorded."""
+    record = _record()
+    if record is not None:
+        record.setdefault("failed_stage", stage)
+
+
+@contextmanager
+def stage(name: str):
+    record = _record()
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record["stages"][name] = (
+            record["stages"].get(name, 0) + time.perf_counter() - start
+        )
+
+
+def finish_render() -> None:
+    record = _record()
+    if record is None:
+        return
+    _local.record = None
+    record["duration"] = time.perf_counter() - record.pop("_start")
+    record["status"] = "failed" if record.get("failed_stage") else "ok"
+    path = _metrics_path()
+    try:
+        if path.endswith(".prom"):
+            _write_prometheus(Path(path), record)
+        else:
+            _write_json_line(Path(path), record)
+    except OSError:  # pragma: no cover
+        pass  # Metrics never fail a render
+
+
+def _write_json_line(path: Path, record: dict[str, Any]) -> None:
+    line = json.dumps(record) + "\n"
+    # Appends of a single line are atomic, so processes can share the file
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def _labels(**labels: Any) -> str:
+    def escape(value: Any) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+    return ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+
+
+def _increments(record: dict[str, Any]) -> dict[str, float]:
+    increments: dict[str, float] = {}
+
+    def add(name: str, labels: str, value: float = 1) -> None:
+        key = f"{name}{{{labels}}}" if labels else name
+        increments[key] = increments.get(key, 0) + value
+
+    def observe(name: str, labels: str, value: float, buckets) -> None:
+        for bucket in (*buckets, "+Inf"):
+            if bucket == "+Inf" or value <= bucket:
+                le = _labels(le=bucket)
+                add(f"{name}_bucket", f"{labels},{le}" if labels else le)
+        add(f"{name}_sum", labels, value)
+        add(f"{name}_count", labels)
+
+    add(
+        "jupyter_tikz_renders_total",
+        _labels(
+            engine=record["engine"],
+            format=record["format"],
+            renderer=record["renderer"],
+            status=record["status"],
+        ),
+    )
+    if record.get("failed_stage"):
+        add("jupyter_tikz_render_failures_total", _labels(stage=record["failed_stage"]))
+    for entry in ["pdf", "image"]:
+        if record.get(f"{entry}_cache"):
+            add(
+                "jupyter_tikz_cache_total",
+                _labels(entry=entry, result=record[f"{entry}_cache"]),
+            )
+    observe(
+        "jupyter_tikz_render_duration_seconds",
+        _labels(renderer=record["renderer"]),
+        record["duration"],
+        _DURATION_BUCKETS,
+    )
+    for stage_name, duration in record["stages"].items():
+        observe(
+            "jupyter_tikz_stage_duration_seconds",
+            _labels(stage=stage_name),
+            duration,
+            _DURATION_BUCKETS,
+        )
+    for stage_name, usage in record.get("resource_usage", {}).items():
+        add(
+            "jupyter_tikz_process_cpu_seconds_total",
+            _labels(stage=stage_name),
+            usage["user_time"] + usage["system_time"],
+        )
+        observe(
+            "jupyter_tikz_process_max_rss_bytes",
+            _labels(stage=stage_name),
+            usage["max_rss"],
+            _MEMORY_BUCKETS,
+        )
+    if record.get("output_bytes") is not None:
+        observe(
+            "jupyter_tikz_output_bytes",
+            _labels(format=record["format"]),
+            record["output_bytes"],
+            _SIZE_BUCKETS,
+        )
+    return increments
+
+
+def _read_samples(path: Path) -> dict[str, float]:
+    samples: dict[str, float] = {}
+    try:
+        text = path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return samples
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            key, value = line.rsplit(" ", 1)
+            samples[key] = float(value)
+    return samples
+
+
+def _format_samples(samples: dict[str, float]) -> str:
+    lines = []
+    for family, (metric_type, help_text) in _FAMILIES.items():
+        names = [family]
+        if metric_type == "histogram":
+            names = [f"{family}_bucket", f"{family}_sum", f"{family}_count"]
+        family_samples = [
+            (key, value) for key, value in samples.items() if key.split("{")[0] in names
+        ]
+        if not family_samples:
+            continue
+        lines += [f"# HELP {family} {help_text}", f"# TYPE {family} {metric_type}"]
+        lines += [f"{key} {float(value)!r}" for key, value in family_samples]
+    return "\n".join(lines) + "\n"
+
+
+def _write_prometheus(path: Path, record: dict[str, Any]) -> None:
+    # Counters of all processes are added up in the same file
+    with _write_lock, open(path.with_name(f".{path.name}.lock"), "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        samples = _read_samples(path)
+        for key, value in _increments(record).items():
+            samples[key] = samples.get(key, 0) + value
+        # The collector may read the file at any time, so it is replaced atomically
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        temp_path.write_text(_format_samples(samples), encoding="utf-8")
+        os.replace(temp_path, path)
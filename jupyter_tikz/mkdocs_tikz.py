@@ -0,0 +1,240 @@
+"""MkDocs macros pluglet that renders fenced TikZ blocks at build time.
+
+Add it to the `macros` plugin in `mkdocs.yml`:
+
+```yaml
+plugins:
+  - macros:
+      modules: [jupyter_tikz.mkdocs_tikz]
+```
+
+Then write TikZ code in fenced blocks with the `tikz` language, optionally followed by the magic options:
+
+````markdown
+```tikz -l=calc -sc=2
+\\draw (0,0) circle (1);
+```
+````
+"""
+
+import logging
+import os
+import posixpath
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from IPython.core.error import UsageError
+from IPython.core.magic_arguments import parse_argstring
+
+from .converters import _converter_name
+from .jupyter_tikz import (
+    TexDocument,
+    TexFragment,
+    _get_input_type,
+    _image_cache_key,
+    _remove_wrapping_quotes,
+)
+from .magics import TikZMagics
+
+_DEFAULT_TIKZ_DIR = "assets/tikz"
+_DEFAULT_ALT = "TikZ figure"
+_TIKZ_BLOCK_PATTERN = re.compile(
+    r"^(?P<indent>[ \t]*)(?P<fence>`{3,}|~{3,})tikz(?:[ \t]+(?P<options>[^\n]*))?\n"
+    r"(?P<code>.*?)^(?P=indent)(?P=fence)[ \t]*$",
+    re.MULTILINE | re.DOTALL,
+)
+
+logger = logging.getLogger("mkdocs.plugins.jupyter_tikz")
+
+
+class _Figure(NamedTuple):
+    tex: TexDocument
+    run_kwargs: dict[str, Any]
+    name: str
+
+
+def _parse_block(options: str, code: str) -> _Figure | None:
+    try:
+        args = vars(parse_argstring(TikZMagics.tikz, options))
+    except UsageError as e:
+        logger.warning(f"Invalid options in TikZ block `{options}`: {e}")
+        return None
+    args = {
+        key: _remove_wrapping_quotes(value) if isinstance(value, str) else value
+        for key, value in args.items()
+    }
+
+    if args["implicit_pic"]:
+        input_type = "tikzpicture"
+    elif args["full_document"]:
+        input_type = "full-document"
+    else:
+        input_type = _get_input_type(args["input_type"])
+    if input_type is None:
+        logger.warning(f"`{args['input_type']}` is not a valid input type.")
+        return None
+
+    if input_type == "full-document":
+        tex = TexDocument(code, no_jinja=args["no_jinja"])
+    else:
+        tex = TexFragment(
+            code,
+            implicit_tikzpicture=input_type == "tikzpicture",
+            preamble=args["latex_preamble"],
+            tex_packages=args["tex_packages"],
+            no_tikz=args["no_tikz"],
+            tikz_libraries=args["tikz_libraries"],
+            pgfplots_libraries=args["pgfplots_libraries"],
+            scale=args["scale"],
+            no_jinja=args["no_jinja"],
+        )
+
+    image_format = "png" if args["rasterize"] else "svg"
+    try:
+        converter = _converter_name(args["converter"], image_format)
+    except ValueError as e:
+        logger.warning(str(e))
+        return None
+
+    run_kwargs = {
+        "tex_program": args["tex_program"],
+        "tex_args": args["tex_args"],
+        "rasterize": args["rasterize"],
+        "full_err": args["full_err"],
+        "dpi": args["dpi"],
+        "grayscale": args["gray"],
+        "max_passes": args["max_passes"],
+        "converter": converter,
+    }
+    name = _image_cache_key(
+        tex._cache_key(args["tex_program"], args["tex_args"]),
+        image_format,
+        args["dpi"],
+        args["gray"],
+        converter,
+    )
+    return _Figure(tex, run_kwargs, name)
+
+
+def _dedent(code: str, indent: str) -> str:
+    return "".join(
+        line[len(indent) :] if line.startswith(indent) else line
+        for line in code.splitlines(keepends=True)
+    )
+
+
+def _find_figures(markdown: str) -> list[tuple[re.Match, _Figure | None]]:
+    return [
+        (
+            match,
+            _parse_block(
+                match.group("options") or "",
+                _dedent(match.group("code"), match.group("indent")),
+            ),
+        )
+        for match in _TIKZ_BLOCK_PATTERN.finditer(markdown)
+    ]
+
+
+def _render_figure(figure: _Figure, image_dir: Path) -> bool:
+    image_path = image_dir / figure.name
+    if image_path.exists():
+        return True
+    image = figure.tex.run_latex(
+        save_image=str(image_path), cache=True, **figure.run_kwargs
+    )
+    return image is not None
+
+
+def render_figures(
+    docs_dir: str | Path, tikz_dir: str = _DEFAULT_TIKZ_DIR, jobs: int | None = None
+) -> int:
+    """Renders the TikZ blocks of all Markdown pages concurrently.
+
+    Figures are saved as `<tikz_dir>/<hash>.svg` (or `.png` with `-r`), where the hash is given by the TeX code and options. Figures that already exist are not rendered again.
+
+    Args:
+        docs_dir: The MkDocs documentation directory.
+        tikz_dir: Directory for the figures, relative to `docs_dir`.
+        jobs: Maximum number of concurrent renders. Defaults to the number of CPUs.
+
+    Returns:
+        int: The number of figures that failed to render.
+    """
+    docs_dir = Path(docs_dir)
+    image_dir = docs_dir / tikz_dir
+    figures: dict[str, _Figure] = {}
+    for page in sorted(docs_dir.rglob("*.md")):
+        for _, figure in _find_figures(page.read_text(encoding="utf-8")):
+            if figure is not None:
+                figures.setdefault(figure.name, figure)
+
+    pending = [
+        figure for figure in figures.values() if not (image_dir / figure.name).exists()
+    ]
+    if not pending:
+        return 0
+
+    image_dir.mkdir(parents=True, exist_ok=True)
+    logger.info(f"Rendering {len(pending)} TikZ figures")
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        results = list(
+            executor.map(lambda figure: _render_figure(figure, image_dir), pending)
+        )
+    return results.count(False)
+
+
+def replace_figures(
+    markdown: str, page_path: str, tikz_dir: str = _DEFAULT_TIKZ_DIR, docs_dir="."
+) -> str:
+    """Replaces the rendered TikZ blocks of a page with image links.
+
+    Blocks whose figure is not rendered (e.g., due to a LaTeX error) are kept as code.
+
+    Args:
+        markdown: The Markdown of the page.
+        page_path: Path of the page, relative to `docs_dir`.
+        tikz_dir: Directory of the figures, relative to `docs_dir`.
+        docs_dir: The MkDocs documentation directory.
+
+    Returns:
+        str: The Markdown with image links.
+    """
+    image_dir = Path(docs_dir) / tikz_dir
+    page_dir = posixpath.dirname(Path(page_path).as_posix())
+    chunks, end = [], 0
+    for match, figure in _find_figures(markdown):
+        if figure is None or not (image_dir / figure.name).exists():
+            logger.warning(f"TikZ figure in `{page_path}` was not rendered.")
+            continue
+        link = posixpath.relpath(
+            posixpath.join(Path(tikz_dir).as_posix(), figure.name), page_dir or "."
+        )
+        chunks += [
+            markdown[end : match.start()],
+            f"{match.group('indent')}![{_DEFAULT_ALT}]({link})",
+        ]
+        end = match.end()
+    return "".join(chunks) + markdown[end:]
+
+
+def define_env(env):
+    """Renders the figures of all pages when the build starts, so MkDocs copies them to the site."""
+    failed = render_figures(
+        env.conf["docs_dir"],
+        env.variables.get("tikz_dir", _DEFAULT_TIKZ_DIR),
+        env.variables.get("tikz_jobs"),
+    )
+    if failed:
+        logger.warning(f"{failed} TikZ figures failed to render.")
+
+
+def on_pre_page_macros(env):
+    env.markdown = replace_figures(
+        env.markdown,
+        env.page.file.src_path,
+        env.variables.get("tikz_dir", _DEFAULT_TIKZ_DIR),
+        env.conf["docs_dir"],
+    )
@@ -0,0 +1,131 @@
+"""nbconvert preprocessor that pre-renders `%%tikz` cells concurrently before executing the notebook."""
+
+import base64
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from IPython.core.error import UsageError
+from IPython.core.magic_arguments import parse_argstring
+from IPython.display import SVG
+from nbconvert.preprocessors import ExecutePreprocessor
+from nbformat import NotebookNode
+from nbformat.v4 import new_output
+from traitlets import Bool, Integer
+
+from .jupyter_tikz import _JINJA_DELIMITERS
+from .magics import TikZMagics
+
+_CELL_MAGIC_PATTERN = re.compile(r"\A%%tikz(?:[ \t]+(?P<line>[^\n]*))?(?:\n|\Z)")
+# Options whose output is not just the rendered image
+_KERNEL_ONLY_ARGS = ["save_var", "print_jinja", "print_tex", "no_compile", "animate"]
+
+
+@contextmanager
+def _working_dir(path: str):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def _split_cell_magic(source: str) -> tuple[str, str] | None:
+    match = _CELL_MAGIC_PATTERN.match(source)
+    if not match:
+        return None
+    return match.group("line") or "", source[match.end() :]
+
+
+def _needs_kernel(line: str, cell: str) -> bool:
+    """Returns whether the `%%tikz` cell depends on the kernel namespace or side effects."""
+    if "$" in line or "{" in line:  # IPython variable expansion
+        return True
+    try:
+        args = vars(parse_argstring(TikZMagics.tikz, line))
+    except UsageError:
+        return True  # Let the kernel report it
+    if any(args[arg] for arg in _KERNEL_ONLY_ARGS) or args["split_pictures"]:
+        return True
+    return not args["no_jinja"] and any(
+        delimiter in cell for delimiter in _JINJA_DELIMITERS
+    )
+
+
+def _display_data(image) -> NotebookNode:
+    if isinstance(image, SVG):
+        data = {"image/svg+xml": image.data}
+    else:
+        data = {"image/png": base64.b64encode(image.data).decode("ascii")}
+    data["text/plain"] = repr(image)
+    return new_output("display_data", data=data)
+
+
+class TikZPreprocessor(ExecutePreprocessor):
+    """Executes a notebook, pre-rendering its `%%tikz` cells concurrently.
+
+    `%%tikz` cells that do not depend on the kernel namespace (no Jinja templates, IPython variables or `--save-var`) are rendered in parallel before the notebook is executed, and are skipped by the kernel. The other cells, including `%tikz` line magics, are rendered by the kernel when they are executed.
+
+    Example:
+        `jupyter nbconvert --to html --Exporter.preprocessors=jupyter_tikz.preprocessors.TikZPreprocessor notebook.ipynb`
+    """
+
+    jobs = Integer(
+        None,
+        allow_none=True,
+        help="Maximum number of concurrent renders. Defaults to the number of CPUs.",
+    ).tag(config=True)
+    cache = Bool(
+        True,
+        help="Use the render cache, so unchanged figures are not compiled again in later exports.",
+    ).tag(config=True)
+
+    def preprocess(self, nb, resources=None, km=None):
+        resources = resources or {}
+        path = resources.get("metadata", {}).get("path") or os.getcwd()
+
+        prerender, kernel_cells = [], []
+        for cell in nb.cells:
+            if cell.cell_type != "code":
+                continue
+            magic = _split_cell_magic(cell.source)
+            if magic and not _needs_kernel(*magic):
+                prerender.append((cell, *magic))
+            elif magic:
+                kernel_cells.append((cell, cell.source))
+
+        with _working_dir(path), ThreadPoolExecutor(
+            max_workers=self.jobs or os.cpu_count()
+        ) as executor:
+            images = list(executor.map(lambda job: self._render(*job[1:]), prerender))
+
+        skipped = []
+        for (cell, *_), image in zip(prerender, images):
+            if image is None:  # Let the kernel show the error
+                continue
+            cell.outputs = [_display_data(image)]
+            tags = cell.metadata.setdefault("tags", [])
+            if self.skip_cells_with_tag not in tags:
+                tags.append(self.skip_cells_with_tag)
+                skipped.append(cell)
+
+        if self.cache:
+            for cell, _ in kernel_cells:
+                cell.source = re.sub(r"\A%%tikz", "%%tikz -c", cell.source)
+
+        try:
+            return super().preprocess(nb, resources, km)
+        finally:
+            for cell in skipped:
+                cell.metadata.tags.remove(self.skip_cells_with_tag)
+                if not cell.metadata.tags:
+                    del cell.metadata["tags"]
+            for cell, source in kernel_cells:
+                cell.source = source
+
+    def _render(self, line: str, cell: str):
+        if self.cache:
+            line += " -c"
+        return TikZMagics().tikz(line, cell, local_ns={})
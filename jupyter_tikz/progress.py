@@ -0,0 +1,147 @@
+"""Progress of long renders in the notebook: the stage, the TeX pass, the pages shipped out and the elapsed time.
+
+TeX runs in batch mode, so it writes nothing to the terminal. The pages are read from the new part of its log file, as it is written.
+"""
+
+from __future__ import annotations
+
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any
+
+# Quick renders show nothing
+_DELAY = 2.0  # s
+_INTERVAL = 0.5  # s
+# Pages shipped out are logged as `[1]`, or `[1{/path/pdftex.map}]`
+_PAGE_PATTERN = re.compile(rb"\[(\d+)[\]{<\s]")
+_PAGE_MARK_SIZE = 16  # bytes, so a mark split between two reads is found
+_STAGE_LABELS = {
+    "tex": "Compiling",
+    "convert": "Converting",
+    "export": "Exporting",
+    "save": "Saving",
+    "remote": "Rendering with the daemon",
+}
+
+# The monitor of the render of the current thread
+_local = threading.local()
+
+
+class _Monitor:
+    """Shows the progress of a render in a display, updated from a background thread."""
+
+    def __init__(self, delay: float, interval: float):
+        self.delay = delay
+        self.interval = interval
+        self._fields: dict[str, Any] = {}
+        self._start = time.perf_counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="jupyter-tikz-progress", daemon=True
+        )
+        self._handle = None
+        self._log_key: tuple[Path, int | None] | None = None
+        self._log_offset = 0
+        self._pages = 0
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        if self._handle is not None:
+            self._handle.update({"text/plain": ""}, raw=True)
+
+    def update(self, **fields) -> None:
+        self._fields = {**self._fields, **fields}
+
+    def _run(self) -> None:
+        if self._stopped.wait(self.delay):
+            return
+        from IPython import display
+
+        handle = display.display({"text/plain": self.text()}, raw=True, display_id=True)
+        if handle is None:  # No frontend to update
+            return
+        self._handle = handle
+        while not self._stopped.wait(self.interval):
+            handle.update({"text/plain": self.text()}, raw=True)
+
+    def text(self) -> str:
+        fields = self._fields
+        parts = [_STAGE_LABELS.get(fields.get("stage"), "Rendering")]
+        if fields.get("stage") == "tex":
+            if fields.get("engine"):
+                parts[0] += f" with {fields['engine']}"
+            if fields.get("tex_pass"):
+                parts.append(f"pass {fields['tex_pass']}")
+            pages = self._read_pages(fields.get("log_path"), fields.get("tex_pass"))
+            if pages:
+                parts.append(f"{pages} page{'s' if pages > 1 else ''}")
+        elapsed = time.perf_counter() - self._start
+        return f"{', '.join(parts)} ({elapsed:.0f} s)"
+
+    def _read_pages(self, log_path: Path | None, tex_pass: int | None) -> int:
+        """Returns the last page shipped out, reading only the new part of the log."""
+        if log_path is None:
+            return 0
+        try:
+            size = log_path.stat().st_size
+            if (log_path, tex_pass) != self._log_key or size < self._log_offset:
+                # Each pass writes a new log
+                self._log_key, self._log_offset, self._pages = (
+                    (log_path, tex_pass),
+                    0,
+                    0,
+                )
+            with open(log_path, "rb") as log_file:
+                log_file.seek(max(self._log_offset - _PAGE_MARK_SIZE, 0))
+                data = log_file.read(size - log_file.tell())
+        except OSError:  # Not written yet
+            return self._pages
+        self._log_offset = size
+        pages = [int(page) for page in _PAGE_PATTERN.findall(data)]
+        self._pages = max([self._pages, *pages])
+        return self._pages
+
+
+def _in_kernel() -> bool:
+    """Whether the code runs in a Jupyter kernel, whose displays can be updated in place."""
+    if "IPython" not in sys.modules:
+        return False
+    from IPython.core.interactiveshell import InteractiveShell
+
+    return InteractiveShell.initialized() and hasattr(
+        InteractiveShell.instance(), "kernel"
+    )
+
+
+@contextmanager
+def show(enabled: bool = True):
+    """Shows the progress of the render run in the block, if it takes longer than `_DELAY`.
+
+    Nothing is shown outside a Jupyter kernel, e.g., in scripts or nbconvert preprocessors.
+    """
+    if not enabled or not _in_kernel():
+        yield
+        return
+    monitor = _Monitor(_DELAY, _INTERVAL)
+    _local.monitor = monitor
+    monitor.start()
+    try:
+        yield
+    finally:
+        _local.monitor = None
+        monitor.stop()
+
+
+def update(**fields) -> None:
+    """Updates the progress of the render of the current thread, e.g., `update(tex_pass=2)`."""
+    monitor = getattr(_local, "monitor", None)
+    if monitor is not None:
+        monitor.update(**fields)
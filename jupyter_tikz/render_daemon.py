@@ -0,0 +1,350 @@
+"""Render daemon shared by all the kernels of a node, e.g., `python -m jupyter_tikz.render_daemon -w 4`.
+
+While the daemon is running, `TexDocument.run_latex` sends its renders to it through a Unix socket instead of running TeX itself. The daemon keeps a pool of worker processes, serves the clients in turn, renders identical requests only once and uses the render cache.
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr
+from hashlib import md5
+from pathlib import Path
+
+from .converters import _CONVERTERS
+from .jupyter_tikz import (
+    _DAEMON_CONNECT_TIMEOUT,
+    TexDocument,
+    _cache_modes,
+    _daemon_accepts,
+    _daemon_socket_path,
+    _make_cache_dir,
+    _recv_message,
+    _send_message,
+)
+
+# Request fields that do not change the rendered files
+_CLIENT_FIELDS = ["client", "full_err"]
+# kpathsea settings of the workers: documents only read and write files in the
+# directories of the search paths, not e.g. the `~/.ssh` of the daemon owner
+_TEX_FILE_ACCESS = {"openin_any": "p", "openout_any": "p"}
+# Types of the request fields, whose values end up in the command lines of the workers
+_REQUEST_FIELDS = {
+    "cwd": str,
+    "latex": str,
+    "tex_program": str,
+    "tex_args": (str, type(None)),
+    "rasterize": bool,
+    "full_err": bool,
+    "dpi": int,
+    "grayscale": bool,
+    "cache": bool,
+    "max_passes": int,
+    "aux_key": (str, type(None)),
+    "converter": str,
+}
+
+
+def _check_request(request: dict) -> str | None:
+    """Returns why the request is refused, or None if it can be rendered."""
+    for field, types in _REQUEST_FIELDS.items():
+        if not isinstance(request.get(field), types):
+            return f"Invalid request field `{field}`."
+    if not _daemon_accepts(request["tex_program"], request["tex_args"]):
+        return "The render daemon does not run this TeX program or these arguments."
+    if request["converter"] not in _CONVERTERS:
+        return f"`{request['converter']}` is not a valid converter."
+    return None
+
+
+def _peer_uid(connection: socket.socket) -> int | None:
+    """Returns the user id of the client process, or None if unknown (e.g., on macOS)."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    credentials = connection.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", credentials)
+    return uid
+
+
+def _request_key(request: dict) -> str:
+    options = {
+        key: value for key, value in request.items() if key not in _CLIENT_FIELDS
+    }
+    return md5(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def _init_worker() -> None:
+    os.environ["JUPYTER_TIKZ_NO_DAEMON"] = "1"  # Workers render in-process
+
+
+def _render_request(request: dict) -> dict:
+    """Renders a request in a worker process, returning the PDF and image bytes."""
+    tex_document = TexDocument(request["latex"], no_jinja=True)
+    # The `.aux` files of each user are kept apart, as by in-process renders
+    aux_key = None
+    if request.get("uid") is not None and request["aux_key"]:
+        aux_key = f"{request['uid']}:{request['aux_key']}"
+    environ = {
+        # Files included by the document are looked up in the client's directory
+        "TEXINPUTS": request["cwd"] + os.pathsep + os.environ.get("TEXINPUTS", ""),
+        **_TEX_FILE_ACCESS,
+    }
+    saved_environ = {name: os.environ.get(name) for name in environ}
+    os.environ.update(environ)
+    cwd = os.getcwd()
+    stderr = io.StringIO()
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir, redirect_stderr(stderr):
+            os.chdir(temp_dir)
+            try:
+                image = tex_document.run_latex(
+                    tex_program=request["tex_program"],
+                    tex_args=request["tex_args"],
+                    rasterize=request["rasterize"],
+                    full_err=request["full_err"],
+                    keep_temp=True,
+                    dpi=request["dpi"],
+                    grayscale=request["grayscale"],
+                    cache=request["cache"],
+                    max_passes=request["max_passes"],
+                    aux_key=aux_key,
+                    converter=request["converter"],
+                )
+                if image is None:
+                    return {"ok": False, "error": stderr.getvalue().rstrip("\n")}
+                tex_path = Path(f"{tex_document._hex_hash}.tex")
+                image_format = "png" if request["rasterize"] else "svg"
+                return {
+                    "ok": True,
+                    "resource_usage": tex_document.resource_usage,
+                    "pdf": base64.b64encode(
+                        tex_path.with_suffix(".pdf").read_bytes()
+                    ).decode("ascii"),
+                    "image": base64.b64encode(
+                        tex_path.with_suffix(f".{image_format}").read_bytes()
+                    ).decode("ascii"),
+                }
+            finally:
+                os.chdir(cwd)
+    finally:
+        for name, value in saved_environ.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+class RenderDaemon:
+    """Queues render requests and runs them in a pool of worker processes.
+
+    Requests are queued per client and dispatched in turn, so a client rendering many figures does not starve the others. Identical requests waiting or running at the same time are rendered once.
+
+    Args:
+        socket_path: Path of the Unix socket. Defaults to `daemon.sock` in the render cache directory, or `JUPYTER_TIKZ_DAEMON_SOCKET`.
+        workers: Number of worker processes. Defaults to the number of CPUs.
+        executor: Executor running the renders. Defaults to a process pool with `workers` processes, replaced when one of them is killed.
+    """
+
+    def __init__(
+        self,
+        socket_path: str | Path | None = None,
+        workers: int | None = None,
+        executor: Executor | None = None,
+    ):
+        self.socket_path = Path(socket_path or _daemon_socket_path())
+        self.workers = workers or os.cpu_count()
+        self._owns_executor = executor is None
+        self._executor = executor or self._new_executor()
+        self._queues: OrderedDict[str, deque] = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        self._free_workers = self.workers
+        self._condition = threading.Condition()
+        self._server: socketserver.UnixStreamServer | None = None
+
+    def _new_executor(self) -> Executor:
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+    def _replace_broken_executor(self, broken: Executor) -> None:
+        # A killed worker (e.g., by the OOM killer) breaks the whole process pool
+        with self._condition:
+            if not self._owns_executor or self._executor is not broken:
+                return  # Not ours, or already replaced
+            self._executor = self._new_executor()
+        broken.shutdown(wait=False)
+
+    def submit(self, request: dict) -> Future:
+        """Queues a render request.
+
+        Returns:
+            Future: The response, shared by identical requests.
+        """
+        key = _request_key(request)
+        with self._condition:
+            if key in self._inflight:
+                return self._inflight[key]
+            future = Future()
+            self._inflight[key] = future
+            client = str(request.get("client"))
+            self._queues.setdefault(client, deque()).append((key, request))
+            self._condition.notify()
+        return future
+
+    def _next_request(self) -> tuple[str, dict]:
+        # The served client goes to the end of the line
+        client, queue = self._queues.popitem(last=False)
+        key, request = queue.popleft()
+        if queue:
+            self._queues[client] = queue
+        return key, request
+
+    def _dispatch(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._server is None
+                    or (self._queues and self._free_workers)
+                )
+                if self._server is None:
+                    return
+                key, request = self._next_request()
+                self._free_workers -= 1
+            executor = self._executor
+            try:
+                result = executor.submit(_render_request, request)
+            except RuntimeError as e:  # e.g., a worker process was killed
+                result = Future()
+                result.set_exception(e)
+            result.add_done_callback(
+                lambda result, key=key, executor=executor: self._finish(
+                    key, result, executor
+                )
+            )
+
+    def _finish(self, key: str, result: Future, executor: Executor) -> None:
+        with self._condition:
+            future = self._inflight.pop(key)
+            self._free_workers += 1
+            self._condition.notify()
+        try:
+            future.set_result(result.result())
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                self._replace_broken_executor(executor)
+            # Not an error of the document: the client renders it in-process
+            future.set_result(
+                {
+                    "ok": False,
+                    "error": f"Render daemon error: {e}",
+                    "retry_locally": True,
+                }
+            )
+
+    def serve_forever(self) -> None:
+        """Listens on the socket until `shutdown` is called."""
+        if self.socket_path.exists():
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                    client.connect(str(self.socket_path))
+                raise RuntimeError(
+                    f"A render daemon is running on `{self.socket_path}`."
+                )
+            except ConnectionRefusedError:  # Left by a stopped daemon
+                self.socket_path.unlink()
+
+        daemon = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.settimeout(_DAEMON_CONNECT_TIMEOUT)
+                try:
+                    request = _recv_message(self.request)
+                except (OSError, ValueError):  # Hung or invalid client
+                    return
+                if not isinstance(request, dict):
+                    return
+                # Set by the daemon: identical requests of different users are not
+                # shared, and neither are their `.aux` files
+                request["uid"] = _peer_uid(self.request)
+                error = _check_request(request)
+                if error is not None:
+                    response = {"ok": False, "error": error, "retry_locally": True}
+                else:
+                    response = daemon.submit(request).result()
+                self.request.settimeout(None)
+                _send_message(self.request, response)
+
+        _make_cache_dir(self.socket_path.parent)
+        server = socketserver.ThreadingUnixStreamServer(str(self.socket_path), Handler)
+        server.daemon_threads = True
+        # Clients need write access to connect
+        os.chmod(self.socket_path, 0o660 if _cache_modes()[1] & 0o040 else 0o600)
+        with self._condition:
+            self._server = server
+        dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        dispatcher.start()
+        try:
+            server.serve_forever()
+        finally:
+            with self._condition:
+                self._server = None
+                self._condition.notify_all()
+            dispatcher.join()
+            server.server_close()
+            self.socket_path.unlink(missing_ok=True)
+            self._executor.shutdown(cancel_futures=True)
+
+    def shutdown(self) -> None:
+        """Stops `serve_forever`, from another thread."""
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m jupyter_tikz.render_daemon",
+        description="Render daemon shared by the Jupyter kernels of this node.",
+    )
+    parser.add_argument(
+        "-s",
+        "--socket",
+        default=None,
+        help="Path of the Unix socket. Defaults to `daemon.sock` in the render cache directory.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes. Defaults to the number of CPUs.",
+    )
+    args = parser.parse_args(argv)
+
+    daemon = RenderDaemon(args.socket, args.workers)
+    # Remove the socket when stopped by a service manager
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Listening on {daemon.socket_path}", file=sys.stderr)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Trace spans of the magic and renders, enabled by setting `JUPYTER_TIKZ_TRACE` to a file path.
+
+Spans are appended to the file in the Chrome trace event format, which can be opened with Perfetto (https://ui.perfetto.dev) or `chrome://tracing`. Processes can share the file, e.g., all the kernels of a "Run All".
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any
+
+_CATEGORY = "jupyter-tikz"
+
+
+def _trace_path() -> str | None:
+    return os.environ.get("JUPYTER_TIKZ_TRACE")
+
+
+@contextmanager
+def span(name: str, **attributes: Any):
+    """Records the duration of the block. Attributes added to the yielded dict are recorded too."""
+    path = _trace_path()
+    if not path:
+        yield attributes
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield attributes
+    finally:
+        end = time.perf_counter_ns()
+        event = {
+            "name": name,
+            "cat": _CATEGORY,
+            "ph": "X",  # Complete event, nested by their times in each thread
+            "ts": _timestamp(start),
+            "dur": (end - start) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": {
+                key: value for key, value in attributes.items() if value is not None
+            },
+        }
+        try:
+            _append_event(path, event)
+        except OSError:  # pragma: no cover
+            pass  # Tracing never fails a render
+
+
+# Timestamps are in µs since the epoch, so events of several processes line up
+_EPOCH_OFFSET_NS = time.time_ns() - time.perf_counter_ns()
+
+
+def _timestamp(perf_counter_ns: int) -> float:
+    return (perf_counter_ns + _EPOCH_OFFSET_NS) / 1000
+
+
+def _append_event(path: str, event: dict[str, Any]) -> None:
+    # The closing `]` of the array is optional in the format, so events are appended
+    if not os.path.exists(path):
+        # The file is linked with its opening `[`, so no event is written before it
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as temp_file:
+            temp_file.write("[\n")
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass  # Created by another process
+        finally:
+            os.unlink(temp_path)
+    line = json.dumps(event, default=str) + ",\n"
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
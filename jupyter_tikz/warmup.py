@@ -0,0 +1,135 @@
+"""Warm-up of the TeX toolchain, so the first figure of a session does not pay for its cold caches.
+
+The first render in a fresh container is much slower than the next ones: `lualatex` builds its font database, kpathsea loads its file databases, and the formats, fonts and programs are read from a cold disk. `warmup()` renders a small figure with each engine and the preamble of the notebook, so these caches are built before the first real figure.
+
+Set `JUPYTER_TIKZ_WARMUP` to warm up in the background when the extension is loaded, e.g., `JUPYTER_TIKZ_WARMUP=pdflatex,lualatex` (or `1` for `pdflatex`).
+"""
+
+from __future__ import annotations
+
+import os
+import shutil
+import threading
+import time
+from typing import Sequence
+
+from . import tracing as _tracing
+from .converters import _converter_name, _import_pymupdf, _pdftocairo_path
+from .jupyter_tikz import TexFragment
+
+_DEFAULT_TEX_PROGRAM = "pdflatex"
+# Text and math, so their fonts are loaded too
+_WARMUP_CODE = r"\node {Warm-up $x^2$};"
+
+
+def _tex_programs(tex_programs: str | Sequence[str]) -> list[str]:
+    if isinstance(tex_programs, str):
+        tex_programs = tex_programs.split(",")
+    return [program.strip() for program in tex_programs if program.strip()]
+
+
+def _converter_program(converter: str) -> str | None:
+    if converter == "pdftocairo":
+        return _pdftocairo_path()
+    return None if converter == "pymupdf" else converter
+
+
+def warmup(
+    tex_programs: str | Sequence[str] = _DEFAULT_TEX_PROGRAM,
+    preamble: str | None = None,
+    tex_packages: str | None = None,
+    tikz_libraries: str | None = None,
+    pgfplots_libraries: str | None = None,
+    rasterize: bool = False,
+    converter: str | None = None,
+) -> dict[str, float | None]:
+    """Primes the caches of the TeX toolchain by rendering a small figure with each TeX program.
+
+    Example:
+        `warmup("pdflatex,lualatex", tex_packages="pgfplots")`
+
+    Args:
+        tex_programs: The TeX programs to warm up, as a list or comma-separated.
+        preamble: LaTeX preamble of the figure, so its packages and fonts are loaded.
+        tex_packages: Comma-separated list of TeX packages, if there is no `preamble`.
+        tikz_libraries: Comma-separated list of TikZ libraries, if there is no `preamble`.
+        pgfplots_libraries: Comma-separated list of pgfplots libraries, if there is no `preamble`.
+        rasterize: Warm up the conversion to PNG instead of SVG.
+        converter: Backend converting the PDF to the image. Defaults to `JUPYTER_TIKZ_CONVERTER` or `pdftocairo`.
+
+    Returns:
+        dict[str, float | None]: The duration in seconds of each step: `executables`, to find the programs, and one per TeX program. None if the program was not found or the render failed.
+
+    Raises:
+        ValueError: If the converter cannot output the image format.
+    """
+    converter = _converter_name(converter, "png" if rasterize else "svg")
+    tex_programs = _tex_programs(tex_programs)
+    timings: dict[str, float | None] = {}
+
+    with _tracing.span("warmup", engines=",".join(tex_programs)):
+        start = time.perf_counter()
+        # Also reads the programs from the disk, and imports PyMuPDF
+        programs = [*tex_programs, "kpsewhich", _converter_program(converter)]
+        found = {
+            program: shutil.which(program) is not None
+            for program in programs
+            if program
+        }
+        if converter == "pymupdf":
+            try:
+                _import_pymupdf()
+            except ImportError:
+                pass  # The renders fail with the error
+        timings["executables"] = time.perf_counter() - start
+
+        tex = TexFragment(
+            _WARMUP_CODE,
+            implicit_tikzpicture=True,
+            preamble=preamble,
+            tex_packages=tex_packages,
+            tikz_libraries=tikz_libraries,
+            pgfplots_libraries=pgfplots_libraries,
+            no_jinja=True,
+        )
+        for tex_program in tex_programs:
+            if not found[tex_program]:
+                timings[tex_program] = None
+                continue
+            start = time.perf_counter()
+            image = tex.run_latex(
+                tex_program=tex_program, rasterize=rasterize, converter=converter
+            )
+            timings[tex_program] = (
+                time.perf_counter() - start if image is not None else None
+            )
+    return timings
+
+
+def _format_report(timings: dict[str, float | None]) -> str:
+    total = sum(duration or 0 for duration in timings.values())
+    width = max(len(step) for step in timings)
+    lines = [f"TikZ warm-up: {total:.2f} s"]
+    for step, duration in timings.items():
+        status = f"{duration:.2f} s" if duration is not None else "not found or failed"
+        lines.append(f"  {step:<{width}}  {status}")
+    return "\n".join(lines)
+
+
+def start_warmup(**kwargs) -> threading.Thread:
+    """Runs `warmup` in a background thread, with the same arguments."""
+    thread = threading.Thread(
+        target=warmup, kwargs=kwargs, name="jupyter-tikz-warmup", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def _warmup_on_load() -> threading.Thread | None:
+    """Starts the warm-up set by `JUPYTER_TIKZ_WARMUP`, when the extension is loaded."""
+    setting = os.environ.get("JUPYTER_TIKZ_WARMUP", "").strip()
+    if setting.lower() in ["", "0", "false", "no"]:
+        return None
+    if setting.lower() in ["1", "true", "yes"]:
+        setting = _DEFAULT_TEX_PROGRAM
+    return start_warmup(tex_programs=setting)
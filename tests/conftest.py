@@ -1,8 +1,10 @@
+import subprocess
 from hashlib import md5
+from pathlib import Path
 
 import pytest
 
-from jupyter_tikz import TexDocument
+from jupyter_tikz import TexDocument, jupyter_tikz
 
 EXAMPLE_BAD_TIKZ = "HELLO WORLD"
 
@@ -61,7 +63,49 @@ DUMMY_COMMAND = "dummy_command"
 ANY_CODE_HASH = md5("any code".encode()).hexdigest()
 ANY_CODE = "any code"
 
+SVG_CODE = '<svg xmlns="http://www.w3.org/2000/svg"/>'
+
+
+def render_side_effect(command, **kwargs):
+    """Writes the outputs of the TeX and converter commands, e.g., a PNG with the command as content."""
+    _ = kwargs
+    output = Path(command.split()[-1])
+    if command.startswith("dvisvgm"):
+        Path(command.split()[-2].removeprefix("--output=")).write_text(SVG_CODE)
+    elif command.startswith(("pdftocairo -png", "pdftoppm")):
+        Path(f"{output}.png").write_text(command)
+    elif command.startswith("pdftocairo"):
+        output.write_text(SVG_CODE)
+    else:
+        output.with_suffix(".pdf").write_text("pdf")
+    return subprocess.CompletedProcess(command, 0, "", "")
+
 
 @pytest.fixture
 def tex_document():
     return TexDocument(ANY_CODE)
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path_factory, monkeypatch):
+    """Keeps the cache files written by the tests (e.g., saved records) out of `~/.cache`."""
+    cache_home = tmp_path_factory.mktemp("cache_home")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(cache_home))
+    return cache_home
+
+
+@pytest.fixture
+def run_side_effect():
+    """Side effect of `run_mock`, overridden or parametrized by the tests."""
+    return render_side_effect
+
+
+@pytest.fixture
+def run_mock(mocker, monkeypatch, tmp_path, run_side_effect):
+    """Mocks the TeX and converter processes of `run_latex` in the `work` folder."""
+    (tmp_path / "work").mkdir()
+    monkeypatch.chdir(tmp_path / "work")
+    monkeypatch.setenv("JUPYTER_TIKZ_NO_DAEMON", "1")
+    return mocker.patch.object(
+        jupyter_tikz, "_run_process", side_effect=run_side_effect
+    )
@@ -0,0 +1,329 @@
+import re
+import struct
+import subprocess
+import zlib
+from hashlib import md5
+from pathlib import Path
+
+import pytest
+
+from jupyter_tikz import TexDocument, TexFragment, TikZMagics, animation, jupyter_tikz
+from jupyter_tikz.animation import (
+    _PNG_SIGNATURE,
+    _apng,
+    _frames_latex,
+    _png_chunk,
+    _png_chunks,
+    render_animation,
+)
+from tests.conftest import *
+
+FRAME_TEMPLATE = r"\draw (0,0) circle ((* r *));"
+
+
+def make_png(text="", width=2, height=2):
+    color = md5(text.encode()).digest()[:4]
+    raw = b"".join(b"\x00" + color * width for _ in range(height))
+    header = struct.pack("!IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (
+        _PNG_SIGNATURE
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(raw))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def make_frames(radii, **kwargs):
+    return [
+        TexFragment(FRAME_TEMPLATE, implicit_tikzpicture=True, ns={"r": r}, **kwargs)
+        for r in radii
+    ]
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("JUPYTER_TIKZ_CACHEDIR", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+@pytest.fixture
+def run_side_effect():
+    """Compiles one page per picture, and rasterizes each page to a PNG given by its code."""
+
+    def run(command, **kwargs):
+        _ = kwargs
+        output = Path(command.split()[-1])
+        if command.startswith("pdftocairo"):
+            pages = Path(command.split()[-2]).read_text().split("\n")
+            if "-singlefile" in command:
+                output.with_suffix(".png").write_bytes(make_png(pages[0]))
+                return subprocess.CompletedProcess(command, 0, "", "")
+            for index, page in enumerate(pages, start=1):
+                digits = len(str(len(pages)))
+                Path(f"{output}-{index:0{digits}d}.png").write_bytes(make_png(page))
+        else:
+            pages = re.findall(r"\\draw[^\n]*", output.read_text())
+            output.with_suffix(".pdf").write_text("\n".join(pages))
+        return subprocess.CompletedProcess(command, 0, "", "")
+
+    return run
+
+
+def frames_of(data):
+    chunks = _png_chunks(data)
+    return [chunk for chunk_type, chunk in chunks if chunk_type == b"fcTL"]
+
+
+def test_frames_latex_standalone():
+    # Act
+    res = _frames_latex(make_frames([1, 2]))
+
+    # Assert
+    assert "\\documentclass[multi=jupytertikzframe]{standalone}" in res
+    assert "\\newenvironment{jupytertikzframe}{}{}\n\\begin{document}" in res
+    assert res.count("\\begin{jupytertikzframe}") == 2
+    assert res.count("\\begin{document}") == 1
+    assert res.index("circle (1)") < res.index("circle (2)")
+    assert res.endswith("\\end{jupytertikzframe}\n\\end{document}")
+
+
+def test_frames_latex_standalone_tikz():
+    # Arrange
+    frames = [TexDocument(EXAMPLE_GOOD_TEX.replace("blue", color)) for color in "ab"]
+
+    # Act
+    res = _frames_latex(frames)
+
+    # Assert
+    assert "\\documentclass[tikz]{standalone}" in res
+    assert "jupytertikzframe" not in res
+    assert res.count("\\begin{tikzpicture}") == 2
+
+
+def test_frames_latex_other_classes():
+    # Arrange
+    frames = [
+        TexDocument(
+            f"\\documentclass{{article}}\n\\begin{{document}}\n{text}\n\\end{{document}}"
+        )
+        for text in ["a", "b"]
+    ]
+
+    # Act
+    res = _frames_latex(frames)
+
+    # Assert
+    assert "a\n\\clearpage\nb" in res
+
+
+def test_frames_latex_different_preambles():
+    # Arrange
+    frames = make_frames([1]) + make_frames([2], tikz_libraries="calc")
+
+    # Act & Assert
+    assert _frames_latex(frames) is None
+
+
+def test_apng():
+    # Arrange
+    images = [make_png(str(index)) for index in range(3)]
+
+    # Act
+    res = _apng(images, fps=4)
+
+    # Assert
+    chunks = _png_chunks(res)
+    assert [chunk_type for chunk_type, _ in chunks] == [
+        b"IHDR",
+        b"acTL",
+        b"fcTL",
+        b"IDAT",
+        b"fcTL",
+        b"fdAT",
+        b"fcTL",
+        b"fdAT",
+        b"IEND",
+    ]
+    assert struct.unpack("!II", dict(chunks)[b"acTL"]) == (3, 0)
+    sequence = [
+        struct.unpack("!I", data[:4])[0]
+        for chunk_type, data in chunks
+        if chunk_type in (b"fcTL", b"fdAT")
+    ]
+    assert sequence == [0, 1, 2, 3, 4]
+    delays = {struct.unpack("!HH", frame[20:24]) for frame in frames_of(res)}
+    assert delays == {(1, 4)}
+    fdat = [data for chunk_type, data in chunks if chunk_type == b"fdAT"]
+    assert fdat[0][4:] == dict(_png_chunks(images[1]))[b"IDAT"]
+
+
+def test_apng_different_sizes():
+    # Act & Assert
+    assert _apng([make_png(), make_png(width=3)], fps=10) is None
+
+
+def test_render_animation_compiles_once(run_mock):
+    # Arrange
+    frames = make_frames([1, 2, 3])
+
+    # Act
+    res = render_animation(frames)
+
+    # Assert
+    assert run_mock.call_count == 2  # One TeX and one pdftocairo call
+    assert len(frames_of(res.data)) == 3
+    assert list(Path().iterdir()) == []
+
+
+def test_render_animation_frames(run_mock, mocker):
+    # Arrange
+    frames = make_frames([1, 2, 1])
+    spy = mocker.spy(animation, "_frames_latex")
+
+    # Act
+    res = render_animation(frames, animation_format="frames", save_image="out/frame")
+
+    # Assert
+    expected = [make_png(f"\\draw (0,0) circle ({r});") for r in [1, 2, 1]]
+    assert [image.data for image in res] == expected
+    assert len(spy.call_args.args[0]) == 2  # Identical frames are compiled once
+    assert Path("out/frame-3.png").read_bytes() == expected[2]
+
+
+def test_render_animation_reuses_cached_frames(run_mock, cache_dir, mocker):
+    # Arrange
+    render_animation(make_frames([1, 2, 3]), cache=True)
+    run_mock.reset_mock()
+    spy = mocker.spy(animation, "_frames_latex")
+
+    # Act
+    res = render_animation(make_frames([1, 2, 4, 5]), cache=True)
+
+    # Assert
+    assert len(frames_of(res.data)) == 4
+    assert run_mock.call_count == 2
+    assert ["circle (4)" in frame.full_latex for frame in spy.call_args.args[0]] == [
+        True,
+        False,
+    ]
+    assert len(list(cache_dir.glob("*.png"))) == 5
+
+
+def test_render_animation_single_pending_frame(run_mock, cache_dir, mocker):
+    # Arrange
+    render_animation(make_frames([1, 2]), cache=True)
+    spy = mocker.spy(TexDocument, "run_latex")
+
+    # Act
+    res = render_animation(make_frames([1, 3]), cache=True)
+
+    # Assert
+    assert len(frames_of(res.data)) == 2
+    spy.assert_called_once()
+    assert spy.call_args.kwargs["rasterize"]
+
+
+def test_render_animation_pages_mismatch(run_mock, mocker):
+    # Arrange
+    code = "\\draw (0,0) circle (1);\n\\end{tikzpicture}\n\\begin{tikzpicture}\n"
+    frames = [
+        TexDocument(EXAMPLE_GOOD_TEX.replace("\\draw", code + "\\draw" + str(i)))
+        for i in range(2)
+    ]
+    spy = mocker.spy(TexDocument, "run_latex")
+
+    # Act
+    res = render_animation(frames, animation_format="frames")
+
+    # Assert
+    assert len(res) == 2
+    assert spy.call_count == 2  # Each frame rendered on its own
+
+
+def test_render_animation_different_sizes(run_mock, mocker, capsys):
+    # Arrange
+    mocker.patch.object(
+        animation,
+        "_render_frames",
+        return_value=[make_png(), make_png(width=3)],
+    )
+
+    # Act
+    res = render_animation(make_frames([1, 2]))
+
+    # Assert
+    assert res is None
+    assert "different sizes" in capsys.readouterr().err
+
+
+def test_render_animation_error(run_mock, capsys):
+    # Arrange
+    run_mock.side_effect = lambda command, **kwargs: subprocess.CompletedProcess(
+        command, 1, "", "! Undefined control sequence."
+    )
+
+    # Act
+    res = render_animation(make_frames([1, 2]))
+
+    # Assert
+    assert res is None
+    assert "Undefined control sequence" in capsys.readouterr().err
+    assert list(Path().iterdir()) == []
+
+
+def test_render_animation_invalid_format():
+    # Act & Assert
+    with pytest.raises(ValueError, match="not a valid animation format"):
+        render_animation(make_frames([1]), animation_format="mp4")
+
+
+def test_render_animation_gif(run_mock):
+    # Arrange
+    pytest.importorskip("PIL")
+
+    # Act
+    res = render_animation(make_frames([1, 2]), animation_format="gif")
+
+    # Assert
+    assert res.data.startswith(b"GIF89a")
+
+
+def test_magic_animate(mocker, monkeypatch, tmp_path):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    animation_mock = mocker.patch("jupyter_tikz.magics.render_animation")
+    local_ns = {"r": [1, 2, 3]}
+
+    # Act
+    TikZMagics().tikz("-i -an=r -fps=5", FRAME_TEMPLATE, local_ns=local_ns)
+
+    # Assert
+    frames = animation_mock.call_args.args[0]
+    assert ["circle (2)" in frame.full_latex for frame in frames] == [
+        False,
+        True,
+        False,
+    ]
+    assert animation_mock.call_args.kwargs["fps"] == 5
+    assert local_ns == {"r": [1, 2, 3]}
+
+
+@pytest.mark.parametrize(
+    "line, local_ns, expected_err",
+    [
+        ("-an=r", {}, "`r` is not defined."),
+        ("-an=r", {"r": []}, "`r` is empty."),
+        ("-an=r -af=mp4", {"r": [1]}, "`mp4` is not a valid animation format."),
+    ],
+)
+def test_magic_animate_errors(mocker, capsys, line, local_ns, expected_err):
+    # Arrange
+    animation_mock = mocker.patch("jupyter_tikz.magics.render_animation")
+
+    # Act
+    res = TikZMagics().tikz(line, FRAME_TEMPLATE, local_ns=local_ns)
+
+    # Assert
+    assert res is None
+    assert capsys.readouterr().err.startswith(expected_err)
+    animation_mock.assert_not_called()
@@ -0,0 +1,205 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from jupyter_tikz import TexDocument, TexFragment
+from jupyter_tikz.__main__ import main
+from tests.conftest import *
+
+
+@pytest.fixture
+def run_latex_mock(mocker):
+    def run_latex(self, save_image=None, **kwargs):
+        _ = kwargs
+        if "FAIL" in self.full_latex:
+            return None
+        Path(save_image).parent.mkdir(parents=True, exist_ok=True)
+        Path(save_image).write_text(self.full_latex)
+        return "image"
+
+    return mocker.patch.object(
+        TexDocument, "run_latex", side_effect=run_latex, autospec=True
+    )
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "figs").mkdir()
+    (tmp_path / "figs" / "a.tikz").write_text(TIKZ_CODE)
+    (tmp_path / "figs" / "b.tikz").write_text(EXAMPLE_TIKZ_BASIC_STANDALONE)
+    (tmp_path / "figs" / "c.tex").write_text(EXAMPLE_GOOD_TEX)
+    return tmp_path / "figs"
+
+
+def test_cli_renders_sources(run_latex_mock, sources, capsys):
+    # Act
+    res = main(["figs/*.tikz", "figs/*.tex", "-j", "2"])
+
+    # Assert
+    assert res == 0
+    assert (sources / "a.svg").exists()
+    assert (sources / "b.svg").exists()
+    assert (sources / "c.svg").read_text() == EXAMPLE_GOOD_TEX.strip()
+    assert "\\documentclass{standalone}" in (sources / "a.svg").read_text()
+    _, err = capsys.readouterr()
+    assert "3 rendered, 0 up to date, 0 failed." in err
+
+
+def test_cli_uses_cache_and_options(run_latex_mock, sources):
+    # Act
+    main(["figs/a.tikz", "-r", "--dpi=300", "-tp=lualatex", "-o", "out"])
+
+    # Assert
+    kwargs = run_latex_mock.call_args.kwargs
+    assert kwargs["cache"]
+    assert kwargs["rasterize"]
+    assert kwargs["dpi"] == 300
+    assert kwargs["tex_program"] == "lualatex"
+    assert kwargs["save_image"] == str(sources.parent / "out" / "a.png")
+
+
+def test_cli_no_cache(run_latex_mock, sources):
+    # Act
+    main(["figs/a.tikz", "--no-cache"])
+
+    # Assert
+    assert not run_latex_mock.call_args.kwargs["cache"]
+
+
+@pytest.mark.parametrize(
+    "args, expected_class",
+    [
+        ([], TexFragment),
+        (["-f"], TexDocument),
+        (["-as=full"], TexDocument),
+    ],
+)
+def test_cli_input_type(run_latex_mock, sources, args, expected_class):
+    # Act
+    main(["figs/a.tikz"] + args)
+
+    # Assert
+    assert type(run_latex_mock.call_args.args[0]) is expected_class
+
+
+def test_cli_skips_up_to_date_outputs(run_latex_mock, sources, capsys):
+    # Arrange
+    main(["figs/*.tikz"])
+    capsys.readouterr()
+    (sources / "b.tikz").write_text(EXAMPLE_TIKZ_BASIC_STANDALONE + "\n% changed")
+    os.utime(sources / "a.svg", (0, 0))  # Output older than its source
+
+    # Act
+    res = main(["figs/*.tikz"])
+
+    # Assert
+    assert res == 0
+    assert run_latex_mock.call_count == 4
+    _, err = capsys.readouterr()
+    assert "2 rendered, 0 up to date, 0 failed." in err
+
+
+def test_cli_resumes_from_journal(run_latex_mock, sources, capsys):
+    # Arrange
+    main(["figs/*.tikz"])
+    capsys.readouterr()
+
+    # Act
+    res = main(["figs/*.tikz"])
+
+    # Assert
+    assert res == 0
+    assert run_latex_mock.call_count == 2
+    _, err = capsys.readouterr()
+    assert "0 rendered, 2 up to date, 0 failed." in err
+
+
+def test_cli_options_change_invalidates_journal(run_latex_mock, sources):
+    # Arrange
+    main(["figs/a.tikz"])
+
+    # Act
+    main(["figs/a.tikz", "-sc=2"])
+
+    # Assert
+    assert run_latex_mock.call_count == 2
+
+
+def test_cli_force(run_latex_mock, sources):
+    # Arrange
+    main(["figs/a.tikz"])
+
+    # Act
+    main(["figs/a.tikz", "--force"])
+
+    # Assert
+    assert run_latex_mock.call_count == 2
+
+
+def test_cli_failures(run_latex_mock, sources, capsys):
+    # Arrange
+    (sources / "bad.tikz").write_text("FAIL")
+
+    # Act
+    res = main(["figs/*.tikz", "missing/*.tikz"])
+
+    # Assert
+    assert res == 1
+    _, err = capsys.readouterr()
+    assert "2 rendered, 0 up to date, 2 failed." in err
+    assert f"Failed: {sources / 'bad.tikz'}" in err
+    assert "No files match `missing/*.tikz`." in err
+
+    journal = [
+        json.loads(line)
+        for line in Path(".jupyter-tikz-journal.jsonl").read_text().splitlines()
+    ]
+    assert {entry["status"] for entry in journal} == {"done", "failed"}
+
+
+def test_cli_broken_template(run_latex_mock, sources, capsys):
+    # Arrange
+    (sources / "broken.tikz").write_text(r"\draw (0,0) circle ((* x ));")
+
+    # Act
+    res = main(["figs/*.tikz"])
+
+    # Assert
+    assert res == 1
+    _, err = capsys.readouterr()
+    assert f"{sources / 'broken.tikz'}: " in err
+    assert "2 rendered, 0 up to date, 1 failed." in err
+    assert f"Failed: {sources / 'broken.tikz'}" in err
+    journal = [
+        json.loads(line)
+        for line in Path(".jupyter-tikz-journal.jsonl").read_text().splitlines()
+    ]
+    assert len(journal) == 3  # Compacted
+    assert {entry["source"]: entry["status"] for entry in journal}[
+        str(sources / "broken.tikz")
+    ] == "failed"
+
+
+def test_cli_failed_sources_are_retried(run_latex_mock, sources):
+    # Arrange
+    (sources / "bad.tikz").write_text("FAIL")
+    main(["figs/bad.tikz"])
+
+    # Act
+    res = main(["figs/bad.tikz"])
+
+    # Assert
+    assert res == 1
+    assert run_latex_mock.call_count == 2
+
+
+def test_cli_invalid_fragment_options(run_latex_mock, sources, capsys):
+    # Act
+    res = main(["figs/a.tikz", "-p=preamble", "-t=amsmath"])
+
+    # Assert
+    assert res == 1
+    run_latex_mock.assert_not_called()
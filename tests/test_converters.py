@@ -0,0 +1,192 @@
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from jupyter_tikz import TexDocument, TikZMagics, converters, jupyter_tikz
+from jupyter_tikz.converters import _CONVERTERS, _converter_name, convert
+from jupyter_tikz.jupyter_tikz import _image_cache_key
+from tests.conftest import *
+
+
+@pytest.mark.parametrize(
+    "converter, image_format, expected_command",
+    [
+        ("pdftocairo", "svg", "pdftocairo -svg in.pdf out.svg"),
+        ("pdftocairo", "png", "pdftocairo -png -singlefile -gray -r 300 in.pdf out"),
+        ("pdftoppm", "png", "pdftoppm -png -singlefile -r 300 -gray in.pdf out"),
+        ("dvisvgm", "svg", "dvisvgm --pdf --page=1 --no-fonts --output=out.svg in.pdf"),
+    ],
+)
+def test_convert_commands(converter, image_format, expected_command):
+    # Arrange
+    commands = []
+
+    # Act
+    res = convert(
+        converter,
+        Path("in.pdf"),
+        Path(f"out.{image_format}"),
+        300,
+        True,
+        lambda command: commands.append(command) or 0,
+    )
+
+    # Assert
+    assert res == 0
+    assert commands == [expected_command]
+
+
+def test_converter_name_from_env(monkeypatch):
+    # Arrange
+    monkeypatch.setenv("JUPYTER_TIKZ_CONVERTER", "pdftoppm")
+
+    # Act & Assert
+    assert _converter_name(None, "png") == "pdftoppm"
+    assert _converter_name("pymupdf", "png") == "pymupdf"
+
+
+def test_converter_name_default(monkeypatch):
+    # Arrange
+    monkeypatch.delenv("JUPYTER_TIKZ_CONVERTER", raising=False)
+
+    # Act & Assert
+    assert _converter_name(None, "svg") == "pdftocairo"
+
+
+@pytest.mark.parametrize(
+    "converter, image_format, expected_err",
+    [
+        ("inkscape", "svg", "`inkscape` is not a valid converter."),
+        ("pdftoppm", "svg", "`pdftoppm` cannot output SVG images."),
+        ("dvisvgm", "png", "`dvisvgm` cannot output PNG images."),
+    ],
+)
+def test_converter_name_errors(converter, image_format, expected_err):
+    # Act & Assert
+    with pytest.raises(ValueError, match=expected_err):
+        _converter_name(converter, image_format)
+
+
+def test_image_cache_key_depends_on_converter():
+    # Act & Assert
+    assert _image_cache_key("key", "svg", 96, False) == "key.svg"
+    assert _image_cache_key("key", "svg", 96, False, "dvisvgm") == "key.dvisvgm.svg"
+
+
+def test_run_latex_converter(run_mock):
+    # Act
+    res = TexDocument(EXAMPLE_GOOD_TEX).run_latex(rasterize=True, converter="pdftoppm")
+
+    # Assert
+    assert res is not None
+    assert run_mock.call_args.args[0].startswith("pdftoppm -png")
+
+
+def test_run_latex_converter_env(run_mock, monkeypatch):
+    # Arrange
+    monkeypatch.setenv("JUPYTER_TIKZ_CONVERTER", "dvisvgm")
+
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex()
+
+    # Assert
+    assert run_mock.call_args.args[0].startswith("dvisvgm --pdf")
+
+
+def test_run_latex_invalid_converter(run_mock):
+    # Act & Assert
+    with pytest.raises(ValueError, match="cannot output SVG"):
+        TexDocument(EXAMPLE_GOOD_TEX).run_latex(converter="pdftoppm")
+    run_mock.assert_not_called()
+
+
+def test_pymupdf_converter_does_not_spawn(run_mock, mocker):
+    # Arrange
+    pixmap = mocker.MagicMock()
+    pixmap.save.side_effect = lambda path: Path(path).write_bytes(b"png")
+    pymupdf = mocker.MagicMock()
+    pymupdf.open.return_value.__enter__.return_value = [
+        mocker.MagicMock(**{"get_pixmap.return_value": pixmap})
+    ]
+    mocker.patch.object(converters, "_import_pymupdf", return_value=pymupdf)
+
+    # Act
+    res = TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        rasterize=True, dpi=200, converter="pymupdf"
+    )
+
+    # Assert
+    assert res.data == b"png"
+    assert run_mock.call_count == 1  # Only TeX
+    page = pymupdf.open.return_value.__enter__.return_value[0]
+    page.get_pixmap.assert_called_once_with(dpi=200, alpha=True)
+
+
+def test_pymupdf_converter_error(tmp_path, mocker, capsys):
+    # Arrange
+    pymupdf = mocker.MagicMock()
+    pymupdf.open.side_effect = RuntimeError("cannot open broken document")
+    mocker.patch.object(converters, "_import_pymupdf", return_value=pymupdf)
+
+    # Act
+    res = convert("pymupdf", tmp_path / "in.pdf", tmp_path / "out.svg", 96, False, None)
+
+    # Assert
+    assert res == 1
+    assert "cannot open broken document" in capsys.readouterr().err
+
+
+def test_magic_invalid_converter(mocker, capsys):
+    # Arrange
+    run_latex_mock = mocker.patch.object(TexDocument, "run_latex")
+
+    # Act
+    res = TikZMagics().tikz("-cv=pdftoppm", EXAMPLE_GOOD_TEX, local_ns={})
+
+    # Assert
+    assert res is None
+    assert capsys.readouterr().err.startswith("`pdftoppm` cannot output SVG images.")
+    run_latex_mock.assert_not_called()
+
+
+def _available(converter):
+    if converter == "pymupdf":
+        try:
+            converters._import_pymupdf()
+        except ImportError:
+            return False
+        return True
+    return shutil.which(converter) is not None
+
+
+@pytest.mark.needs_latex
+@pytest.mark.parametrize("image_format", ["svg", "png"])
+def test_benchmark_converters(tmp_path, monkeypatch, image_format):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    tex = TexDocument(EXAMPLE_GOOD_TEX)
+    tex_path = tmp_path / f"{tex._hex_hash}.tex"
+    tex_path.write_text(tex.full_latex)
+    assert tex._compile(tex_path, "pdflatex", None, False) == 0
+    names = [
+        name
+        for name, converter in _CONVERTERS.items()
+        if image_format in converter["formats"] and _available(name)
+    ]
+
+    # Act
+    timings = {}
+    for name in names:
+        start = time.perf_counter()
+        for _ in range(5):
+            res = tex._convert(tex_path, image_format == "png", 96, False, False, name)
+            assert res == 0
+        timings[name] = (time.perf_counter() - start) / 5
+
+    # Assert
+    for name, duration in sorted(timings.items(), key=lambda item: item[1]):
+        print(f"{image_format} {name}: {duration * 1000:.1f} ms", file=sys.stderr)
+    assert tex_path.with_suffix(f".{image_format}").stat().st_size > 0
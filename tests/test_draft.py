@@ -0,0 +1,174 @@
+import threading
+
+import pytest
+
+from jupyter_tikz import TexDocument, TexFragment, TikZMagics, magics
+from tests.conftest import *
+
+PGFPLOTS_CODE = r"""
+\begin{axis}
+    \addplot3[surf, shader=interp, samples=100] {x^2 - y^2};
+\end{axis}
+"""
+
+
+@pytest.fixture
+def run_latex_mock(mocker):
+    def run_latex(self, **kwargs):
+        _ = kwargs
+        return "draft" if "every axis plot post" in self.full_latex else "final"
+
+    return mocker.patch.object(
+        TexDocument, "run_latex", side_effect=run_latex, autospec=True
+    )
+
+
+@pytest.fixture
+def display_mock(mocker):
+    return mocker.patch.object(magics.display, "display")
+
+
+def test_draft():
+    # Arrange
+    tex = TexDocument(EXAMPLE_GOOD_TEX)
+
+    # Act
+    draft = tex.draft()
+
+    # Assert
+    preamble, body = draft.full_latex.split("\\begin{document}")
+    assert preamble.startswith("\\documentclass[tikz]{standalone}")
+    assert "samples=25, samples y=12, shader=flat" in preamble
+    assert (
+        "\\begin{document}" + body
+        == tex.full_latex.split("\\documentclass[tikz]{standalone}\n")[1]
+    )
+    assert draft._hex_hash != tex._hex_hash
+
+
+def test_draft_fragment():
+    # Act
+    draft = TexFragment(
+        PGFPLOTS_CODE, implicit_tikzpicture=True, tex_packages="pgfplots"
+    ).draft()
+
+    # Assert
+    assert draft.full_latex.index("\\usepackage{pgfplots}") < draft.full_latex.index(
+        "\\AtBeginDocument"
+    )
+    assert "(*" not in draft.full_latex
+
+
+def test_draft_without_document():
+    # Arrange
+    tex = TexDocument("\\draw (0,0) circle (1);")
+
+    # Act & Assert
+    assert tex.draft() is tex
+
+
+def test_magic_draft(run_latex_mock):
+    # Act
+    res = TikZMagics().tikz(
+        "-dr -r -d=300 -S=fig -st=fig -ex=pdf", EXAMPLE_GOOD_TEX, local_ns={}
+    )
+
+    # Assert
+    assert res == "draft"
+    kwargs = run_latex_mock.call_args.kwargs
+    assert kwargs["dpi"] == 48
+    assert kwargs["save_image"] is None and kwargs["save_tex"] is None
+    assert kwargs["export_formats"] is None
+
+
+def test_magic_refine(run_latex_mock, display_mock):
+    # Act
+    res = TikZMagics().tikz("-rf -S=fig", EXAMPLE_GOOD_TEX, local_ns={})
+    magics._wait_for_refines()
+
+    # Assert
+    assert res is None
+    display_mock.assert_called_once_with("draft", display_id=True)
+    display_mock.return_value.update.assert_called_once_with("final")
+    final_kwargs = run_latex_mock.call_args.kwargs
+    assert final_kwargs["save_image"] == "fig"
+    assert final_kwargs["dpi"] == 96
+
+
+def test_magic_refine_split_pictures(run_latex_mock, display_mock, mocker):
+    # Arrange
+    run_latex_mock.side_effect = lambda self, **kwargs: [
+        "draft" if "every axis plot post" in self.full_latex else "final",
+        None,
+    ]
+
+    # Act
+    TikZMagics().tikz("-rf -spl", EXAMPLE_GOOD_TEX, local_ns={})
+    magics._wait_for_refines()
+
+    # Assert
+    display_mock.assert_called_once_with("draft", display_id=True)
+    display_mock.return_value.update.assert_called_once_with("final")
+
+
+def test_magic_refine_error_keeps_draft(run_latex_mock, display_mock):
+    # Arrange
+    run_latex_mock.side_effect = lambda self, **kwargs: (
+        "draft" if "every axis plot post" in self.full_latex else None
+    )
+
+    # Act
+    TikZMagics().tikz("-rf", EXAMPLE_GOOD_TEX, local_ns={})
+    magics._wait_for_refines()
+
+    # Assert
+    display_mock.return_value.update.assert_not_called()
+
+
+def test_refines_of_previous_runs_are_skipped(run_latex_mock, display_mock, mocker):
+    # Arrange
+    started, release = threading.Event(), threading.Event()
+
+    def run_latex(self, **kwargs):
+        if "every axis plot post" in self.full_latex:
+            return "draft"
+        started.set()
+        release.wait(5)
+        return "final"
+
+    run_latex_mock.side_effect = run_latex
+    mocker.patch.object(TikZMagics, "_cell_id", return_value="cell")
+    magic = TikZMagics()
+    magic.tikz("-rf", "\\node {blocking};", local_ns={})
+    started.wait(5)
+
+    # Act
+    for text in ["first", "second"]:
+        magic.tikz("-rf", f"\\node {{{text}}};", local_ns={})
+    release.set()
+    magics._wait_for_refines()
+
+    # Assert
+    finals = [
+        call.args[0].full_latex
+        for call in run_latex_mock.call_args_list
+        if "every axis plot post" not in call.args[0].full_latex
+    ]
+    assert len(finals) == 2  # `first` was run again before it was refined
+    assert "blocking" in finals[0] and "second" in finals[1]
+
+
+@pytest.mark.needs_latex
+@pytest.mark.needs_pdftocairo
+def test_draft_renders_pgfplots(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    tex = TexFragment(PGFPLOTS_CODE, implicit_tikzpicture=True, tex_packages="pgfplots")
+
+    # Act
+    draft = tex.draft().run_latex(rasterize=True, dpi=48)
+    final = tex.run_latex(rasterize=True, dpi=48)
+
+    # Assert
+    assert draft is not None and final is not None
+    assert draft.data != final.data
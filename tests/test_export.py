@@ -0,0 +1,188 @@
+import subprocess
+import threading
+from pathlib import Path
+
+import pytest
+
+from jupyter_tikz import TexDocument, TikZMagics, jupyter_tikz
+from jupyter_tikz.__main__ import main
+from jupyter_tikz.jupyter_tikz import _export_targets
+from tests.conftest import *
+
+
+@pytest.mark.parametrize(
+    "export_formats, expected",
+    [
+        (None, []),
+        ("", []),
+        ("pdf", [("pdf", 96, "fig.pdf")]),
+        (
+            "pdf, svg,PNG@300",
+            [
+                ("pdf", 96, "fig.pdf"),
+                ("svg", 96, "fig.svg"),
+                ("png", 300, "fig-300dpi.png"),
+            ],
+        ),
+        (["png", "png@600"], [("png", 96, "fig.png"), ("png", 600, "fig-600dpi.png")]),
+    ],
+)
+def test_export_targets(tmp_path, monkeypatch, export_formats, expected):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+
+    # Act
+    res = _export_targets(export_formats, "out/fig.svg", 96)
+
+    # Assert
+    assert res == [
+        (image_format, dpi, tmp_path / "out" / name)
+        for image_format, dpi, name in expected
+    ]
+
+
+@pytest.mark.parametrize(
+    "export_formats, save_image, expected_err",
+    [
+        ("jpg", "fig", "`jpg` is not a valid export format."),
+        ("svg@300", "fig", "`svg@300` is not a valid export format."),
+        ("png@high", "fig", "`png@high` is not a valid export format."),
+        ("png", None, "Exporting needs `save_image`"),
+    ],
+)
+def test_export_targets_errors(export_formats, save_image, expected_err):
+    # Act & Assert
+    with pytest.raises(ValueError, match=expected_err):
+        _export_targets(export_formats, save_image, 96)
+
+
+def test_run_latex_exports(run_mock):
+    # Act
+    res = TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        save_image="out/fig", export_formats="pdf,svg,png@150,png@300", grayscale=True
+    )
+
+    # Assert
+    assert res.data == SVG_CODE
+    assert Path("out/fig.pdf").read_text() == "pdf"
+    assert Path("out/fig.svg").read_text() == SVG_CODE
+    assert "-gray -r 150 " in Path("out/fig-150dpi.png").read_text()
+    assert "-gray -r 300 " in Path("out/fig-300dpi.png").read_text()
+    commands = [call.args[0] for call in run_mock.call_args_list]
+    assert sum(command.startswith("pdflatex") for command in commands) == 1
+    assert not list(Path().glob("*.export-*"))  # Temporary files are removed
+
+
+def test_run_latex_exports_run_concurrently(run_mock):
+    # Arrange
+    barrier = threading.Barrier(2, timeout=5)
+
+    def run(command, **kwargs):
+        if "-r 150" in command or "-r 300" in command:
+            barrier.wait()  # Both conversions must be running at the same time
+        return render_side_effect(command, **kwargs)
+
+    run_mock.side_effect = run
+
+    # Act
+    res = TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        save_image="fig", export_formats=["png@150", "png@300"]
+    )
+
+    # Assert
+    assert res is not None
+    assert Path("fig-150dpi.png").exists() and Path("fig-300dpi.png").exists()
+
+
+def test_run_latex_exports_fall_back_to_the_default_converter(run_mock):
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        rasterize=True, converter="pdftoppm", save_image="fig", export_formats="svg"
+    )
+
+    # Assert
+    commands = [call.args[0] for call in run_mock.call_args_list]
+    assert commands[-1].startswith("pdftocairo -svg")
+    assert Path("fig.svg").read_text() == SVG_CODE
+
+
+def test_run_latex_exports_error(run_mock, capsys):
+    # Arrange
+    def run(command, **kwargs):
+        if "-r 300" in command:
+            return subprocess.CompletedProcess(command, 1, "", "Syntax Error")
+        return render_side_effect(command, **kwargs)
+
+    run_mock.side_effect = run
+
+    # Act
+    res = TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        save_image="fig", export_formats="pdf,png@300"
+    )
+
+    # Assert
+    assert res is None
+    assert "Syntax Error" in capsys.readouterr().err
+    assert Path("fig.pdf").exists()
+    assert not Path("fig-300dpi.png").exists()
+
+
+def test_run_latex_exports_resource_usage(run_mock):
+    # Arrange
+    def run(command, **kwargs):
+        result = render_side_effect(command, **kwargs)
+        result.resource_usage = {
+            "processes": 1,
+            "user_time": 0.5,
+            "system_time": 0.0,
+            "max_rss": 10,
+        }
+        return result
+
+    run_mock.side_effect = run
+    tex = TexDocument(EXAMPLE_GOOD_TEX)
+
+    # Act
+    tex.run_latex(save_image="fig", export_formats="svg,png@300")
+
+    # Assert
+    assert tex.resource_usage["export"] == {
+        "processes": 2,
+        "user_time": 1.0,
+        "system_time": 0.0,
+        "max_rss": 10,
+    }
+
+
+def test_magic_export_formats(mocker):
+    # Arrange
+    run_latex_mock = mocker.patch.object(TexDocument, "run_latex")
+
+    # Act
+    TikZMagics().tikz("-S=fig -ex=pdf,png@300", EXAMPLE_GOOD_TEX, local_ns={})
+
+    # Assert
+    assert run_latex_mock.call_args.kwargs["export_formats"] == "pdf,png@300"
+
+
+def test_magic_invalid_export_formats(mocker, capsys):
+    # Arrange
+    run_latex_mock = mocker.patch.object(TexDocument, "run_latex")
+
+    # Act
+    res = TikZMagics().tikz("-ex=pdf", EXAMPLE_GOOD_TEX, local_ns={})
+
+    # Assert
+    assert res is None
+    assert capsys.readouterr().err.startswith("Exporting needs `save_image`")
+    run_latex_mock.assert_not_called()
+
+
+def test_cli_invalid_export_formats(tmp_path, monkeypatch, capsys):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+
+    # Act & Assert
+    with pytest.raises(SystemExit):
+        main(["fig.tikz", "-ex=jpg"])
+    assert "`jpg` is not a valid export format." in capsys.readouterr().err
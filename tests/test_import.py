@@ -0,0 +1,76 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import jupyter_tikz
+from jupyter_tikz import jupyter_tikz as core
+from jupyter_tikz import magics
+
+ROOT_DIR = Path(__file__).parents[1]
+HEAVY_MODULES = ["jinja2", "IPython", "numpy"]
+# Importing IPython alone takes longer than this
+IMPORT_TIME_BUDGET = 0.25  # s
+
+
+def run_python(code: str) -> str:
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "import jupyter_tikz",
+        "from jupyter_tikz import TexFragment; TexFragment(r'\\draw (0,0) circle (1);')",
+        "from jupyter_tikz.__main__ import _build_parser; _build_parser()",
+    ],
+)
+def test_heavy_modules_not_imported(code):
+    # Act
+    res = run_python(
+        f"{code}\nimport json, sys\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+
+    # Assert
+    assert json.loads(res) == []
+
+
+def test_jinja_imported_for_templates():
+    # Act
+    res = run_python(
+        "from jupyter_tikz import TexDocument\n"
+        "TexDocument('(* x *)', ns={'x': 1})\n"
+        "import sys; print('jinja2' in sys.modules)"
+    )
+
+    # Assert
+    assert res.strip() == "True"
+
+
+def test_import_time():
+    # Arrange
+    code = "import time; t = time.perf_counter(); import jupyter_tikz; print(time.perf_counter() - t)"
+
+    # Act
+    res = min(float(run_python(code)) for _ in range(3))
+
+    # Assert
+    assert res < IMPORT_TIME_BUDGET
+
+
+def test_magic_lazily_exported():
+    # Act & Assert
+    assert jupyter_tikz.TikZMagics is magics.TikZMagics
+    assert core.TikZMagics is magics.TikZMagics
+    with pytest.raises(AttributeError):
+        jupyter_tikz.NotDefined
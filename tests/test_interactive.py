@@ -0,0 +1,265 @@
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from jupyter_tikz import TexFragment, interactive, jupyter_tikz
+from jupyter_tikz.interactive import (
+    _neighbour_values,
+    _neighbours,
+    _RenderScheduler,
+    interact_tikz,
+)
+
+TIMEOUT = 5  # s
+
+
+class Recorder:
+    """Renders instantly unless blocked, and records renders and shown results."""
+
+    def __init__(self):
+        self.rendered = []
+        self.shown = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.result_shown = threading.Event()
+
+    def render(self, params):
+        self.started.set()
+        self.release.wait(TIMEOUT)
+        self.rendered.append(params["x"])
+        return f"image {params['x']}"
+
+    def show(self, result):
+        self.shown.append(result)
+        self.result_shown.set()
+
+    def wait_shown(self):
+        assert self.result_shown.wait(TIMEOUT)
+        self.result_shown.clear()
+
+
+@pytest.fixture
+def recorder():
+    return Recorder()
+
+
+@pytest.fixture
+def scheduler(recorder):
+    scheduler = _RenderScheduler(recorder.render, recorder.show, debounce=0.05)
+    yield scheduler
+    scheduler.close()
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_request_is_debounced(scheduler, recorder):
+    # Act
+    for x in range(5):
+        scheduler.request({"x": x})
+    recorder.wait_shown()
+
+    # Assert
+    assert recorder.rendered == [4]
+    assert recorder.shown == ["image 4"]
+
+
+def test_request_cached(scheduler, recorder):
+    # Arrange
+    scheduler.request({"x": 1})
+    recorder.wait_shown()
+
+    # Act
+    scheduler.request({"x": 1})
+
+    # Assert
+    assert recorder.shown == ["image 1", "image 1"]  # Shown at once
+    assert recorder.rendered == [1]
+
+
+def test_obsolete_render_is_not_shown(scheduler, recorder):
+    # Arrange
+    recorder.release.clear()
+    scheduler.request({"x": 1})
+    assert recorder.started.wait(TIMEOUT)
+
+    # Act
+    scheduler.request({"x": 2})
+    recorder.release.set()
+    recorder.wait_shown()
+
+    # Assert
+    assert recorder.shown == ["image 2"]
+    assert recorder.rendered == [1, 2]
+    assert "image 1" in scheduler._cache.values()  # Kept for later
+
+
+def test_queued_renders_are_cancelled(scheduler, recorder):
+    # Arrange
+    recorder.release.clear()
+    scheduler.request({"x": 1}, neighbours=[{"x": 0}, {"x": 2}])
+    assert recorder.started.wait(TIMEOUT)
+    scheduler.prefetch([{"x": 3}], scheduler._generation)
+
+    # Act
+    scheduler.request({"x": 5})
+    recorder.release.set()
+    recorder.wait_shown()
+
+    # Assert
+    assert recorder.rendered == [1, 5]
+
+
+@pytest.mark.skipif(os.name != "posix", reason="Needs process groups")
+def test_running_prefetch_is_terminated(recorder):
+    # Arrange
+    compiling = threading.Event()
+
+    def render(params):
+        if params["x"] == 0:  # A slow prefetch
+            compiling.set()
+            jupyter_tikz._run_process("sleep 10")
+        return recorder.render(params)
+
+    scheduler = _RenderScheduler(render, recorder.show, debounce=0.05)
+    scheduler.request({"x": 1}, neighbours=[{"x": 0}])
+    recorder.wait_shown()
+    assert compiling.wait(TIMEOUT)
+    start = time.monotonic()
+
+    # Act
+    scheduler.request({"x": 2})
+    recorder.wait_shown()
+    scheduler.close()
+
+    # Assert
+    assert time.monotonic() - start < 5  # Not delayed by the prefetch
+    assert recorder.shown == ["image 1", "image 2"]
+    assert "image 0" not in scheduler._cache.values()  # Not rendered
+
+
+def test_request_while_a_render_starts(mocker, scheduler, recorder):
+    # Arrange
+    starting, release = threading.Event(), threading.Event()
+
+    def slow_scope():
+        starting.set()  # Running, but without a scope yet
+        release.wait(TIMEOUT)
+        return jupyter_tikz._CancelScope()
+
+    mocker.patch.object(interactive, "_CancelScope", side_effect=slow_scope)
+    scheduler.request({"x": 1})
+    assert starting.wait(TIMEOUT)
+
+    # Act
+    scheduler.request({"x": 2})
+    release.set()
+    recorder.wait_shown()
+
+    # Assert
+    assert recorder.shown == ["image 2"]
+
+
+def test_neighbours_are_prefetched(scheduler, recorder):
+    # Arrange
+    scheduler.request({"x": 1}, neighbours=[{"x": 0}, {"x": 2}])
+    recorder.wait_shown()
+    wait_until(lambda: len(scheduler._cache) == 3)
+
+    # Act
+    scheduler.request({"x": 2})
+
+    # Assert
+    assert sorted(recorder.rendered) == [0, 1, 2]
+    assert recorder.shown == ["image 1", "image 2"]
+
+
+def test_prefetch_skipped_when_obsolete(scheduler, recorder):
+    # Act
+    scheduler.prefetch([{"x": 0}], generation=-1)
+
+    # Assert
+    assert scheduler._running == {}
+
+
+def test_cache_size(recorder):
+    # Arrange
+    scheduler = _RenderScheduler(recorder.render, recorder.show, 0, cache_size=2)
+
+    # Act
+    for x in range(3):
+        scheduler.request({"x": x})
+        recorder.wait_shown()
+    scheduler.close()
+
+    # Assert
+    assert list(scheduler._cache.values()) == ["image 1", "image 2"]
+
+
+@pytest.mark.parametrize(
+    "widget, expected_values",
+    [
+        (SimpleNamespace(value=5, min=0, max=10, step=1), [4, 6]),
+        (SimpleNamespace(value=0, min=0, max=10, step=2), [2]),
+        (SimpleNamespace(value=0.3, min=0.0, max=1.0, step=0.1), [0.2, 0.4]),
+        (SimpleNamespace(value="b", index=1, _options_values=("a", "b")), ["a"]),
+        (SimpleNamespace(value=None, index=None, _options_values=("a",)), []),
+        (SimpleNamespace(value=True), [False]),
+        (SimpleNamespace(value="text"), []),
+    ],
+)
+def test_neighbour_values(widget, expected_values):
+    # Act & Assert
+    assert _neighbour_values(widget) == expected_values
+
+
+def test_neighbours():
+    # Arrange
+    widgets = {
+        "x": SimpleNamespace(value=1, min=0, max=1, step=1),
+        "y": SimpleNamespace(value=True),
+    }
+
+    # Act
+    res = _neighbours(widgets, {"x": 1, "y": True})
+
+    # Assert
+    assert res == [{"x": 0, "y": True}, {"x": 1, "y": False}]
+
+
+def test_interact_tikz(mocker):
+    # Arrange
+    ipywidgets = pytest.importorskip("ipywidgets")
+    rendered = threading.Event()
+
+    def run_latex(self, **kwargs):
+        _ = kwargs
+        rendered.set()
+        return None if "FAIL" in self.full_latex else "image"
+
+    mocker.patch.object(TexFragment, "run_latex", run_latex)
+
+    # Act
+    box = interact_tikz(
+        r"\draw (0,0) circle ((* r *));",
+        debounce=0,
+        prefetch=False,
+        r=(1, 5),
+        label=ipywidgets.Text(value="a"),
+    )
+
+    # Assert
+    assert rendered.wait(TIMEOUT)
+    slider, text, output = box.children
+    assert isinstance(slider, ipywidgets.IntSlider)
+    assert slider.description == "r"
+    assert text.description == "label"
+    assert isinstance(output, ipywidgets.Output)
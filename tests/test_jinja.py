@@ -1,7 +1,9 @@
+from pathlib import Path
+
 import pytest
 from IPython.display import SVG
 
-from jupyter_tikz import TexDocument
+from jupyter_tikz import TexDocument, TexFragment, jupyter_tikz
 from tests.conftest import *
 
 EXAMPLE_TIKZ_JINJA_TEMPLATE = """\\begin{tikzpicture}
@@ -138,3 +140,220 @@ def test_jinja_extends_template(tmpdir, monkeypatch):
 
     # Assert
     assert f"{tex_document}".strip() == EXAMPLE_TIKZ_JINJA_EXTENDED_TEMPLATE.strip()
+
+
+# =========================== filters ===========================
+
+
+def test_coordinates_filter():
+    # Arrange
+    np = pytest.importorskip("numpy")
+    code = r"\addplot (* x | coordinates(y, precision=2) *);"
+    x = np.array([0, 1, 2])
+    y = x**2
+
+    # Act
+    tex_document = TexDocument(code, ns={"x": x, "y": y})
+
+    # Assert
+    assert (
+        str(tex_document)
+        == r"\addplot coordinates {(0.00,0.00) (1.00,1.00) (2.00,4.00)};"
+    )
+
+
+@pytest.mark.parametrize(
+    "data_factory",
+    [
+        lambda np: np.array([[0, 0], [1, 1], [2, 4]]),
+        lambda np: [(0, 0), (1, 1), (2, 4)],
+        lambda np: np.array([0, 1, 4]),
+    ],
+)
+def test_coordinates_filter_data_shapes(data_factory):
+    # Arrange
+    np = pytest.importorskip("numpy")
+    code = r"(* data | coordinates(precision=1) *)"
+
+    # Act
+    tex_document = TexDocument(code, ns={"data": data_factory(np)})
+
+    # Assert
+    assert str(tex_document) == "coordinates {(0.0,0.0) (1.0,1.0) (2.0,4.0)}"
+
+
+def test_table_filter():
+    # Arrange
+    np = pytest.importorskip("numpy")
+    code = r"\addplot (* data | table(precision=1) *);"
+    data = np.array([[0, 0, 1], [1, 1, 2]])
+
+    # Act
+    tex_document = TexDocument(code, ns={"data": data})
+
+    # Assert
+    assert str(tex_document) == "\\addplot table {\n0.0 0.0 1.0\n1.0 1.0 2.0\n};"
+
+
+def test_table_filter_shapes_have_different_cache_keys():
+    # Arrange
+    np = pytest.importorskip("numpy")
+    code = r"\addplot (* data | table(precision=0) *);"
+    data = np.arange(6)
+
+    # Act
+    keys = {
+        TexDocument(code, ns={"data": data.reshape(shape)})._cache_key("pdflatex", None)
+        for shape in [(3, 2), (2, 3)]
+    }
+
+    # Assert
+    assert len(keys) == 2
+
+
+@pytest.mark.parametrize("method", ["lttb", "minmax"])
+def test_decimation_preserves_extremes(method):
+    # Arrange
+    np = pytest.importorskip("numpy")
+    x = np.linspace(0, 1, 100_000)
+    y = np.sin(2 * np.pi * 5 * x)
+    y[12_345] = 10  # Spike
+
+    # Act
+    tex_document = TexDocument(
+        f"(* x | table(y, max_points=500, method='{method}') *)",
+        ns={"x": x, "y": y},
+    )
+
+    # Assert
+    rows = str(tex_document).splitlines()[1:-1]
+    assert len(rows) <= 500
+    assert rows[0] == "0.0000 0.0000"
+    assert rows[-1].startswith("1.0000")
+    assert any(row.endswith(" 10.0000") for row in rows)
+    assert any(row.endswith(" -1.0000") for row in rows)
+
+
+def test_decimation_not_needed():
+    # Arrange
+    np = pytest.importorskip("numpy")
+    data = np.array([0, 1, 4])
+
+    # Act
+    tex_document = TexDocument(
+        "(* data | coordinates(precision=0, max_points=10) *)", ns={"data": data}
+    )
+
+    # Assert
+    assert str(tex_document) == "coordinates {(0,0) (1,1) (2,4)}"
+
+
+def test_decimation_invalid_method():
+    # Arrange
+    np = pytest.importorskip("numpy")
+    data = np.arange(10)
+
+    # Act & Assert
+    with pytest.raises(ValueError, match="not a valid decimation method"):
+        TexDocument(
+            "(* data | coordinates(max_points=5, method='x') *)", ns={"data": data}
+        )
+
+
+# =========================== expressions ===========================
+
+
+def test_evaluate_filter():
+    # Arrange
+    pytest.importorskip("numpy")
+    code = r"\addplot (* 'x^2 - 1' | evaluate(domain='0:2', samples=3) | coordinates(precision=1) *);"
+
+    # Act
+    tex_document = TexDocument(code, ns={})
+
+    # Assert
+    assert (
+        str(tex_document) == r"\addplot coordinates {(0.0,-1.0) (1.0,0.0) (2.0,3.0)};"
+    )
+
+
+def test_evaluate_global():
+    # Arrange
+    pytest.importorskip("numpy")
+    code = "(* evaluate('3', domain=(0, 1), samples=2) | table(precision=0) *)"
+
+    # Act
+    tex_document = TexDocument(code, ns={})
+
+    # Assert
+    assert str(tex_document) == "table {\n0 3\n1 3\n}"
+
+
+@pytest.mark.parametrize(
+    "expression, expected",
+    [
+        ("sin(x)", [0.0, 1.0, 0.0]),  # Degrees, as in pgfmath
+        ("sin(deg(rad(x)))", [0.0, 1.0, 0.0]),
+        ("asin(sin(x))", [0.0, 90.0, 0.0]),
+        ("\\x^2/90^2", [0.0, 1.0, 4.0]),
+        ("2^2^-1 * x/x", [float("nan"), 2**0.5, 2**0.5]),
+        ("mod(x, 100) + max(x, 90) - min(x, 90)", [90.0, 90.0, 80.0 + 90.0]),
+        ("(x > 45) * ln(e)", [0.0, 1.0, 1.0]),
+    ],
+)
+def test_evaluate_pgfmath(expression, expected):
+    # Arrange
+    np = pytest.importorskip("numpy")
+
+    # Act
+    points = jupyter_tikz._evaluate_expression(expression, "0:180", 3)
+
+    # Assert
+    np.testing.assert_allclose(points[:, 0], [0, 90, 180])
+    np.testing.assert_allclose(points[:, 1], expected, atol=1e-12)
+
+
+@pytest.mark.parametrize(
+    "expression, expected_err",
+    [
+        ("__import__('os')", "`__import__` is not supported"),
+        ("y + 1", "`y` is not supported"),
+        ("x.real", "is not a valid expression"),
+        ("x[0]", "is not a valid expression"),
+        ("'x'", "is not a valid expression"),
+        ("x +", "is not a valid expression"),
+    ],
+)
+def test_evaluate_invalid_expressions(expression, expected_err):
+    # Arrange
+    pytest.importorskip("numpy")
+
+    # Act & Assert
+    with pytest.raises(ValueError, match=expected_err):
+        jupyter_tikz._evaluate_expression(expression)
+
+
+def test_plot_expression():
+    # Arrange
+    pytest.importorskip("numpy")
+
+    # Act
+    res = TexFragment.plot_expression("t^3", domain=(-1, 1), samples=3, variable="t")
+
+    # Assert
+    assert res == "coordinates {(-1.0000,-1.0000) (0.0000,0.0000) (1.0000,1.0000)}"
+
+
+def test_plot_expression_file(tmp_path, monkeypatch):
+    # Arrange
+    pytest.importorskip("numpy")
+    monkeypatch.chdir(tmp_path)
+
+    # Act
+    res = TexFragment.plot_expression(
+        "1/x", "-1:1", 3, precision=1, file="data/inv.dat"
+    )
+
+    # Assert
+    assert res == "table {data/inv.dat}"
+    assert Path("data/inv.dat").read_text() == "-1.0 -1.0\n0.0 inf\n1.0 1.0\n"
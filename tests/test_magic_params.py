@@ -436,3 +436,41 @@ def test_raise_deprecated_args(tikz_magic_mock, capsys, args, expected_err):
     _, err = capsys.readouterr()
     assert f"{expected_err}\n" == err
     assert res is None
+
+
+@pytest.mark.parametrize(
+    "parent, expected_cell_id",
+    [
+        ({"metadata": {"cellId": "abc"}}, "abc"),
+        ({"metadata": {}}, None),
+        ({}, None),
+    ],
+)
+def test_cell_id(mocker, parent, expected_cell_id):
+    # Arrange
+    tikz_magic = TikZMagics()
+    tikz_magic.shell = mocker.Mock()
+    tikz_magic.shell.kernel.get_parent.return_value = parent
+
+    # Act
+    res = tikz_magic._cell_id()
+
+    # Assert
+    assert res == expected_cell_id
+
+
+def test_cell_id_without_kernel():
+    # Act & Assert
+    assert TikZMagics()._cell_id() is None
+
+
+def test_magic_passes_cell_id(tikz_magic_mock, mocker):
+    # Arrange
+    mocker.patch.object(TikZMagics, "_cell_id", return_value="abc")
+
+    # Act
+    tikz_magic_mock.tikz("-mp=2", TIKZ_CODE)
+
+    # Assert
+    assert TexDocument.run_latex.call_args.kwargs["aux_key"] == "abc"
+    assert TexDocument.run_latex.call_args.kwargs["max_passes"] == 2
@@ -0,0 +1,216 @@
+import json
+import subprocess
+
+import pytest
+
+from jupyter_tikz import TexDocument, jupyter_tikz, metrics
+from tests.conftest import *
+
+
+@pytest.fixture
+def metrics_path(tmp_path, monkeypatch):
+    def set_path(name):
+        path = tmp_path / name
+        monkeypatch.setenv("JUPYTER_TIKZ_METRICS", str(path))
+        return path
+
+    return set_path
+
+
+def read_records(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def read_samples(path):
+    return {
+        key: float(value)
+        for key, value in (
+            line.rsplit(" ", 1)
+            for line in path.read_text().splitlines()
+            if not line.startswith("#")
+        )
+    }
+
+
+def test_metrics_disabled(run_mock, tmp_path):
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex()
+
+    # Assert
+    assert metrics._record() is None
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["work"]
+
+
+def test_metrics_json_lines(run_mock, metrics_path):
+    # Arrange
+    path = metrics_path("metrics.jsonl")
+    tex = TexDocument(EXAMPLE_GOOD_TEX)
+
+    # Act
+    tex.run_latex(cache=True)
+    tex.run_latex(cache=True, rasterize=True)
+
+    # Assert
+    first, second = read_records(path)
+    assert first["hash"] == tex._hex_hash
+    assert first["engine"] == "pdflatex"
+    assert first["format"] == "svg"
+    assert first["status"] == "ok"
+    assert first["renderer"] == "local"
+    assert (first["pdf_cache"], first["image_cache"]) == ("miss", "miss")
+    assert set(first["stages"]) == {"tex", "convert", "save"}
+    assert first["tex_passes"] == 1
+    assert first["output_bytes"] == len(SVG_CODE)
+    assert (second["pdf_cache"], second["image_cache"]) == ("hit", "miss")
+    assert "tex" not in second["stages"]
+    assert second["output_bytes"] == len(run_mock.call_args.args[0])  # The command
+
+
+def test_metrics_failure(run_mock, metrics_path, capsys):
+    # Arrange
+    path = metrics_path("metrics.jsonl")
+    run_mock.side_effect = lambda command, **kwargs: subprocess.CompletedProcess(
+        command, 0 if command.startswith("pdftocairo") else 1, "", "error"
+    )
+
+    # Act
+    res = TexDocument(EXAMPLE_GOOD_TEX).run_latex()
+
+    # Assert
+    (record,) = read_records(path)
+    assert res is None
+    assert record["status"] == "failed"
+    assert record["failed_stage"] == "tex"
+    assert "output_bytes" not in record
+    assert "error" in capsys.readouterr().err
+
+
+def test_metrics_exception(run_mock, metrics_path):
+    # Arrange
+    path = metrics_path("metrics.jsonl")
+    run_mock.side_effect = OSError("boom")
+
+    # Act
+    with pytest.raises(OSError):
+        TexDocument(EXAMPLE_GOOD_TEX).run_latex()
+
+    # Assert
+    (record,) = read_records(path)
+    assert record["failed_stage"] == "exception"
+    assert metrics._record() is None
+
+
+def test_metrics_prometheus(run_mock, metrics_path):
+    # Arrange
+    path = metrics_path("jupyter_tikz.prom")
+    tex = TexDocument(EXAMPLE_GOOD_TEX)
+
+    # Act
+    tex.run_latex(cache=True)
+    tex.run_latex(cache=True)
+
+    # Assert
+    text = path.read_text()
+    samples = read_samples(path)
+    assert "# TYPE jupyter_tikz_renders_total counter" in text
+    assert "# TYPE jupyter_tikz_stage_duration_seconds histogram" in text
+    renders = 'jupyter_tikz_renders_total{engine="pdflatex",format="svg",renderer="local",status="ok"}'
+    assert samples[renders] == 2
+    assert samples['jupyter_tikz_cache_total{entry="pdf",result="miss"}'] == 1
+    assert samples['jupyter_tikz_cache_total{entry="pdf",result="hit"}'] == 1
+    assert samples['jupyter_tikz_stage_duration_seconds_count{stage="tex"}'] == 1
+    assert (
+        samples[
+            'jupyter_tikz_render_duration_seconds_bucket{renderer="local",le="+Inf"}'
+        ]
+        == 2
+    )
+    assert samples['jupyter_tikz_output_bytes_sum{format="svg"}'] == 2 * len(SVG_CODE)
+    assert not list(path.parent.glob("*.tmp"))
+
+
+def test_metrics_prometheus_adds_up_existing_file(run_mock, metrics_path):
+    # Arrange
+    path = metrics_path("jupyter_tikz.prom")
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex()
+    before = read_samples(path)
+
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX.replace("blue", "red")).run_latex()
+
+    # Assert
+    after = read_samples(path)
+    assert set(before) <= set(after)
+    assert all(after[key] >= value for key, value in before.items())
+    assert after['jupyter_tikz_render_duration_seconds_count{renderer="local"}'] == 2
+
+
+def test_metrics_histogram_buckets():
+    # Arrange
+    record = {
+        "engine": "pdflatex",
+        "format": "png",
+        "renderer": "local",
+        "status": "ok",
+        "duration": 0.3,
+        "stages": {},
+        "output_bytes": 5000,
+    }
+
+    # Act
+    res = metrics._increments(record)
+
+    # Assert
+    buckets = {
+        key: value
+        for key, value in res.items()
+        if key.startswith("jupyter_tikz_render_duration_seconds_bucket")
+    }
+    assert (
+        'jupyter_tikz_render_duration_seconds_bucket{renderer="local",le="0.25"}'
+        not in buckets
+    )
+    assert (
+        buckets[
+            'jupyter_tikz_render_duration_seconds_bucket{renderer="local",le="0.5"}'
+        ]
+        == 1
+    )
+    assert len(buckets) == 8  # 0.5 to 60, and +Inf
+    assert res['jupyter_tikz_output_bytes_bucket{format="png",le="10000"}'] == 1
+
+
+def test_metrics_label_escaping():
+    # Act & Assert
+    assert metrics._labels(engine='C:\\tex "x"') == 'engine="C:\\\\tex \\"x\\""'
+
+
+def test_metrics_resource_usage(run_mock, metrics_path):
+    # Arrange
+    path = metrics_path("jupyter_tikz.prom")
+
+    def run(*args, **kwargs):
+        result = render_side_effect(*args, **kwargs)
+        result.resource_usage = {
+            "processes": 1,
+            "user_time": 0.25,
+            "system_time": 0.25,
+            "max_rss": 100 * 2**20,
+            "read_blocks": 0,
+            "write_blocks": 0,
+        }
+        return result
+
+    run_mock.side_effect = run
+
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex()
+
+    # Assert
+    samples = read_samples(path)
+    assert samples['jupyter_tikz_process_cpu_seconds_total{stage="tex"}'] == 0.5
+    assert samples['jupyter_tikz_process_max_rss_bytes_sum{stage="convert"}'] == (
+        100 * 2**20
+    )
+    bucket = 'jupyter_tikz_process_max_rss_bytes_bucket{stage="tex",le="134217728"}'
+    assert samples[bucket] == 1
@@ -0,0 +1,141 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from jupyter_tikz import TexDocument, TexFragment
+from jupyter_tikz.mkdocs_tikz import (
+    _find_figures,
+    define_env,
+    on_pre_page_macros,
+    render_figures,
+    replace_figures,
+)
+from tests.conftest import *
+
+PAGE = f"""# Figures
+
+```tikz
+{TIKZ_CODE}
+```
+
+```latex
+Not a figure
+```
+
+!!! example
+    ```tikz -r -d=150
+    {TIKZ_CODE.replace("blue", "red")}
+    ```
+"""
+
+FAILED_PAGE = """```tikz -f
+FAIL
+```
+"""
+
+
+@pytest.fixture
+def run_latex_mock(mocker):
+    def run_latex(self, save_image=None, **kwargs):
+        _ = kwargs
+        if "FAIL" in self.full_latex:
+            return None
+        Path(save_image).write_text(self.full_latex)
+        return "image"
+
+    return mocker.patch.object(
+        TexDocument, "run_latex", side_effect=run_latex, autospec=True
+    )
+
+
+@pytest.fixture
+def docs_dir(tmp_path):
+    (tmp_path / "usage").mkdir()
+    (tmp_path / "index.md").write_text(PAGE)
+    (tmp_path / "usage" / "page.md").write_text(PAGE + FAILED_PAGE)
+    return tmp_path
+
+
+def test_find_figures():
+    # Act
+    res = _find_figures(PAGE)
+
+    # Assert
+    assert len(res) == 2
+    first, second = (figure for _, figure in res)
+    assert isinstance(first.tex, TexFragment)
+    assert first.name.endswith(".svg")
+    assert first.tex.full_latex == TexFragment(TIKZ_CODE).full_latex
+    assert second.name.endswith(".150dpi-transp.png")
+    assert second.run_kwargs["rasterize"]
+    assert "red" in second.tex.full_latex
+
+
+def test_find_figures_invalid_options():
+    # Act
+    res = _find_figures("```tikz --not-an-option\ncode\n```")
+
+    # Assert
+    assert res[0][1] is None
+
+
+def test_render_figures(run_latex_mock, docs_dir):
+    # Act
+    failed = render_figures(docs_dir, jobs=2)
+
+    # Assert
+    assert failed == 1
+    rendered = sorted(path.suffix for path in (docs_dir / "assets/tikz").iterdir())
+    assert rendered == [".png", ".svg"]
+    # Identical figures of different pages are rendered once
+    assert run_latex_mock.call_count == 3
+    assert all(call.kwargs["cache"] for call in run_latex_mock.call_args_list)
+
+
+def test_render_figures_only_renders_new_figures(run_latex_mock, docs_dir):
+    # Arrange
+    render_figures(docs_dir)
+    run_latex_mock.reset_mock()
+    (docs_dir / "new.md").write_text("```tikz\n\\draw (0,0) circle (1);\n```")
+
+    # Act
+    render_figures(docs_dir)
+
+    # Assert
+    assert run_latex_mock.call_count == 2  # The new and the failed figures
+
+
+def test_replace_figures(run_latex_mock, docs_dir):
+    # Arrange
+    render_figures(docs_dir)
+    names = [figure.name for _, figure in _find_figures(PAGE)]
+
+    # Act
+    res = replace_figures(PAGE + FAILED_PAGE, "usage/page.md", docs_dir=docs_dir)
+
+    # Assert
+    assert f"![TikZ figure](../assets/tikz/{names[0]})" in res
+    assert f"    ![TikZ figure](../assets/tikz/{names[1]})\n" in res
+    assert "```latex\nNot a figure\n```" in res
+    assert res.endswith(FAILED_PAGE)
+    assert "```tikz\n" not in res
+
+
+def test_mkdocs_hooks(run_latex_mock, docs_dir):
+    # Arrange
+    env = SimpleNamespace(
+        conf={"docs_dir": str(docs_dir)},
+        variables={"tikz_dir": "img"},
+        markdown=PAGE,
+        page=SimpleNamespace(file=SimpleNamespace(src_path="index.md")),
+    )
+
+    # Act
+    define_env(env)
+    on_pre_page_macros(env)
+
+    # Assert
+    assert len(list((docs_dir / "img").iterdir())) == 2
+    assert "](img/" in env.markdown
+    assert "```tikz" not in env.markdown
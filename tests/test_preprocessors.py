@@ -0,0 +1,192 @@
+import os
+
+import pytest
+
+nbconvert = pytest.importorskip("nbconvert")
+
+import nbformat
+from IPython.display import SVG, Image
+from nbconvert.preprocessors import ExecutePreprocessor
+from nbformat.v4 import new_code_cell, new_markdown_cell, new_notebook
+
+from jupyter_tikz import TexDocument
+from jupyter_tikz.preprocessors import (
+    TikZPreprocessor,
+    _needs_kernel,
+    _split_cell_magic,
+)
+from tests.conftest import *
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ("%%tikz\n" + TIKZ_CODE, ("", TIKZ_CODE)),
+        ("%%tikz -f -r\n" + ANY_CODE, ("-f -r", ANY_CODE)),
+        ("%%tikz", ("", "")),
+        ("%tikz code", None),
+        ("%%tikzz\n" + TIKZ_CODE, None),
+        ("x = 1\n%%tikz\n" + TIKZ_CODE, None),
+    ],
+)
+def test_split_cell_magic(source, expected):
+    # Act
+    res = _split_cell_magic(source)
+
+    # Assert
+    assert res == expected
+
+
+@pytest.mark.parametrize(
+    "line, cell, expected",
+    [
+        ("", TIKZ_CODE, False),
+        ("-r -d=300", TIKZ_CODE, False),
+        ("", "\\node {(** x **)};", True),
+        ("", "(* if x *)\\node {};(* endif *)", True),
+        ("-nj", "\\node {(** x **)};", False),
+        ("-l=$libraries", TIKZ_CODE, True),
+        ("-l={libraries}", TIKZ_CODE, True),
+        ("-sv=tex", TIKZ_CODE, True),
+        ("-pt", TIKZ_CODE, True),
+        ("-nc", TIKZ_CODE, True),
+        ("-spl", TIKZ_CODE, True),
+        ("--not-an-option", TIKZ_CODE, True),
+    ],
+)
+def test_needs_kernel(line, cell, expected):
+    # Act
+    res = _needs_kernel(line, cell)
+
+    # Assert
+    assert res == expected
+
+
+@pytest.fixture
+def notebook():
+    return new_notebook(
+        cells=[
+            new_markdown_cell("# Figures"),
+            new_code_cell("%load_ext jupyter_tikz"),
+            new_code_cell("%%tikz\n" + TIKZ_CODE),
+            new_code_cell("%%tikz -r\n" + TIKZ_CODE.replace("blue", "red")),
+            new_code_cell("%%tikz\n\\node {(** label **)};"),
+        ]
+    )
+
+
+@pytest.fixture
+def run_latex_mock(mocker):
+    def run_latex(self, rasterize=False, **kwargs):
+        _ = kwargs
+        if rasterize:
+            return Image(data=b"PNG", format="png")
+        return SVG(data="<svg></svg>")
+
+    return mocker.patch.object(
+        TexDocument, "run_latex", side_effect=run_latex, autospec=True
+    )
+
+
+@pytest.fixture
+def execute_mock(mocker):
+    sources = []
+
+    def preprocess(self, nb, resources=None, km=None):
+        _ = self, km
+        sources.append(
+            [(cell.source, list(cell.metadata.get("tags", []))) for cell in nb.cells]
+        )
+        return nb, resources
+
+    mocker.patch.object(
+        ExecutePreprocessor, "preprocess", side_effect=preprocess, autospec=True
+    )
+    return sources
+
+
+def test_preprocessor_prerenders_independent_cells(
+    run_latex_mock, execute_mock, notebook, tmp_path
+):
+    # Arrange
+    preprocessor = TikZPreprocessor(jobs=2)
+
+    # Act
+    nb, _ = preprocessor.preprocess(notebook, {"metadata": {"path": str(tmp_path)}})
+
+    # Assert
+    assert run_latex_mock.call_count == 2
+    assert all(call.kwargs["cache"] for call in run_latex_mock.call_args_list)
+    assert nb.cells[2].outputs[0].output_type == "display_data"
+    assert nb.cells[2].outputs[0].data["image/svg+xml"] == "<svg/>"
+    assert nb.cells[3].outputs[0].data["image/png"] == "UE5H"  # base64 of b"PNG"
+    assert nb.cells[4].outputs == []
+    nbformat.validate(nb)
+
+
+def test_preprocessor_skips_prerendered_cells_on_execution(
+    run_latex_mock, execute_mock, notebook, tmp_path
+):
+    # Arrange
+    preprocessor = TikZPreprocessor()
+
+    # Act
+    nb, _ = preprocessor.preprocess(notebook, {"metadata": {"path": str(tmp_path)}})
+
+    # Assert
+    executed = execute_mock[0]
+    assert executed[2][1] == ["skip-execution"]
+    assert executed[3][1] == ["skip-execution"]
+    assert executed[4] == ("%%tikz -c\n\\node {(** label **)};", [])
+    # The notebook is restored after execution
+    assert "tags" not in nb.cells[2].metadata
+    assert nb.cells[4].source == "%%tikz\n\\node {(** label **)};"
+
+
+def test_preprocessor_without_cache(run_latex_mock, execute_mock, notebook, tmp_path):
+    # Arrange
+    preprocessor = TikZPreprocessor(cache=False)
+
+    # Act
+    preprocessor.preprocess(notebook, {"metadata": {"path": str(tmp_path)}})
+
+    # Assert
+    assert not any(call.kwargs["cache"] for call in run_latex_mock.call_args_list)
+    assert execute_mock[0][4][0] == "%%tikz\n\\node {(** label **)};"
+
+
+def test_preprocessor_leaves_failed_renders_to_kernel(
+    mocker, execute_mock, notebook, tmp_path
+):
+    # Arrange
+    mocker.patch.object(TexDocument, "run_latex", return_value=None)
+    preprocessor = TikZPreprocessor()
+
+    # Act
+    nb, _ = preprocessor.preprocess(notebook, {"metadata": {"path": str(tmp_path)}})
+
+    # Assert
+    assert all(tags == [] for _, tags in execute_mock[0])
+    assert nb.cells[2].outputs == []
+
+
+def test_preprocessor_renders_in_notebook_dir(
+    mocker, execute_mock, notebook, tmp_path, monkeypatch
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "notebooks").mkdir()
+    cwds = []
+    mocker.patch.object(
+        TexDocument,
+        "run_latex",
+        side_effect=lambda **kwargs: cwds.append(os.getcwd()),
+    )
+    preprocessor = TikZPreprocessor()
+
+    # Act
+    preprocessor.preprocess(notebook, {"metadata": {"path": "notebooks"}})
+
+    # Assert
+    assert cwds == [str(tmp_path / "notebooks")] * 2
+    assert os.getcwd() == str(tmp_path)
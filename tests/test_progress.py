@@ -0,0 +1,158 @@
+import io
+import subprocess
+import time
+from pathlib import Path
+
+import pytest
+
+from jupyter_tikz import TexDocument, TikZMagics, jupyter_tikz, progress
+from jupyter_tikz.jupyter_tikz import _OutputTail
+from tests.conftest import *
+
+
+@pytest.fixture
+def display_mock(mocker):
+    return mocker.patch("IPython.display.display")
+
+
+@pytest.fixture
+def fast_progress(monkeypatch):
+    monkeypatch.setattr(progress, "_DELAY", 0.01)
+    monkeypatch.setattr(progress, "_INTERVAL", 0.01)
+    monkeypatch.setattr(progress, "_in_kernel", lambda: True)
+
+
+def test_output_tail():
+    # Arrange
+    tail = _OutputTail(size=10)
+
+    # Act
+    tail.read_from(io.BufferedReader(io.BytesIO(b"0123456789" * 5 + b"end")))
+
+    # Assert
+    assert tail.text() == "3456789end"
+    assert tail._length < 10 + jupyter_tikz._OUTPUT_CHUNK_SIZE
+
+
+def test_output_tail_cut_character():
+    # Arrange
+    tail = _OutputTail(size=5)
+
+    # Act
+    tail.read_from(io.BufferedReader(io.BytesIO("ééé".encode())))
+
+    # Assert
+    assert tail.text() == "\ufffdéé"
+
+
+def test_monitor_text(tmp_path):
+    # Arrange
+    log_path = tmp_path / "doc.log"
+    monitor = progress._Monitor(delay=60, interval=60)
+    monitor.update(stage="tex", engine="lualatex", tex_pass=1, log_path=log_path)
+
+    # Act & Assert
+    assert monitor.text() == "Compiling with lualatex, pass 1 (0 s)"
+    log_path.write_bytes(b"Preamble\n[1{/usr/share/pdftex.map}] [2] [")
+    assert monitor.text() == "Compiling with lualatex, pass 1, 2 pages (0 s)"
+    with open(log_path, "ab") as log_file:
+        log_file.write(b"3]\n")
+    assert monitor.text() == "Compiling with lualatex, pass 1, 3 pages (0 s)"
+    monitor.update(tex_pass=2)
+    log_path.write_bytes(b"Preamble\n[1]\n" + b"Overfull \\hbox\n" * 10)
+    assert monitor.text() == "Compiling with lualatex, pass 2, 1 page (0 s)"
+    monitor.update(stage="convert")
+    assert monitor.text() == "Converting (0 s)"
+
+
+def test_show_disabled(mocker):
+    # Arrange
+    thread_mock = mocker.patch.object(progress.threading, "Thread")
+
+    # Act
+    with progress.show(enabled=False):
+        progress.update(stage="tex")
+
+    # Assert
+    thread_mock.assert_not_called()
+
+
+def test_show_outside_kernel(mocker, monkeypatch, display_mock):
+    # Arrange
+    monkeypatch.setattr(progress, "_DELAY", 0.01)
+    thread_mock = mocker.patch.object(progress.threading, "Thread")
+
+    # Act
+    with progress.show():
+        time.sleep(0.05)
+
+    # Assert
+    thread_mock.assert_not_called()
+    display_mock.assert_not_called()
+
+
+def test_show_without_display_handle(fast_progress, display_mock, capsys):
+    # Arrange
+    display_mock.return_value = None  # e.g., no frontend
+
+    # Act
+    with progress.show():
+        progress.update(stage="tex")
+        time.sleep(0.05)
+
+    # Assert
+    display_mock.assert_called_once()
+    assert capsys.readouterr().err == ""
+
+
+def test_quick_render_shows_nothing(display_mock):
+    # Act
+    with progress.show():
+        progress.update(stage="tex")
+
+    # Assert
+    display_mock.assert_not_called()
+
+
+def test_run_latex_progress(mocker, monkeypatch, tmp_path, fast_progress, display_mock):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("JUPYTER_TIKZ_NO_DAEMON", "1")
+
+    def run(command, **kwargs):
+        _ = kwargs
+        output = Path(command.split()[-1])
+        if command.startswith("pdflatex"):
+            output.with_suffix(".log").write_text("[1] [2]")
+            time.sleep(0.2)
+            output.with_suffix(".pdf").write_text("pdf")
+        else:
+            output.write_text("<svg/>")
+        return subprocess.CompletedProcess(command, 0, "", "")
+
+    mocker.patch.object(jupyter_tikz, "_run_process", side_effect=run)
+
+    # Act
+    res = TexDocument(EXAMPLE_GOOD_TEX).run_latex(progress=True)
+
+    # Assert
+    assert res is not None
+    text = display_mock.call_args.args[0]["text/plain"]
+    assert text.startswith("Compiling with pdflatex, pass 1")
+    updates = [
+        call.args[0]["text/plain"]
+        for call in display_mock.return_value.update.call_args_list
+    ]
+    assert any("pass 1, 2 pages" in update for update in updates)
+    assert updates[-1] == ""  # Cleared at the end
+
+
+def test_magic_progress(mocker):
+    # Arrange
+    run_latex_mock = mocker.patch.object(TexDocument, "run_latex")
+
+    # Act
+    TikZMagics().tikz("", EXAMPLE_GOOD_TEX, local_ns={})
+
+    # Assert
+    assert run_latex_mock.call_args.kwargs["progress"]
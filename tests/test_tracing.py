@@ -0,0 +1,129 @@
+import json
+import threading
+
+import pytest
+
+from jupyter_tikz import TexDocument, TexFragment, TikZMagics, tracing
+from tests.conftest import *
+
+
+@pytest.fixture
+def trace_path(tmp_path, monkeypatch):
+    path = tmp_path / "trace.json"
+    monkeypatch.setenv("JUPYTER_TIKZ_TRACE", str(path))
+    return path
+
+
+def read_events(path):
+    # Viewers close the array themselves
+    return json.loads(path.read_text().rstrip().rstrip(",") + "]")
+
+
+def events_by_name(path):
+    return {event["name"]: event for event in read_events(path)}
+
+
+def encloses(outer, inner):
+    return (
+        outer["ts"] <= inner["ts"]
+        and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+        and outer["tid"] == inner["tid"]
+    )
+
+
+def test_span_disabled(tmp_path):
+    # Act
+    with tracing.span("name", key="value") as attributes:
+        attributes["other"] = 1
+
+    # Assert
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_span(trace_path):
+    # Act
+    with tracing.span("outer", key="value", empty=None):
+        with tracing.span("inner") as attributes:
+            attributes["added"] = 1
+
+    # Assert
+    assert trace_path.read_text().startswith("[\n")
+    inner, outer = read_events(trace_path)
+    assert (inner["name"], outer["name"]) == ("inner", "outer")
+    assert outer["ph"] == "X"
+    assert outer["args"] == {"key": "value"}
+    assert inner["args"] == {"added": 1}
+    assert encloses(outer, inner)
+
+
+def test_span_records_exceptions(trace_path):
+    # Act
+    with pytest.raises(ValueError):
+        with tracing.span("failing"):
+            raise ValueError()
+
+    # Assert
+    assert [event["name"] for event in read_events(trace_path)] == ["failing"]
+
+
+def test_span_threads(trace_path):
+    # Arrange
+    def record():
+        for _ in range(20):
+            with tracing.span("thread"):
+                pass
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+
+    # Act
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Assert
+    events = read_events(trace_path)
+    assert len(events) == 80
+    assert not list(trace_path.parent.glob("*.tmp"))
+
+
+def test_run_latex_spans(run_mock, trace_path):
+    # Arrange
+    tex = TexDocument(EXAMPLE_GOOD_TEX)
+
+    # Act
+    tex.run_latex(save_tex="saved")
+
+    # Assert
+    events = events_by_name(trace_path)
+    assert events["run_latex"]["args"] == {
+        "hash": tex._hex_hash,
+        "engine": "pdflatex",
+        "format": "svg",
+        "cache": False,
+    }
+    assert events["tex pass"]["args"] == {"engine": "pdflatex"}
+    for name in ["tex", "convert", "save", "cleanup"]:
+        assert encloses(events["run_latex"], events[name])
+    assert encloses(events["tex"], events["tex pass"])
+    assert events["tex"]["ts"] < events["convert"]["ts"] < events["save"]["ts"]
+
+
+def test_jinja_span(trace_path):
+    # Act
+    TexFragment("\\node {(* text *)};", implicit_tikzpicture=True, ns={"text": "a"})
+
+    # Assert
+    assert [event["name"] for event in read_events(trace_path)] == ["jinja"]
+
+
+def test_magic_spans(run_mock, trace_path):
+    # Act
+    TikZMagics().tikz("-i", "\\draw (0,0) circle (1);", local_ns={})
+
+    # Assert
+    events = events_by_name(trace_path)
+    magic = events["%%tikz"]
+    for name in ["parse", "jinja", "run_latex", "tex", "convert", "cleanup"]:
+        assert encloses(magic, events[name])
+    assert events["parse"]["ts"] < events["run_latex"]["ts"]
@@ -0,0 +1,160 @@
+import pytest
+
+from jupyter_tikz import TexDocument, TikZMagics, warmup
+from tests.conftest import *
+
+
+@pytest.fixture
+def run_latex_mock(mocker):
+    def run_latex(self, tex_program="pdflatex", **kwargs):
+        _ = kwargs
+        return None if tex_program == "broken" else "image"
+
+    return mocker.patch.object(
+        TexDocument, "run_latex", side_effect=run_latex, autospec=True
+    )
+
+
+@pytest.fixture
+def which_mock(mocker):
+    return mocker.patch.object(
+        warmup.shutil,
+        "which",
+        side_effect=lambda program: None if program == "missing" else program,
+    )
+
+
+def test_warmup(run_latex_mock, which_mock):
+    # Act
+    res = warmup.warmup(
+        "pdflatex, lualatex",
+        tex_packages="pgfplots",
+        rasterize=True,
+        converter="pdftoppm",
+    )
+
+    # Assert
+    assert list(res) == ["executables", "pdflatex", "lualatex"]
+    assert all(duration >= 0 for duration in res.values())
+    searched = [call.args[0] for call in which_mock.call_args_list]
+    assert searched == ["pdflatex", "lualatex", "kpsewhich", "pdftoppm"]
+    calls = run_latex_mock.call_args_list
+    assert [call.kwargs["tex_program"] for call in calls] == ["pdflatex", "lualatex"]
+    assert calls[0].kwargs["rasterize"] and calls[0].kwargs["converter"] == "pdftoppm"
+    assert "\\usepackage{pgfplots}" in calls[0].args[0].full_latex
+
+
+def test_warmup_missing_and_failing_programs(run_latex_mock, which_mock):
+    # Act
+    res = warmup.warmup(["missing", "broken"])
+
+    # Assert
+    assert res["missing"] is None and res["broken"] is None
+    assert [call.kwargs["tex_program"] for call in run_latex_mock.call_args_list] == [
+        "broken"
+    ]
+
+
+def test_warmup_invalid_converter():
+    # Act & Assert
+    with pytest.raises(ValueError, match="cannot output SVG"):
+        warmup.warmup(converter="pdftoppm")
+
+
+def test_format_report():
+    # Act
+    res = warmup._format_report({"executables": 0.01, "lualatex": 2.5, "xelatex": None})
+
+    # Assert
+    assert res.splitlines() == [
+        "TikZ warm-up: 2.51 s",
+        "  executables  0.01 s",
+        "  lualatex     2.50 s",
+        "  xelatex      not found or failed",
+    ]
+
+
+@pytest.mark.parametrize(
+    "setting, expected_programs",
+    [
+        (None, None),
+        ("0", None),
+        ("1", "pdflatex"),
+        ("pdflatex,lualatex", "pdflatex,lualatex"),
+    ],
+)
+def test_warmup_on_load(monkeypatch, mocker, setting, expected_programs):
+    # Arrange
+    if setting is None:
+        monkeypatch.delenv("JUPYTER_TIKZ_WARMUP", raising=False)
+    else:
+        monkeypatch.setenv("JUPYTER_TIKZ_WARMUP", setting)
+    warmup_mock = mocker.patch.object(warmup, "warmup")
+
+    # Act
+    thread = warmup._warmup_on_load()
+    if thread is not None:
+        thread.join(5)
+
+    # Assert
+    if expected_programs is None:
+        assert thread is None
+        warmup_mock.assert_not_called()
+    else:
+        assert thread.daemon
+        warmup_mock.assert_called_once_with(tex_programs=expected_programs)
+
+
+def test_magic_warmup(run_latex_mock, which_mock, capsys):
+    # Act
+    TikZMagics().tikz_warmup('-tp=pdflatex,missing -l="calc" -r')
+
+    # Assert
+    out = capsys.readouterr().out
+    assert out.startswith("TikZ warm-up: ")
+    assert "  missing      not found or failed" in out
+    tex = run_latex_mock.call_args.args[0]
+    assert "\\usetikzlibrary{calc}" in tex.full_latex
+    assert run_latex_mock.call_args.kwargs["rasterize"]
+
+
+def test_magic_warmup_background(mocker, capsys):
+    # Arrange
+    start_mock = mocker.patch("jupyter_tikz.magics.start_warmup")
+
+    # Act
+    TikZMagics().tikz_warmup("-b -tp=lualatex")
+
+    # Assert
+    assert capsys.readouterr().out == ""
+    assert start_mock.call_args.kwargs["tex_programs"] == "lualatex"
+
+
+@pytest.mark.parametrize(
+    "line, expected_err",
+    [
+        ("-cv=dvisvgm -r", "`dvisvgm` cannot output PNG images."),
+        ("-p=preamble -t=pgfplots", "You cannot provide `preamble`"),
+    ],
+)
+def test_magic_warmup_errors(run_latex_mock, capsys, line, expected_err):
+    # Act
+    TikZMagics().tikz_warmup(line)
+
+    # Assert
+    assert capsys.readouterr().err.startswith(expected_err)
+    run_latex_mock.assert_not_called()
+
+
+@pytest.mark.needs_latex
+@pytest.mark.needs_pdftocairo
+def test_warmup_renders(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+
+    # Act
+    res = warmup.warmup()
+
+    # Assert
+    assert res["pdflatex"] is not None
+    assert list(tmp_path.iterdir()) == []  # Temporary files are removed